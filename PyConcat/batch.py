@@ -0,0 +1,209 @@
+#! encoding = utf-8
+
+""" Batch concatenation from the command line (no GUI required)
+
+The manifest is a json file, either a list of jobs, or a dictionary
+with optional "defaults" shared by all jobs and a "jobs" list:
+
+    {
+      "defaults": {"avg1": 1, "avg2": 1, "fmtX": "%.3f", "fmtY": "%.3f"},
+      "jobs": [
+        {"file1": "a.txt", "file2": "b.txt", "output": "ab.txt",
+         "scale2": 1.2, "yshift2": -0.5},
+        {"file1": "c.txt", "file2": "d.txt", "output": "cd.txt",
+         "replace": true},
+        {"files": ["e.txt", {"file": "f.txt", "avg": 2, "scale": 0.9},
+                   "g.txt"], "output": "efg.txt"}
+      ]
+    }
+
+A job with a "files" list stitches any number of spectra in one pass,
+each with optional "avg", "scale" and "yshift".
+
+With "match": true, the scale and shift of file 2 (or of every stitched
+file but the first) are fitted to the others on their overlaps instead.
+
+Relative paths are resolved against the directory of the manifest.
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PyConcat.libs.lib import load_xy_file, load_xy_files, save_xy_blocks
+from PyConcat.libs import engine
+
+
+# parameters of a job and their default values
+JOB_DEFAULTS = {
+    'avg1': 1,
+    'avg2': 1,
+    'scale1': 1.,
+    'scale2': 1.,
+    'yshift1': 0.,
+    'yshift2': 0.,
+    'replace': False,
+    'match': False,
+    'grid': engine.GRID_EXACT,
+    'step': 0.,
+    'fmtX': '%.3f',
+    'fmtY': '%.3f',
+}
+
+
+def load_manifest(filename):
+    """ Load the job list from a manifest file
+
+    Arguments:
+        filename: str           manifest file name
+    Returns:
+        jobs: list of dict      jobs with all parameters filled in
+    """
+
+    with open(filename, 'r') as fp:
+        content = json.load(fp)
+    if isinstance(content, list):
+        defaults = {}
+        jobs_in = content
+    else:
+        defaults = content.get('defaults', {})
+        jobs_in = content.get('jobs', [])
+    root = os.path.dirname(os.path.abspath(filename))
+    jobs = []
+    for i, job_in in enumerate(jobs_in):
+        job = dict(JOB_DEFAULTS)
+        job.update(defaults)
+        job.update(job_in)
+        if 'files' in job:
+            job['files'] = [_load_segment(seg, root) for seg in job['files']]
+            file_keys = ('output',)
+        else:
+            file_keys = ('file1', 'file2', 'output')
+        for key in file_keys:
+            if key not in job:
+                raise ValueError('Job #{:d} misses "{:s}"'.format(i, key))
+            job[key] = _abs_path(job[key], root)
+        unknown = set(job) - set(JOB_DEFAULTS) - {'file1', 'file2', 'files', 'output'}
+        if unknown:
+            raise ValueError('Job #{:d} has unknown keys: {:s}'.format(
+                i, ', '.join(sorted(unknown))))
+        jobs.append(job)
+    return jobs
+
+
+def _abs_path(filename, root):
+    return os.path.join(root, os.path.expanduser(filename))
+
+
+def _load_segment(seg, root):
+    """ Fill in a stitching segment of the "files" list """
+    if isinstance(seg, str):
+        seg = {'file': seg}
+    else:
+        seg = dict(seg)
+    unknown = set(seg) - {'file', 'avg', 'scale', 'yshift'}
+    if 'file' not in seg or unknown:
+        raise ValueError('Invalid stitching segment: {:s}'.format(str(seg)))
+    seg['file'] = _abs_path(seg['file'], root)
+    seg.setdefault('avg', 1)
+    seg.setdefault('scale', 1.)
+    seg.setdefault('yshift', 0.)
+    return seg
+
+
+def run_job(job, load_workers=1):
+    """ Load, concatenate (or stitch) and save a single job
+
+    Arguments:
+        job: dict               job parameters, see JOB_DEFAULTS
+        load_workers: int       number of processes parsing the stitched
+                                files, None for all cores
+    Returns:
+        output: str             output file name
+    Raises:
+        ValueError              if any file fails to load, listing them all
+    """
+
+    if 'files' in job:
+        datas, errors = load_xy_files([seg['file'] for seg in job['files']], load_workers)
+        if errors:
+            raise ValueError('; '.join(err for _, err in errors))
+        segments = [(data[:, 0], data[:, 1], seg['avg'], seg['scale'], seg['yshift'])
+                    for seg, data in zip(job['files'], datas)]
+        if job['match']:
+            params = engine.match_segments(segments)
+            segments = [seg[:3] + param for seg, param in zip(segments, params)]
+        plan = engine.plan_stitch(segments)
+    else:
+        data1 = load_xy_file(job['file1'])
+        data2 = load_xy_file(job['file2'])
+        x1, y1, x2, y2 = data1[:, 0], data1[:, 1], data2[:, 0], data2[:, 1]
+        if job['match']:
+            job = dict(job)
+            job['scale2'], job['yshift2'] = engine.match_scale(
+                x1, y1, x2, y2, job['scale1'], job['yshift1'])
+        plan = engine.plan_concat(
+            x1, y1, x2, y2,
+            avg1=job['avg1'], avg2=job['avg2'],
+            scale1=job['scale1'], scale2=job['scale2'],
+            yshift1=job['yshift1'], yshift2=job['yshift2'],
+            replace=job['replace'], grid=job['grid'], step=job['step'])
+    # the result is formatted block by block, never made contiguous
+    save_xy_blocks(job['output'], plan.iter_blocks(), job['fmtX'], job['fmtY'])
+    return job['output']
+
+
+def run_jobs(jobs, workers=None):
+    """ Run jobs across a process pool
+
+    Arguments:
+        jobs: list of dict      jobs to run
+        workers: int            number of worker processes, default: all cores
+    Returns:
+        errors: list of (dict, str)   failed jobs and their error messages
+    """
+
+    errors = []
+    if workers == 1 or len(jobs) == 1:
+        # a single job parses its stitched files in parallel instead
+        for job in jobs:
+            try:
+                run_job(job, load_workers=workers)
+            except Exception as e:
+                errors.append((job, str(e)))
+        return errors
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append((futures[future], str(e)))
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pycc-batch',
+        description='Concatenate pairs of spectra listed in a json manifest')
+    parser.add_argument('manifest', help='json manifest of the jobs')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: all cores)')
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = load_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        print('Error: {:s}'.format(str(e)), file=sys.stderr)
+        return 2
+    errors = run_jobs(jobs, workers=args.jobs)
+    for job, err in errors:
+        print('Failed: {:s}: {:s}'.format(job['output'], err), file=sys.stderr)
+    print('{:d} of {:d} jobs done'.format(len(jobs) - len(errors), len(jobs)))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+
+    sys.exit(main())
@@ -0,0 +1,3 @@
+#! encoding = utf-8
+
+""" Benchmarks of the load, transform, concat and save hot paths """
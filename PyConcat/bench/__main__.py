@@ -0,0 +1,6 @@
+#! encoding = utf-8
+
+import sys
+from PyConcat.bench.run import main
+
+sys.exit(main())
@@ -0,0 +1,227 @@
+#! encoding = utf-8
+
+""" Time each hot path stage on synthetic spectra
+
+Results are written as json, and can be compared against a stored
+baseline to flag regressions:
+
+    pycc-bench --sizes 1e3 1e5 1e6 -o today.json --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from PyConcat.libs import lib, engine
+from PyConcat.bench import synth
+
+_PHASE_PATTERN = re.compile(r'^\s+(\S.*?)\s+([\d.]+) ms$', re.M)
+
+
+def timeit(fn, repeat=3):
+    """ Run fn repeat times
+
+    Returns:
+        best, median: float     wall time in seconds
+    """
+
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times), float(np.median(times))
+
+
+def iter_cases(n, work_dir):
+    """ Yield (stage, case, fn) of every benchmark at size n """
+
+    # text sniffing and parsing, for each delimiter with and without header
+    for delimiter in synth.DELIMITERS:
+        for n_header in (0, 5):
+            f = synth.write_text(work_dir, n, delimiter, n_header)
+            case = {'delimiter': delimiter, 'header': n_header}
+            yield 'sniff_format', case, lambda f=f: lib.sniff_format(f)
+            yield 'load_xy_file', case, lambda f=f: lib.load_xy_file(f)
+    # parsing with the x order
+    for order in synth.ORDERS[1:]:
+        f = synth.write_text(work_dir, n, 'comma', 0, order)
+        yield 'load_xy_file', {'order': order}, lambda f=f: lib.load_xy_file(f)
+    # sorting in memory
+    x, y = synth.make_spectrum(n)
+    for order in synth.ORDERS:
+        data = np.column_stack(synth.reorder(x, y, order))
+        yield 'sort_xy', {'order': order}, lambda data=data: lib.sort_xy(data)
+    # transforms and concatenation of two overlapping halves
+    yield 'y_stats', {}, lambda: engine.y_stats(y)
+    yield 'transform_y', {}, lambda: engine.transform_y(y, 1.5, 0.1)
+    i1 = n * 2 // 3
+    i2 = n // 3
+    x1, y1, x2, y2 = x[:i1], y[:i1], x[i2:], y[i2:]
+    yield 'concat', {'grid': engine.GRID_EXACT}, lambda: engine.concat(
+        x1, y1, x2, y2, scale2=1.2)
+    yield 'plan_concat', {'grid': engine.GRID_EXACT}, lambda: engine.plan_concat(
+        x1, y1, x2, y2, scale2=1.2)
+    x2s = x2 + (x[1] - x[0]) / 3
+    yield 'concat', {'grid': engine.GRID_FILE1}, lambda: engine.concat(
+        x1, y1, x2s, y2, grid=engine.GRID_FILE1)
+    yield 'stitch', {'segments': 10}, lambda: engine.stitch(
+        [(x[i:i + n // 5], y[i:i + n // 5]) for i in range(0, n, n // 10)])
+    f = os.path.join(work_dir, 'save.txt')
+    yield 'save_xy_file', {}, lambda: lib.save_xy_file(f, x, y, '%.3f', '%.6f')
+
+
+def time_startup(repeat=3):
+    """ Cold start the GUI off screen and collect its startup report
+
+    Returns:
+        phases: dict            {phase: [seconds of each run]}, including
+                                'process' for the whole interpreter run
+    """
+
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+    cmd = [sys.executable, '-m', 'PyConcat.launch', '--startup-report', '--quit']
+    phases = {}
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        proc = subprocess.run(cmd, env=env, capture_output=True, text=True, timeout=120)
+        dt = time.perf_counter() - t0
+        if proc.returncode:
+            raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr else
+                               'exit code {:d}'.format(proc.returncode))
+        phases.setdefault('process', []).append(dt)
+        for name, ms in _PHASE_PATTERN.findall(proc.stderr):
+            phases.setdefault(name, []).append(float(ms) / 1e3)
+    return phases
+
+
+def run(sizes, work_dir, repeat=3, stages=None, log=None):
+    """ Run the benchmarks
+
+    Arguments:
+        sizes: list of int      numbers of points
+        work_dir: str           directory of the synthetic files
+        repeat: int             number of runs of each case
+        stages: list of str     only run these stages, default: all
+        log: file               progress output
+    Returns:
+        results: dict           json-serializable results
+    """
+
+    results = []
+    if not stages or 'startup' in stages:
+        try:
+            phases = time_startup(repeat)
+        except (OSError, RuntimeError, subprocess.TimeoutExpired) as e:
+            phases = {}
+            if log:
+                print('startup skipped: {:s}'.format(str(e)), file=log)
+        for name, times in phases.items():
+            results.append({'stage': 'startup', 'case': {'phase': name}, 'n': 0,
+                            'best': min(times), 'median': float(np.median(times))})
+            if log:
+                print('{:<14s} {:>10d} {:<40s} {:10.4f} s'.format(
+                    'startup', 0, 'phase=' + name, min(times)), file=log)
+    for n in sizes:
+        for stage, case, fn in iter_cases(n, work_dir):
+            if stages and stage not in stages:
+                continue
+            best, median = timeit(fn, repeat)
+            results.append({'stage': stage, 'case': case, 'n': n,
+                            'best': best, 'median': median})
+            if log:
+                print('{:<14s} {:>10d} {:<40s} {:10.4f} s'.format(
+                    stage, n, _case_str(case), best), file=log)
+    meta = {
+        'version': lib.VERSION,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': repeat,
+    }
+    return {'meta': meta, 'results': results}
+
+
+def compare(results, baseline, threshold=1.2):
+    """ Compare results against a baseline
+
+    Arguments:
+        results, baseline: dict     outputs of run
+        threshold: float            ratio of best times flagged as a regression
+    Returns:
+        rows: list of (stage, n, case, base_time, new_time, ratio, is_regression)
+    """
+
+    base = {_result_key(r): r['best'] for r in baseline['results']}
+    rows = []
+    for r in results['results']:
+        key = _result_key(r)
+        if key in base:
+            ratio = r['best'] / base[key] if base[key] > 0 else float('inf')
+            rows.append((r['stage'], r['n'], r['case'], base[key], r['best'],
+                         ratio, ratio > threshold))
+    return rows
+
+
+def _result_key(r):
+    return r['stage'], r['n'], json.dumps(r['case'], sort_keys=True)
+
+
+def _case_str(case):
+    return ' '.join('{:s}={:s}'.format(k, str(v)) for k, v in sorted(case.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pycc-bench',
+        description='Benchmark the load, transform, concat and save hot paths')
+    parser.add_argument('--sizes', type=float, nargs='+',
+                        default=[1e3, 1e4, 1e5, 1e6],
+                        help='numbers of points, up to 1e8 (default: 1e3 to 1e6)')
+    parser.add_argument('--stages', nargs='+', default=None,
+                        help='only run these stages')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each case (default: 3)')
+    parser.add_argument('--work-dir', default=None,
+                        help='keep the synthetic files in this directory')
+    parser.add_argument('-o', '--output', default=None,
+                        help='write the results to this json file')
+    parser.add_argument('--compare', default=None,
+                        help='baseline json file to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='slowdown ratio flagged as a regression (default: 1.2)')
+    args = parser.parse_args(argv)
+
+    sizes = [int(n) for n in args.sizes]
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = run(sizes, args.work_dir, args.repeat, args.stages, log=sys.stdout)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run(sizes, work_dir, args.repeat, args.stages, log=sys.stdout)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as fp:
+            baseline = json.load(fp)
+        rows = compare(results, baseline, args.threshold)
+        n_reg = 0
+        print('\nComparison with {:s}'.format(args.compare))
+        for stage, n, case, t_base, t_new, ratio, is_reg in rows:
+            n_reg += is_reg
+            print('{:<14s} {:>10d} {:<40s} {:10.4f} -> {:10.4f} s  x{:5.2f}{:s}'.format(
+                stage, n, _case_str(case), t_base, t_new, ratio,
+                '  REGRESSION' if is_reg else ''))
+        print('{:d} regression(s) in {:d} compared cases'.format(n_reg, len(rows)))
+        return 1 if n_reg else 0
+    return 0
@@ -0,0 +1,76 @@
+#! encoding = utf-8
+
+""" Synthetic spectra for the benchmarks """
+
+import os
+import numpy as np
+from PyConcat.libs.lib import save_xy_file
+
+# name: delimiter
+DELIMITERS = {'comma': ',', 'tab': '\t', 'space': ' '}
+ORDERS = ('sorted', 'reversed', 'shuffled')
+
+
+def make_spectrum(n, xmin=1e4, xmax=2e4, nlines=50, seed=0):
+    """ Noisy baseline with Lorentzian lines, on a uniform grid
+
+    Arguments:
+        n: int                  number of points
+        xmin, xmax: float       x range
+        nlines: int             number of lines
+        seed: int               random seed
+    Returns:
+        x, y: np.array          sorted spectrum
+    """
+
+    rng = np.random.default_rng(seed)
+    x = np.linspace(xmin, xmax, n)
+    y = rng.normal(0., 0.01, n)
+    width = (xmax - xmin) * 1e-4
+    for x0, a in zip(rng.uniform(xmin, xmax, nlines), rng.uniform(0.1, 1, nlines)):
+        # only evaluate the line where it is significant
+        i0, i1 = np.searchsorted(x, (x0 - 50 * width, x0 + 50 * width))
+        y[i0:i1] += a / (1 + ((x[i0:i1] - x0) / width) ** 2)
+    return x, y
+
+
+def reorder(x, y, order, seed=0):
+    """ Return (x, y) in the given order, one of ORDERS """
+    if order == 'sorted':
+        return x, y
+    elif order == 'reversed':
+        return x[::-1], y[::-1]
+    elif order == 'shuffled':
+        idx = np.random.default_rng(seed).permutation(len(x))
+        return x[idx], y[idx]
+    else:
+        raise ValueError('Unknown order: {:s}'.format(order))
+
+
+def write_text(dir_, n, delimiter='comma', n_header=0, order='sorted'):
+    """ Write a synthetic text spectrum, reusing it if it already exists
+
+    Returns:
+        filename: str           name of the written file
+    """
+
+    filename = os.path.join(dir_, 'spec_{:d}_{:s}_hdr{:d}_{:s}.txt'.format(
+        n, delimiter, n_header, order))
+    if not os.path.isfile(filename):
+        x, y = reorder(*make_spectrum(n), order)
+        tmp = filename + '.tmp'
+        save_xy_file(tmp, x, y, '%.6f', '%.6e')
+        delm = DELIMITERS[delimiter]
+        with open(tmp, 'rb') as src, open(filename, 'wb') as dst:
+            # text rows, not comments, so that the header count is sniffed
+            for i in range(n_header - 1):
+                dst.write('Synthetic spectrum{:s}row {:d}\n'.format(delm, i + 1).encode())
+            if n_header:
+                dst.write('Frequency (MHz){:s}Intensity\n'.format(delm).encode())
+            while True:
+                blk = src.read(1 << 22)
+                if not blk:
+                    break
+                dst.write(blk.replace(b' ', delm.encode()))
+        os.remove(tmp)
+    return filename
@@ -3,6 +3,13 @@
 """ System configuration files """
 
 import json
+import os
+
+
+def prefs_file():
+    """ Path of the preference file, next to this module """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prefs.json')
+
 
 def to_json(obj, filename):
     """ Serialize an object to json and save on disk
@@ -43,10 +50,19 @@ class Prefs:
         # default directories
         self.spec_dir = '.'
         self.export_dir = '.'
+        self.session_dir = '.'
+        self.cache_dir = ''     # empty for the default user cache directory
+        self.cache_size = 512   # parsed spectrum cache budget in MB, 0 to disable
+        self.history_size = 1024    # undo history budget in MB, 0 to disable
 
         # default parameters
         self.click_radius = 3
+        self.export_workers = 1     # number of processes formatting the exported text
+        self.load_workers = 0       # number of processes parsing stitched files, 0 for all cores
         self.is_antialias = True    # turn on anti-alias
+        self.is_approx_median = False   # sample the median of large spectra
+        self.is_session_compress = False    # zlib compress saved sessions
+        self.is_trace = False       # record the timing of the hot paths
         self.nscreens = 1                 # number of screens
         self.geometry = (900, 600, 1280, 1080)              # window geometry
 
@@ -58,6 +74,8 @@ class Prefs:
         self.scale2 = 1
         self.yshift1 = 0
         self.yshift2 = 0
+        self.concat_grid = 'exact'  # grid of the averaged overlap
+        self.concat_step = 0.01     # step of the custom overlap grid
 
 
 def _obj2dict(obj):
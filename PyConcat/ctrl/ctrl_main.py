@@ -3,24 +3,35 @@
 """ PSE main controller """
 
 
+from collections import deque
 import numpy as np
-from PyQt5 import QtWidgets
+from PyQt5 import QtWidgets, QtCore
 from os.path import isfile
-try:
-    import importlib.resources as resources
-except ImportError:
-    # Try backported to PY<37 'importlib_resources'.
-    import importlib_resources as resources
-from PyConcat.libs.lib import get_abs_path, split_filename_dir, load_xy_file
+from PyConcat.libs.lib import split_filename_dir, save_xy_blocks
+from PyConcat.libs import engine
+from PyConcat.libs.cache import SpectrumCache
+from PyConcat.libs.history import History
+from PyConcat.libs.lod import MinMaxPyramid, SegmentedPyramid
+from PyConcat.libs import session
+from PyConcat.libs.trace import TRACER, traced
+from PyConcat.ctrl.worker import Worker
 from PyConcat.config import config
 from PyConcat.ui.ui import MainUI, MenuBar
-from PyConcat.ui.dialog import DialogPref, DialogAbout
 from PyConcat.ui.common import msg
 
 
+# size above which the median of memory mapped data is estimated
+MAX_EXACT_MEDIAN = 1 << 22
+# size above which the median of a live preview is estimated
+PREVIEW_MEDIAN = 1 << 16
+
+
 class PyCCMainWin(QtWidgets.QMainWindow):
     """ PSE main window """
 
+    # outermost timing span that just finished, possibly in a worker thread
+    traceDone = QtCore.pyqtSignal(object)
+
     def __init__(self, nscreens):
         super().__init__()
 
@@ -33,13 +44,14 @@ class PyCCMainWin(QtWidgets.QMainWindow):
 
         # load settings
         self.prefs = config.Prefs()
-        f = get_abs_path('PyConcat.config', 'prefs.json')
+        f = config.prefs_file()
         if isfile(f):
             config.from_json_(self.prefs, f)
         self.prefs.nscreens = nscreens
         self.setGeometry(*self.prefs.geometry)
         self.dbconn = None          # db connection
         self.dbcursor = None        # db cursor
+        self.cache = SpectrumCache(self.prefs.cache_dir, self.prefs.cache_size * 1024 ** 2)
 
         # load main UI
         self.ui = MainUI(self.prefs, parent=self)
@@ -49,33 +61,62 @@ class PyCCMainWin(QtWidgets.QMainWindow):
         self.ui.box2.btnOpen.setShortcut('Ctrl+Shift+O')
         self.ui.box2.btnOpen.setToolTip('Hot key: Ctrl+Shift+O')
 
-        # create dialog windows
-        self.dPref = DialogPref(parent=self)
-        self.dPref.load_prefs(self.prefs)
-        self.dAbout = DialogAbout(parent=self)
+        # dialog windows are created the first time they are opened
+        self.dPref = None
+        self.dAbout = None
 
         # set menu bar
         self.menuBar = MenuBar(self.prefs, parent=self)
         self.setMenuBar(self.menuBar)
-        self.menuBar.actionPref.triggered.connect(self.dPref.exec)
-        self.menuBar.actionAbout.triggered.connect(self.dAbout.exec)
+        self.menuBar.actionOpenSession.triggered.connect(self.open_session)
+        self.menuBar.actionSaveSession.triggered.connect(self.save_session)
+        self.menuBar.actionPref.triggered.connect(self.open_pref)
+        self.menuBar.actionAbout.triggered.connect(self.open_about)
         self.menuBar.actionExit.triggered.connect(self.close)
+        self.menuBar.actionTrace.toggled.connect(self.enable_trace)
+        self.menuBar.actionSaveTrace.triggered.connect(self.save_trace)
+        self.menuBar.actionUndo.triggered.connect(self.undo)
+        self.menuBar.actionRedo.triggered.connect(self.redo)
 
         # set central widget
         self.setCentralWidget(self.ui)
 
         # connect top-level signals
-        self.dPref.accepted.connect(self.update_prefs)
         self.ui.box1.btnOpen.clicked.connect(self.open_file_1)
         self.ui.box2.btnOpen.clicked.connect(self.open_file_2)
         self.ui.box1.btnClear.clicked.connect(self.clear_file_1)
+        self.ui.box1.btnCancel.clicked.connect(self.cancel_file_1)
         self.ui.box2.btnClear.clicked.connect(self.clear_file_2)
-        self.ui.box1.inpYShift.valueChanged.connect(self.transform_y1)
-        self.ui.box2.inpYShift.valueChanged.connect(self.transform_y2)
-        self.ui.box1.inpScale.valueChanged.connect(self.transform_y1)
-        self.ui.box2.inpScale.valueChanged.connect(self.transform_y2)
+        self.ui.box2.btnCancel.clicked.connect(self.cancel_file_2)
+        # coalesce rapid spin box changes: only the latest value is rendered
+        self._timerY1 = QtCore.QTimer(self)
+        self._timerY1.setSingleShot(True)
+        self._timerY1.setInterval(15)
+        self._timerY1.timeout.connect(self.transform_y1)
+        self._timerY2 = QtCore.QTimer(self)
+        self._timerY2.setSingleShot(True)
+        self._timerY2.setInterval(15)
+        self._timerY2.timeout.connect(self.transform_y2)
+        self.ui.box1.inpYShift.valueChanged.connect(self._timerY1.start)
+        self.ui.box2.inpYShift.valueChanged.connect(self._timerY2.start)
+        self.ui.box1.inpScale.valueChanged.connect(self._timerY1.start)
+        self.ui.box2.inpScale.valueChanged.connect(self._timerY2.start)
+        # live preview of the concatenation, coalesced the same way
+        self._timerPreview = QtCore.QTimer(self)
+        self._timerPreview.setSingleShot(True)
+        self._timerPreview.setInterval(15)
+        self._timerPreview.timeout.connect(self.update_preview)
+        for box in (self.ui.box1, self.ui.box2):
+            box.inpAvg.valueChanged.connect(self._preview_changed)
+            box.inpScale.valueChanged.connect(self._preview_changed)
+            box.inpYShift.valueChanged.connect(self._preview_changed)
+        self.ui.box3.ckPreview.toggled.connect(self._replan_preview)
+        self.ui.box3.comboGrid.currentIndexChanged.connect(self._replan_preview)
+        self.ui.box3.inpStep.valueChanged.connect(self._replan_preview)
+        self.ui.box3.btnMatch.clicked.connect(self.auto_match)
         self.ui.box3.btnConcat.clicked.connect(self.concat_or_replace)
         self.ui.box3.btnReplace.clicked.connect(lambda: self.concat_or_replace(True))
+        self.ui.box3.btnStitch.clicked.connect(self.stitch_files)
         self.ui.box3.btnSave.clicked.connect(self.save)
         self.ui.box3.btnOverride.clicked.connect(self.override)
         self.ui.box3.btnClear.clicked.connect(self.clear_concat)
@@ -85,22 +126,90 @@ class PyCCMainWin(QtWidgets.QMainWindow):
         self.y1 = np.zeros(0)
         self.x2 = np.zeros(0)
         self.y2 = np.zeros(0)
-        self.xt = np.zeros(0)
-        self.yt = np.zeros(0)
+        # concatenated result, kept virtual until it is saved or moved to file 1
+        self.plant = engine.ConcatPlan()
+        self._replace = False       # mode of the latest concatenation
+        self._plan_pending = False  # a full concatenation is running
+        self._preview_dirty = False     # parameters changed while it was running
+        # (min, max, median) of y1, y2 and the result, None if there is no data
+        self.stats1 = None
+        self.stats2 = None
+        self.statst = None
+        # level-of-detail pyramids, shared by the canvases. None until
+        # the worker has built them
+        self.lod1 = None
+        self.lod2 = None
+        self.lodt = None
+        self.catt = None            # overlap curve of the result, see prepare_plan
+        self.worker = Worker(self)
+        # undo/redo of the workspace. States share the unchanged arrays
+        self.history = History(self.prefs.history_size * 1024 ** 2)
+        self.history.push(self._snapshot())
+        self._steps = 0     # number of steps recorded, see concat_or_replace
+
+        # timing of the hot paths, the breakdown goes to the status bar
+        self._trace_history = deque(maxlen=10)
+        self.traceDone.connect(self._show_trace)
+        TRACER.add_listener(self.traceDone.emit)
+        self.enable_trace(self.prefs.is_trace)
 
     def closeEvent(self, ev):
 
         # save setting to local file
-        f = get_abs_path('PyConcat.config', 'prefs.json')
+        f = config.prefs_file()
         self.ui.fetch_prefs_(self.prefs)
         geo = self.geometry()
         self.prefs.geometry = (geo.x(), geo.y(), geo.width(), geo.height())
+        self.prefs.is_trace = self.menuBar.actionTrace.isChecked()
         config.to_json(self.prefs, f)
+        self.worker.shutdown()
+        self.cache.close()
+        TRACER.remove_listener(self.traceDone.emit)
         self.close()
 
+    def open_pref(self):
+        if self.dPref is None:
+            from PyConcat.ui.dialog import DialogPref
+            self.dPref = DialogPref(parent=self)
+            self.dPref.accepted.connect(self.update_prefs)
+        self.dPref.load_prefs(self.prefs)
+        self.dPref.exec()
+
+    def open_about(self):
+        if self.dAbout is None:
+            from PyConcat.ui.dialog import DialogAbout
+            self.dAbout = DialogAbout(parent=self)
+        self.dAbout.exec()
+
     def update_prefs(self):
         self.dPref.fetch_prefs_(self.prefs)
         self.ui.load_prefs(self.prefs)
+        self.cache.set_max_bytes(self.prefs.cache_size * 1024 ** 2)
+        self.history.set_max_bytes(self.prefs.history_size * 1024 ** 2)
+        self._update_undo_actions()
+
+    def enable_trace(self, is_enabled):
+        TRACER.enable(is_enabled)
+        if is_enabled:
+            self.statusBar().showMessage('Recording timing')
+        else:
+            self.statusBar().clearMessage()
+
+    def _show_trace(self, sp):
+        # skip bare redraws, e.g. when panning, to keep the last operation
+        if TRACER.enabled and sp.children:
+            self._trace_history.append(sp.breakdown())
+            self.statusBar().showMessage(self._trace_history[-1])
+            self.statusBar().setToolTip('\n'.join(self._trace_history))
+
+    def save_trace(self):
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self, 'Save Timing Trace', self.prefs.export_dir, 'Chrome Trace (*.json)')
+        if filename:
+            try:
+                TRACER.dump(filename)
+            except OSError as e:
+                msg('Error', str(e))
 
     def _open_file_dialog(self, title):
         filename, _ = QtWidgets.QFileDialog.getOpenFileName(
@@ -110,176 +219,526 @@ class PyCCMainWin(QtWidgets.QMainWindow):
         return filename
 
     def open_file_1(self):
-        try:
-            filename = self._open_file_dialog('Open Data 1')
-            if filename:
-                data = load_xy_file(filename)
-                self.x1 = data[:, 0]
-                self.y1 = data[:, 1]
-                self.ui.box1.inpYShift.setValue(0)
-                self.ui.box1.inpScale.setValue(1)
-                self.transform_y1()    # plot the data without y shift
-                self._adjust_range()
-        except Exception as e:
-            msg('Error', str(e))
+        filename = self._open_file_dialog('Open Data 1')
+        if filename:
+            # the data is only assigned to slot 1 once it is fully parsed
+            self.ui.box1.set_loading(split_filename_dir(filename)[1])
+            self.worker.submit('file1', load_task, self.cache, filename,
+                               self.prefs.is_approx_median,
+                               on_done=self._file1_loaded,
+                               on_error=self._file1_failed,
+                               on_progress=self.ui.box1.set_progress)
 
     def open_file_2(self):
-        try:
-            filename = self._open_file_dialog('Open Data 2')
-            if filename:
-                data = load_xy_file(filename)
-                self.x2 = data[:, 0]
-                self.y2 = data[:, 1]
-                self.ui.box2.inpYShift.setValue(0)
-                self.ui.box2.inpScale.setValue(1)
-                self.transform_y2()    # plot the data without y shift
-                self._adjust_range()
-        except Exception as e:
-            msg('Error', str(e))
+        filename = self._open_file_dialog('Open Data 2')
+        if filename:
+            # the data is only assigned to slot 2 once it is fully parsed
+            self.ui.box2.set_loading(split_filename_dir(filename)[1])
+            self.worker.submit('file2', load_task, self.cache, filename,
+                               self.prefs.is_approx_median,
+                               on_done=self._file2_loaded,
+                               on_error=self._file2_failed,
+                               on_progress=self.ui.box2.set_progress)
+
+    def _file1_loaded(self, result, label='Open File 1'):
+        self.ui.box1.set_loading('')
+        self.x1, self.y1, self.stats1, self.lod1 = result
+        # no separate preview for the reset, the new data is replanned below
+        for inp, value in ((self.ui.box1.inpYShift, 0), (self.ui.box1.inpScale, 1)):
+            inp.blockSignals(True)
+            inp.setValue(value)
+            inp.blockSignals(False)
+        self.transform_y1()    # plot the data without y shift
+        self._adjust_range()
+        self._record(label)
+        # the preview of the new data is part of the same undo step
+        self._replan_preview(amend=True)
+
+    def _file2_loaded(self, result, label='Open File 2'):
+        self.ui.box2.set_loading('')
+        self.x2, self.y2, self.stats2, self.lod2 = result
+        # no separate preview for the reset, the new data is replanned below
+        for inp, value in ((self.ui.box2.inpYShift, 0), (self.ui.box2.inpScale, 1)):
+            inp.blockSignals(True)
+            inp.setValue(value)
+            inp.blockSignals(False)
+        self.transform_y2()    # plot the data without y shift
+        self._adjust_range()
+        self._record(label)
+        # the preview of the new data is part of the same undo step
+        self._replan_preview(amend=True)
+
+    def _file1_failed(self, err):
+        self.ui.box1.set_loading('')
+        msg('Error', err)
+
+    def _file2_failed(self, err):
+        self.ui.box2.set_loading('')
+        msg('Error', err)
+
+    def cancel_file_1(self):
+        self.worker.cancel('file1')
+        self.ui.box1.set_loading('')
+
+    def cancel_file_2(self):
+        self.worker.cancel('file2')
+        self.ui.box2.set_loading('')
 
     def clear_file_1(self):
+        self.cancel_file_1()
         self.x1 = np.zeros(0)
         self.y1 = np.zeros(0)
+        self.stats1 = None
+        self.lod1 = None
         self.ui.box1.inpYShift.setValue(0)
         self.ui.box1.inpScale.setValue(1)
-        self.ui.canvasFull.plot1(np.zeros(0), np.zeros(0))
-        self.ui.canvasDetail.plot1(np.zeros(0), np.zeros(0))
+        self.ui.store.clear('file1')
         self._adjust_range()
+        self._record('Clear File 1')
 
     def clear_file_2(self):
+        self.cancel_file_2()
         self.x2 = np.zeros(0)
         self.y2 = np.zeros(0)
+        self.stats2 = None
+        self.lod2 = None
         self.ui.box2.inpYShift.setValue(0)
         self.ui.box2.inpScale.setValue(1)
-        self.ui.canvasFull.plot2(np.zeros(0), np.zeros(0))
-        self.ui.canvasDetail.plot2(np.zeros(0), np.zeros(0))
+        self.ui.store.clear('file2')
         self._adjust_range()
+        self._record('Clear File 2')
 
+    @traced
     def transform_y1(self):
+        if self.lod1 is None:
+            # nothing loaded, or the worker is still preparing the data
+            return None
         yshift = self.ui.box1.inpYShift.value()
         scale = self.ui.box1.inpScale.value()
-        ym = np.median(self.y1)
-        y_tr = (self.y1 - ym) * scale + ym + yshift
-        self.ui.canvasFull.plot1(self.x1, y_tr)
-        self.ui.canvasDetail.plot1(self.x1, y_tr)
+        affine = engine.affine_coef(scale, yshift, self.stats1[2]) if self.stats1 else (1., 0.)
+        self.ui.store.set_data('file1', self.x1, self.y1, self.stats1, affine, self.lod1)
 
+    @traced
     def transform_y2(self):
+        if self.lod2 is None:
+            # nothing loaded, or the worker is still preparing the data
+            return None
         yshift = self.ui.box2.inpYShift.value()
         scale = self.ui.box2.inpScale.value()
-        ym = np.median(self.y2)
-        y_tr = (self.y2 - ym) * scale + ym + yshift
-        self.ui.canvasFull.plot2(self.x2, y_tr)
-        self.ui.canvasDetail.plot2(self.x2, y_tr)
+        affine = engine.affine_coef(scale, yshift, self.stats2[2]) if self.stats2 else (1., 0.)
+        self.ui.store.set_data('file2', self.x2, self.y2, self.stats2, affine, self.lod2)
 
     def _adjust_range(self):
-        """ Adjust x range of the two curves """
+        """ Adjust x range of the two curves. x is sorted, so its range
+        is given by the first and last points """
         # full range
-        if np.any(self.x1) and np.any(self.x2):
-            xmin = min(self.x1.min(), self.x2.min())
-            xmax = max(self.x1.max(), self.x2.max())
+        if len(self.x1) and len(self.x2):
+            xmin = min(self.x1[0], self.x2[0])
+            xmax = max(self.x1[-1], self.x2[-1])
             self.ui.canvasFull.set_xrange(xmin, xmax)
             # detail range
-            self.ui.canvasDetail.set_xrange(*self._find_overlap_range(
-                self.x1.min(), self.x1.max(), self.x2.min(), self.x2.max()
+            self.ui.canvasDetail.set_xrange(*engine.find_overlap_range(
+                self.x1[0], self.x1[-1], self.x2[0], self.x2[-1]
             ))
-        elif np.any(self.x1):
-            self.ui.canvasFull.set_xrange(self.x1.min(), self.x1.max())
-            self.ui.canvasDetail.set_xrange(self.x1.min(), self.x1.max())
-        elif np.any(self.x2):
-            self.ui.canvasFull.set_xrange(self.x2.min(), self.x2.max())
-            self.ui.canvasDetail.set_xrange(self.x2.min(), self.x2.max())
-
-    @staticmethod
-    def _find_overlap_range(x1min, x1max, x2min, x2max):
-        """ Find the overlap range of two x ranges """
-        _l = [x1min, x1max, x2min, x2max]
-        _l.sort()
-        return _l[1], _l[2]
+        elif len(self.x1):
+            self.ui.canvasFull.set_xrange(self.x1[0], self.x1[-1])
+            self.ui.canvasDetail.set_xrange(self.x1[0], self.x1[-1])
+        elif len(self.x2):
+            self.ui.canvasFull.set_xrange(self.x2[0], self.x2[-1])
+            self.ui.canvasDetail.set_xrange(self.x2[0], self.x2[-1])
 
     def save(self):
+        # a second save would write the same file at the same time
+        if self.worker.is_busy('save'):
+            msg('Error', 'The concatenated spectrum is still being saved')
+            return None
         filename, _ = QtWidgets.QFileDialog.getSaveFileName(
             self, 'Save Concatenated', self.prefs.export_dir, 'Spectral File (*.txt)')
         if filename:
             self.prefs.export_dir, _ = split_filename_dir(filename)
             fmtX = self.ui.box3.inpFmtX.text()
             fmtY = self.ui.box3.inpFmtY.text()
-            try:
-                np.savetxt(filename, np.column_stack((self.xt, self.yt)), fmt=[fmtX, fmtY])
-            except Exception as e:
-                msg('Error', str(e))
+            self.worker.submit('save', save_xy_blocks, filename, self.plant.iter_blocks(),
+                               fmtX, fmtY, workers=self.prefs.export_workers,
+                               nrows=len(self.plant),
+                               on_error=lambda err: msg('Error', err))
 
-    def concat_or_replace(self, replace=False):
-        # get settings
-        avg1 = self.ui.box1.inpAvg.value()
-        scale1 = self.ui.box1.inpScale.value()
-        avg2 = self.ui.box2.inpAvg.value()
-        scale2 = self.ui.box2.inpScale.value()
-        yshift1 = self.ui.box1.inpYShift.value()
-        yshift2 = self.ui.box2.inpYShift.value()
-        # get transformed data
-        x1 = self.x1
-        x2 = self.x2
-        y1 = (self.y1 - np.median(self.y1)) * scale1 + np.median(self.y1) + yshift1
-        y2 = (self.y2 - np.median(self.y2)) * scale2 + np.median(self.y2) + yshift2
-        try:
-            # get overlap xrange
-            xo_min, xo_max = self._find_overlap_range(x1.min(), x1.max(), x2.min(), x2.max())
-            # check if the dimension of the two data are identical
-            x1_to_cat = x1[(x1 > xo_min) & (x1 < xo_max)]
-            x2_to_cat = x2[(x2 > xo_min) & (x2 < xo_max)]
-            y1_to_cat = y1[(x1 > xo_min) & (x1 < xo_max)]
-            y2_to_cat = y2[(x2 > xo_min) & (x2 < xo_max)]
-        except Exception as e:
-            msg('Error', str(e))
+    def save_session(self):
+        """ Save both inputs, their parameters and the result """
+        # both saves would write the same temporary file
+        if self.worker.is_busy('save_session'):
+            msg('Error', 'The session is still being saved')
+            return None
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self, 'Save Session', self.prefs.session_dir,
+            'PyConcat Session (*{:s})'.format(session.SESSION_EXT))
+        if not filename:
             return None
-        # concatenate
-        # 1. find left part
-        if x1.min() < xo_min:
-            x_left = x1[x1 <= xo_min]
-            y_left = y1[x1 <= xo_min]
+        self.prefs.session_dir, _ = split_filename_dir(filename)
+        curves = {}
+        if self.lod1 is not None:
+            curves['file1'] = (self.x1, self.y1, self.stats1, self.lod1)
+        if self.lod2 is not None:
+            curves['file2'] = (self.x2, self.y2, self.stats2, self.lod2)
+        if len(self.plant):
+            curves['result'] = (self.plant, None, self.statst, None)
+        if self.catt:
+            curves['overlap'] = self.catt
+        params = {
+            'avg1': self.ui.box1.inpAvg.value(),
+            'scale1': self.ui.box1.inpScale.value(),
+            'yshift1': self.ui.box1.inpYShift.value(),
+            'avg2': self.ui.box2.inpAvg.value(),
+            'scale2': self.ui.box2.inpScale.value(),
+            'yshift2': self.ui.box2.inpYShift.value(),
+            'replace': self._replace,
+            'grid': self.ui.box3.get_grid(),
+            'step': self.ui.box3.inpStep.value(),
+        }
+        self.worker.submit('save_session', session.save_session, filename, curves, params,
+                           compress=self.prefs.is_session_compress,
+                           on_error=lambda err: msg('Error', err))
+
+    def open_session(self):
+        filename, _ = QtWidgets.QFileDialog.getOpenFileName(
+            self, 'Open Session', self.prefs.session_dir,
+            'PyConcat Session (*{:s})'.format(session.SESSION_EXT))
+        if filename:
+            self.prefs.session_dir, _ = split_filename_dir(filename)
+            self.worker.submit('session', session.load_session, filename,
+                               on_done=self._session_loaded,
+                               on_error=lambda err: msg('Error', err))
+
+    def _session_loaded(self, sess):
+        empty = (np.zeros(0), np.zeros(0), None, None)
+        p = sess.params
+        if 'result' in sess.curves:
+            xt, yt, statst, lod = sess.curves['result']
+            cat = sess.curves.get('overlap')
+            x_cat, y_cat = cat[:2] if cat else (None, None)
+            plant = engine.ConcatPlan([(xt, yt, 1., 0.)], x_cat, y_cat)
+            lodt = SegmentedPyramid.from_parts([(lod, 1., 0.)])
         else:
-            x_left = x2[x2 <= xo_min]
-            y_left = y2[x2 <= xo_min]
-        # 2. find right part
-        if x1.max() > xo_max:
-            x_right = x1[x1 >= xo_max]
-            y_right = y1[x1 >= xo_max]
+            plant, statst, lodt, cat = engine.ConcatPlan(), None, None, None
+        self.ui.box3.comboGrid.blockSignals(True)
+        self.ui.box3.set_grid(p.get('grid', engine.GRID_EXACT))
+        self.ui.box3.comboGrid.blockSignals(False)
+        self.ui.box3.inpStep.setEnabled(self.ui.box3.get_grid() == engine.GRID_STEP)
+        self.ui.box3.inpStep.blockSignals(True)
+        self.ui.box3.inpStep.setValue(p.get('step', 0.))
+        self.ui.box3.inpStep.blockSignals(False)
+        self._restore({
+            'file1': sess.curves.get('file1', empty),
+            'file2': sess.curves.get('file2', empty),
+            'result': (plant, statst, lodt, cat, p.get('replace', False)),
+            'params': tuple((p.get('avg' + i, 1), p.get('scale' + i, 1.), p.get('yshift' + i, 0.))
+                            for i in ('1', '2')),
+        })
+        self._record('Open Session')
+
+    def concat_or_replace(self, replace=False, preview=False, amend=False):
+        """ Concatenate from scratch. With amend, the result is merged into
+        the current undo step, unless another step was recorded meanwhile """
+        self._replace = replace
+        self._plan_pending = True
+        if preview:
+            label = 'Preview'
         else:
-            x_right = x2[x2 >= xo_max]
-            y_right = y2[x2 >= xo_max]
-        # 3. concatenate middle part
-        # if replace=True, replace the middle part
-        if replace:
-            x_cat = x2_to_cat
-            y_cat = y2_to_cat
+            label = 'Replace' if replace else 'Concatenate'
+        step = self._steps if amend else None
+        self.worker.submit(
+            'concat', concat_task,
+            self.x1, self.y1, self.x2, self.y2,
+            avg1=self.ui.box1.inpAvg.value(),
+            avg2=self.ui.box2.inpAvg.value(),
+            scale1=self.ui.box1.inpScale.value(),
+            scale2=self.ui.box2.inpScale.value(),
+            yshift1=self.ui.box1.inpYShift.value(),
+            yshift2=self.ui.box2.inpYShift.value(),
+            replace=replace,
+            grid=self.ui.box3.get_grid(),
+            step=self.ui.box3.inpStep.value(),
+            # same median as the preview
+            ym1=self.stats1[2] if self.stats1 else None,
+            ym2=self.stats2[2] if self.stats2 else None,
+            on_done=lambda result: self._concat_ready(result, label=label, step=step),
+            on_error=self._preview_failed if preview else self._concat_failed)
+
+    def auto_match(self):
+        """ Fit the scale and shift of file 2 to file 1 on their overlap """
+        if self.lod1 is None or self.lod2 is None:
+            msg('Error', 'Both data need to be loaded')
+            return None
+        self.worker.submit('match', engine.match_scale,
+                           self.x1, self.y1, self.x2, self.y2,
+                           scale1=self.ui.box1.inpScale.value(),
+                           yshift1=self.ui.box1.inpYShift.value(),
+                           ym1=self.stats1[2], ym2=self.stats2[2],
+                           on_done=self._match_ready,
+                           on_error=lambda err: msg('Error', err))
+
+    def _match_ready(self, result):
+        scale, yshift = result
+        if not scale > 0:
+            msg('Error', 'File 2 does not match file 1 with a positive scale')
+            return None
+        # the redraw and the live preview are coalesced by their timers
+        self.ui.box2.inpScale.setValue(scale)
+        self.ui.box2.inpYShift.setValue(yshift)
+
+    def _concat_failed(self, err):
+        self._plan_pending = False
+        msg('Error', err)
+
+    def _preview_failed(self, err):
+        self._plan_pending = False
+        self.statusBar().showMessage('Preview: ' + err, 5000)
+
+    def _preview_changed(self):
+        if self.ui.box3.ckPreview.isChecked():
+            self._timerPreview.start()
+
+    def _replan_preview(self, *_, amend=False):
+        """ Concatenate again from scratch, e.g. for new data or grid.
+        With amend, the preview belongs to the last undo step """
+        if self.ui.box3.ckPreview.isChecked() and len(self.x1) and len(self.x2):
+            self.concat_or_replace(self._replace, preview=True, amend=amend)
+
+    def update_preview(self):
+        """ Redo the overlap of the current concatenation with the current
+        averages, scales and shifts """
+        if not self.ui.box3.ckPreview.isChecked():
+            return None
+        if self._plan_pending:
+            # update once the running concatenation is done
+            self._preview_dirty = True
+        elif self.plant.recipe is not None:
+            self.worker.submit(
+                'concat', preview_task, self.plant, self.lodt,
+                avg1=self.ui.box1.inpAvg.value(),
+                avg2=self.ui.box2.inpAvg.value(),
+                scale1=self.ui.box1.inpScale.value(),
+                scale2=self.ui.box2.inpScale.value(),
+                yshift1=self.ui.box1.inpYShift.value(),
+                yshift2=self.ui.box2.inpYShift.value(),
+                on_done=lambda result: self._concat_ready(result, True, 'Preview'),
+                on_error=self._preview_failed)
+
+    @traced
+    def _concat_ready(self, result, keep_range=False, label='Concatenate', step=None):
+        self._plan_pending = False
+        (self.plant, self.statst, self.lodt), self.catt = result
+        self._plot_result()
+        if not keep_range:
+            self.ui.canvasCC.set_xrange(*self.plant.xrange())
+        if step is not None and step == self._steps:
+            # automatic follow-up of the operation of the current step
+            self.history.amend(self._snapshot())
+            self._update_undo_actions()
+        else:
+            # a burst of preview updates is a single undo step
+            self._record(label, merge=label == 'Preview')
+        if self._preview_dirty:
+            self._preview_dirty = False
+            self.update_preview()
+
+    def _plot_result(self):
+        if self.lodt is None:
+            self.ui.store.clear('result')
         else:
-            if x1_to_cat.shape != x2_to_cat.shape:
-                msg('Error', 'The two data have different dimensions')
-                return None
-            else:
-                x_cat = x1_to_cat
-                y_cat = (y1_to_cat * avg1 + y2_to_cat * avg2) / (avg1 + avg2)
-        # put everything together
-        self.xt = np.concatenate((x_left, x_cat, x_right))
-        self.yt = np.concatenate((y_left, y_cat, y_right))
-        # plot
-        self.ui.canvasCC.plot1(self.xt, self.yt)
-        if np.any(x1_to_cat):
-            self.ui.canvasCC.plot2(x1_to_cat, y_cat)
+            self.ui.store.set_data('result', None, None, self.statst, lod=self.lodt)
+        if self.catt:
+            x_cat, y_cat, stats_cat, lod_cat = self.catt
+            self.ui.store.set_data('overlap', x_cat, y_cat, stats_cat, lod=lod_cat)
         else:
-            self.ui.canvasCC.curve2.clear()
-        self.ui.canvasCC.set_xrange(self.xt.min(), self.xt.max())
+            self.ui.store.clear('overlap')
+
+    def stitch_files(self):
+        """ Stitch many files at once, with equal weights """
+        filenames, _ = QtWidgets.QFileDialog.getOpenFileNames(
+            self, 'Stitch Files', self.prefs.spec_dir, 'Spectral File (*.*)')
+        if not filenames:
+            return None
+        self.prefs.spec_dir, _ = split_filename_dir(filenames[0])
+        # the files are parsed in parallel, off the GUI thread
+        self.worker.submit('concat', stitch_files_task, self.cache, filenames,
+                           self.prefs.load_workers or None,
+                           on_done=self._stitch_ready,
+                           on_error=lambda err: msg('Error', err))
 
+    def _stitch_ready(self, result):
+        result, errors = result
+        self._concat_ready(result, label='Stitch')
+        if errors:
+            msg('Warning', 'Stitched without:\n' + '\n'.join(
+                '{:s}: {:s}'.format(f, err) for f, err in errors), 'warning')
+
+    @traced
     def override(self):
-        self.x1 = self.xt
-        self.y1 = self.yt
-        self.ui.canvasFull.curve1.setData(self.x1, self.y1)
-        self.ui.canvasDetail.curve1.setData(self.x1, self.y1)
-        self._adjust_range()
+        if self.worker.is_busy('concat'):
+            msg('Error', 'Concatenation is still running')
+            return None
+        # the result becomes a contiguous array only now
+        self.ui.box1.set_loading('Concatenated')
+        self.worker.submit('file1', materialize_task, self.plant,
+                           self.prefs.is_approx_median,
+                           on_done=lambda result: self._file1_loaded(result, 'Result to File 1'),
+                           on_error=self._file1_failed)
 
     def clear_concat(self):
-        self.xt = np.zeros(0)
-        self.yt = np.zeros(0)
-        self.ui.canvasCC.plot1(np.zeros(0), np.zeros(0))
-        self.ui.canvasCC.plot2(np.zeros(0), np.zeros(0))
+        self.worker.cancel('concat')
+        self._plan_pending = False
+        self.plant = engine.ConcatPlan()
+        self.statst = None
+        self.lodt = None
+        self.catt = None
+        self._plot_result()
+        self._adjust_range()
+        self._record('Clear Result')
+
+    def _snapshot(self):
+        """ Workspace state. Holds references only: the arrays are never
+        modified in place, so the states share the ones that did not change """
+        params = tuple((box.inpAvg.value(), box.inpScale.value(), box.inpYShift.value())
+                       for box in (self.ui.box1, self.ui.box2))
+        return {
+            'file1': (self.x1, self.y1, self.stats1, self.lod1),
+            'file2': (self.x2, self.y2, self.stats2, self.lod2),
+            'result': (self.plant, self.statst, self.lodt, self.catt, self._replace),
+            'params': params,
+        }
+
+    def _record(self, label, merge=False):
+        self._steps += 1
+        self.history.push(self._snapshot(), label, merge)
+        self._update_undo_actions()
+
+    def _restore(self, state):
+        # drop the running tasks, their results belong to another state
+        for channel in ('file1', 'file2', 'concat', 'session'):
+            self.worker.cancel(channel)
+        self.ui.box1.set_loading('')
+        self.ui.box2.set_loading('')
+        self._plan_pending = False
+        self._preview_dirty = False
+        self._steps += 1
+        self.x1, self.y1, self.stats1, self.lod1 = state['file1']
+        self.x2, self.y2, self.stats2, self.lod2 = state['file2']
+        self.plant, self.statst, self.lodt, self.catt, self._replace = state['result']
+        for box, (avg, scale, yshift) in zip((self.ui.box1, self.ui.box2), state['params']):
+            # no redraw nor preview per value, everything is redrawn below
+            for inp, value in ((box.inpAvg, avg), (box.inpScale, scale),
+                               (box.inpYShift, yshift)):
+                inp.blockSignals(True)
+                inp.setValue(value)
+                inp.blockSignals(False)
+        if self.lod1 is None:
+            self.ui.store.clear('file1')
+        if self.lod2 is None:
+            self.ui.store.clear('file2')
+        self.transform_y1()
+        self.transform_y2()
+        self._plot_result()
         self._adjust_range()
+        if len(self.plant):
+            self.ui.canvasCC.set_xrange(*self.plant.xrange())
+        self._update_undo_actions()
+
+    @traced
+    def undo(self):
+        state = self.history.undo()
+        if state is not None:
+            self._restore(state)
+
+    @traced
+    def redo(self):
+        state = self.history.redo()
+        if state is not None:
+            self._restore(state)
+
+    def _update_undo_actions(self):
+        undo = self.history.undo_label()
+        redo = self.history.redo_label()
+        self.menuBar.actionUndo.setEnabled(self.history.can_undo())
+        self.menuBar.actionUndo.setText('Undo ' + undo if undo else 'Undo')
+        self.menuBar.actionRedo.setEnabled(self.history.can_redo())
+        self.menuBar.actionRedo.setText('Redo ' + redo if redo else 'Redo')
+
+
+@traced
+def load_task(cache, filename, approx_median=False, progress=None):
+    """ Load a file and prepare it for rendering. Runs in the worker thread """
+    data = cache.load(filename, progress=progress)
+    x = data[:, 0]
+    y = data[:, 1]
+    return (x, y) + prepare_curve(x, y, approx_median)
+
+
+@traced
+def prepare_curve(x, y, approx_median=False):
+    """ Render-ready statistics and level-of-detail pyramid of a curve.
+    Runs in the worker thread """
+    # avoid a full copy of memory mapped data for the median
+    if approx_median or isinstance(y, np.memmap):
+        max_exact = MAX_EXACT_MEDIAN
+    else:
+        max_exact = None
+    lod = MinMaxPyramid(x, y)
+    # min and max from the pyramid, instead of scanning y again
+    return engine.y_stats(y, max_exact, lod.limits()), lod
+
+
+@traced
+def concat_task(x1, y1, x2, y2, **kwargs):
+    """ Concatenate in the worker thread. Returns the render-ready
+    result and overlap curves """
+    return prepare_plan(engine.plan_concat(x1, y1, x2, y2, **kwargs))
+
+
+@traced
+def stitch_task(segments):
+    """ Stitch in the worker thread, see concat_task """
+    return prepare_plan(engine.plan_stitch(segments))
+
+
+@traced
+def stitch_files_task(cache, filenames, workers=None):
+    """ Load files in a pool of processes and stitch those that loaded.
+    Runs in the worker thread. Returns the result of stitch_task and the
+    (file name, error message) of the failed files """
+    datas, errors = cache.load_many(filenames, workers)
+    segments = [(data[:, 0], data[:, 1]) for data in datas if data is not None]
+    if not segments:
+        raise ValueError('\n'.join(err for _, err in errors))
+    return stitch_task(segments), errors
+
+
+@traced
+def preview_task(plan, lod, **kwargs):
+    """ Redo the overlap of a concatenation with new parameters in the
+    worker thread. The pyramids of the unchanged segments are reused """
+    return prepare_plan(plan.with_params(**kwargs), lod, PREVIEW_MEDIAN)
+
+
+def prepare_plan(plan, reuse=None, max_exact=MAX_EXACT_MEDIAN):
+    """ Render-ready statistics and level-of-detail pyramids of a virtual
+    result, and of its overlap curve. Runs in the worker thread """
+    lod = SegmentedPyramid(plan.segments, reuse)
+    if len(plan.x_cat):
+        # the overlap curve is usually a segment of the result
+        lod_cat = next((part for part, a, b in lod.parts if part.x is plan.x_cat
+                        and part.y is plan.y_cat and a == 1 and b == 0), None)
+        if lod_cat is None:
+            lod_cat = MinMaxPyramid(plan.x_cat, plan.y_cat)
+        cat = (plan.x_cat, plan.y_cat, engine.y_stats(plan.y_cat, max_exact), lod_cat)
+    else:
+        cat = None
+    return (plan, plan.stats(max_exact, lod.limits()), lod), cat
+
+
+@traced
+def materialize_task(plan, approx_median=False):
+    """ Make a virtual result contiguous, to be used as a loaded file.
+    Runs in the worker thread """
+    x, y = plan.materialize()
+    return (x, y) + prepare_curve(x, y, approx_median)
@@ -0,0 +1,122 @@
+#! encoding = utf-8
+
+""" Background worker for the NumPy side of the GUI.
+
+Jobs are run on a thread pool, and their results are delivered back to
+the GUI thread. Jobs are submitted on named channels: a new submission
+supersedes whatever is still in flight on the same channel, and the
+stale result is dropped when it arrives. Jobs that report progress are
+also asked to stop as soon as they are superseded or cancelled.
+"""
+
+from PyQt5 import QtCore
+
+
+class _TaskSignals(QtCore.QObject):
+
+    done = QtCore.pyqtSignal(str, int, object)
+    failed = QtCore.pyqtSignal(str, int, str)
+    progress = QtCore.pyqtSignal(str, int, float, float)
+
+
+class _Task(QtCore.QRunnable):
+
+    def __init__(self, channel, gen, fn, args, kwargs, is_current=None):
+        super().__init__()
+        self.signals = _TaskSignals()
+        self._channel = channel
+        self._gen = gen
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+        if is_current:
+            self._is_current = is_current
+            self._kwargs['progress'] = self._progress
+
+    def _progress(self, done, total):
+        """ Report progress, return False if the job is no longer wanted """
+        self.signals.progress.emit(self._channel, self._gen, done, total)
+        return self._is_current(self._channel, self._gen)
+
+    def run(self):
+        try:
+            result = self._fn(*self._args, **self._kwargs)
+        except Exception as e:
+            self.signals.failed.emit(self._channel, self._gen, str(e))
+        else:
+            self.signals.done.emit(self._channel, self._gen, result)
+
+
+class Worker(QtCore.QObject):
+    """ Run jobs off the GUI thread, keeping only the latest job per channel """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._pool = QtCore.QThreadPool(self)
+        self._gen = {}          # latest generation number of each channel
+        self._callbacks = {}    # (on_done, on_error, on_progress) of the latest job of each channel
+
+    def submit(self, channel, fn, *args, on_done=None, on_error=None,
+               on_progress=None, **kwargs):
+        """ Run fn(*args, **kwargs) in the pool
+
+        Arguments:
+            channel: str            jobs on the same channel supersede each other
+            fn: callable            job, must not touch any Qt widget
+            on_done: callable       called in the GUI thread with the result
+            on_error: callable      called in the GUI thread with the error message
+            on_progress: callable   called in the GUI thread with (done, total).
+                                    If given, fn also gets a progress(done, total)
+                                    keyword argument, which returns False once
+                                    the job is superseded or cancelled
+        """
+        gen = self._gen.get(channel, 0) + 1
+        self._gen[channel] = gen
+        self._callbacks[channel] = (on_done, on_error, on_progress)
+        task = _Task(channel, gen, fn, args, kwargs,
+                     is_current=self._is_current if on_progress else None)
+        task.signals.done.connect(self._on_done)
+        task.signals.failed.connect(self._on_failed)
+        task.signals.progress.connect(self._on_progress)
+        self._pool.start(task)
+
+    def _is_current(self, channel, gen):
+        # called from the pool threads, only reads the dictionary
+        return self._gen.get(channel) == gen
+
+    def cancel(self, channel):
+        """ Drop the result of the job in flight on channel """
+        self._gen[channel] = self._gen.get(channel, 0) + 1
+        self._callbacks.pop(channel, None)
+
+    def is_busy(self, channel):
+        return channel in self._callbacks
+
+    def shutdown(self):
+        """ Drop queued jobs, stop the cancellable ones and wait for the rest """
+        for channel in self._gen:
+            self._gen[channel] += 1
+        self._pool.clear()
+        self._callbacks.clear()
+        self._pool.waitForDone()
+
+    @QtCore.pyqtSlot(str, int, object)
+    def _on_done(self, channel, gen, result):
+        if gen == self._gen.get(channel):
+            on_done, _, _ = self._callbacks.pop(channel)
+            if on_done:
+                on_done(result)
+
+    @QtCore.pyqtSlot(str, int, str)
+    def _on_failed(self, channel, gen, err):
+        if gen == self._gen.get(channel):
+            _, on_error, _ = self._callbacks.pop(channel)
+            if on_error:
+                on_error(err)
+
+    @QtCore.pyqtSlot(str, int, float, float)
+    def _on_progress(self, channel, gen, done, total):
+        if gen == self._gen.get(channel):
+            _, _, on_progress = self._callbacks[channel]
+            if on_progress:
+                on_progress(done, total)
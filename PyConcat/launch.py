@@ -1,13 +1,23 @@
 #! encoding = utf-8
 
-""" Launch PyConcat GUI """
+""" Launch PyConcat GUI
+
+Start with --startup-report (or set PYCC_STARTUP_REPORT=1) to print the
+time spent in each startup phase, and add --quit to exit right after the
+window is shown, e.g. to time the cold start from a script.
+"""
+
+import time
+_T0 = time.perf_counter()
 
 import sys
+import os
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtGui import QFont
+from PyQt5.QtCore import QTimer
 import platform
-import ctypes
 from PyConcat.ctrl.ctrl_main import PyCCMainWin
+_T_IMPORT = time.perf_counter()
 
 
 def launch():
@@ -15,17 +25,60 @@ def launch():
     # fix the bug of bad scaling on screens of different DPI
     if platform.system() == 'Windows':
         if int(platform.release()) >= 8:
+            import ctypes
             ctypes.windll.shcore.SetProcessDpiAwareness(True)
 
+    is_report = '--startup-report' in sys.argv or bool(os.environ.get('PYCC_STARTUP_REPORT'))
+    is_quit = '--quit' in sys.argv
+    phases = [('imports', _T_IMPORT - _T0)]
+    t = time.perf_counter()
+
     app = QApplication(sys.argv)
     app.setFont(QFont('Microsoft YaHei UI', 12))
+    t = _add_phase(phases, 'application', t)
 
     window = PyCCMainWin(len(app.screens()))
+    t = _add_phase(phases, 'main window', t)
     window.show()
+    t = _add_phase(phases, 'show', t)
+
+    def _started():
+        _add_phase(phases, 'first event', t)
+        total = sum(dt for _, dt in phases)
+        window.statusBar().showMessage('Started in {:.2f} s'.format(total), 5000)
+        if is_report:
+            print(startup_report(phases), file=sys.stderr)
+        if is_quit:
+            # leave without the close event, which would save the preferences
+            app.quit()
+
+    # runs once the event loop has processed the first show events
+    QTimer.singleShot(0, _started)
 
     sys.exit(app.exec_())
 
 
+def _add_phase(phases, name, t0):
+    t = time.perf_counter()
+    phases.append((name, t - t0))
+    return t
+
+
+def startup_report(phases):
+    """ Format the startup phases
+
+    Arguments:
+        phases: list of (str, float)    phase name and duration in seconds
+    Returns:
+        text: str
+    """
+    lines = ['Startup time']
+    for name, dt in phases:
+        lines.append('  {:<14s} {:8.1f} ms'.format(name, dt * 1e3))
+    lines.append('  {:<14s} {:8.1f} ms'.format('total', sum(dt for _, dt in phases) * 1e3))
+    return '\n'.join(lines)
+
+
 if __name__ == '__main__':
 
     launch()
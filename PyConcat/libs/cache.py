@@ -0,0 +1,285 @@
+#! encoding = utf-8
+
+""" Persistent on-disk cache of parsed spectra
+
+Parsed and sorted arrays are saved as binary .npy files, listed in a
+json index. An entry is keyed by the absolute path, size and mtime of the
+source file, so any change of the source invalidates it. A cache hit is
+a read-only memory map instead of a full text parse. Binary .npy and .npz
+files are memory mapped directly and never copied into the cache. When
+many files are loaded at once, the .npy files written by the parsing
+processes are moved into the cache as they are, without another copy.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import numpy as np
+from PyConcat.libs.lib import LoadCancelled, load_xy_file, load_xy_files, map_npy_temp, \
+    parse_xy_files
+
+_INDEX_NAME = 'index.json'
+
+
+def default_cache_dir():
+    """ Return the per-user cache directory of PyConcat """
+    if sys.platform.startswith('win'):
+        root = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    elif sys.platform == 'darwin':
+        root = os.path.expanduser('~/Library/Caches')
+    else:
+        root = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(root, 'PyConcat')
+
+
+class SpectrumCache:
+    """ LRU cache of parsed spectra, bounded by a byte budget
+
+    Arguments:
+        cache_dir: str          cache directory. Use the default if empty
+        max_bytes: int          byte budget. 0 disables the cache
+    """
+
+    def __init__(self, cache_dir='', max_bytes=512 * 1024 ** 2):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self._index = None
+        # access times updated by hits but not saved yet
+        self._dirty = False
+        # the cache can be used from several loading threads
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def load(self, file_name, progress=None):
+        """ Load a spectrum through the cache. Same result as load_xy_file
+
+        Arguments:
+            file_name: str          input file name
+            progress: callable      see load_xy_file
+        Returns:
+            data: np.array          sorted data array
+        """
+
+        if file_name.endswith(('.npy', '.npz')):
+            return load_xy_file(file_name, progress=progress, mmap=True)
+        if not self.enabled:
+            return load_xy_file(file_name, progress=progress)
+        try:
+            key = self._key(file_name)
+        except OSError:
+            # let load_xy_file raise the proper error message
+            return load_xy_file(file_name, progress=progress)
+        data = self._lookup(key)
+        if data is not None:
+            return data
+        data = load_xy_file(file_name, progress=progress)
+        with self._lock:
+            self._store(key, data)
+        return data
+
+    def load_many(self, file_names, workers=None, progress=None):
+        """ Load many spectra through the cache, parsing the missing text
+        files in a pool of processes. Same result as load_xy_files
+
+        Arguments:
+            file_names: list of str     input file names
+            workers: int                number of processes, default: all cores
+            progress: callable          see load_xy_files
+        Returns:
+            datas: list of np.array     sorted data of each file, in input
+                                        order, None for the failed files
+            errors: list of (str, str)  failed files and their error messages
+        """
+
+        if not self.enabled:
+            return load_xy_files(file_names, workers, progress)
+        datas = [None] * len(file_names)
+        errors = {}
+        misses = []
+        keys = []
+        for i, f in enumerate(file_names):
+            try:
+                if f.endswith(('.npy', '.npz')):
+                    datas[i] = load_xy_file(f, mmap=True)
+                    continue
+                key = self._key(f)
+            except ValueError as e:
+                errors[i] = str(e)
+                continue
+            except OSError:
+                key = None
+            datas[i] = self._lookup(key) if key else None
+            if datas[i] is None:
+                misses.append(i)
+                keys.append(key)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        done = len(file_names) - len(misses)
+        if min(workers, len(misses)) > 1:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            paths = [os.path.join(self.cache_dir, '{:d}-{:d}.npy.tmp'.format(os.getpid(), i))
+                     for i in misses]
+            try:
+                results = parse_xy_files(
+                    [file_names[i] for i in misses], paths, min(workers, len(misses)),
+                    progress and (lambda n, _: progress(done + n, len(file_names))))
+                for i, key, path, err in zip(misses, keys, paths, results):
+                    if err is not None:
+                        errors[i] = err
+                    else:
+                        datas[i] = self._adopt(key, path)
+            finally:
+                for path in paths:
+                    if os.path.isfile(path):
+                        os.remove(path)
+        else:
+            for i in misses:
+                try:
+                    datas[i] = self.load(file_names[i])
+                except ValueError as e:
+                    errors[i] = str(e)
+                done += 1
+                if progress and progress(done, len(file_names)) is False:
+                    raise LoadCancelled(file_names[i])
+        return datas, [(file_names[i], errors[i]) for i in sorted(errors)]
+
+    def set_max_bytes(self, max_bytes):
+        """ Change the byte budget, evicting entries that no longer fit """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict(max(max_bytes, 0))
+            self._save_index()
+
+    def close(self):
+        """ Save the access times of the hits since the index was last saved """
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    def clear(self):
+        """ Remove every cached spectrum """
+        with self._lock:
+            index = self._load_index()
+            for key in list(index):
+                self._remove(key)
+            self._save_index()
+
+    def _key(self, file_name):
+        path = os.path.abspath(file_name)
+        st = os.stat(path)
+        return '{:s}|{:d}|{:d}'.format(path, st.st_size, st.st_mtime_ns)
+
+    def _lookup(self, key):
+        """ Memory map the entry of key. Returns None on a miss. The new
+        access time is saved with the next change of the index, or by close """
+        with self._lock:
+            index = self._load_index()
+            entry = index.get(key)
+            if entry:
+                try:
+                    data = np.load(os.path.join(self.cache_dir, entry['file']),
+                                   mmap_mode='r', allow_pickle=False)
+                    entry['atime'] = time.time()
+                    self._dirty = True
+                    return data
+                except (OSError, ValueError):
+                    # corrupted or deleted entry, parse again
+                    self._remove(key)
+                    self._save_index()
+        return None
+
+    def _adopt(self, key, path):
+        """ Move a parsed .npy file into the cache, see _store. Returns
+        its memory map """
+        # the .npy header is small, count it in
+        nbytes = os.path.getsize(path)
+        if key is None or nbytes > self.max_bytes:
+            return map_npy_temp(path)
+        with self._lock:
+            index = self._load_index()
+            self._make_room(key, nbytes)
+            name = self._file_name(key)
+            try:
+                os.replace(path, os.path.join(self.cache_dir, name))
+            except OSError:
+                return map_npy_temp(path)
+            index[key] = {'file': name, 'nbytes': nbytes, 'atime': time.time()}
+            self._save_index()
+        return np.load(os.path.join(self.cache_dir, name), mmap_mode='r', allow_pickle=False)
+
+    def _store(self, key, data):
+        nbytes = data.nbytes
+        if nbytes > self.max_bytes:
+            return
+        index = self._load_index()
+        self._make_room(key, nbytes)
+        name = self._file_name(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = os.path.join(self.cache_dir, name + '.tmp')
+            with open(tmp, 'wb') as f:
+                # column major, so that x and y are contiguous when mapped
+                np.save(f, np.asfortranarray(data), allow_pickle=False)
+            os.replace(tmp, os.path.join(self.cache_dir, name))
+        except OSError:
+            # the cache is only an accelerator, never fail the load
+            return
+        index[key] = {'file': name, 'nbytes': nbytes, 'atime': time.time()}
+        self._save_index()
+
+    def _make_room(self, key, nbytes):
+        """ Drop older versions of the same source file, and evict entries
+        to fit nbytes more """
+        index = self._load_index()
+        path = key.rsplit('|', 2)[0]
+        for k in [k for k in index if k.rsplit('|', 2)[0] == path]:
+            self._remove(k)
+        self._evict(self.max_bytes - nbytes)
+
+    @staticmethod
+    def _file_name(key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy'
+
+    def _evict(self, budget):
+        """ Remove least recently used entries until they fit in budget """
+        index = self._load_index()
+        total = sum(entry['nbytes'] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]['atime']):
+            if total <= budget:
+                break
+            total -= index[key]['nbytes']
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._index.pop(key)
+        try:
+            os.remove(os.path.join(self.cache_dir, entry['file']))
+        except OSError:
+            # already gone, or still memory mapped on Windows
+            pass
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(os.path.join(self.cache_dir, _INDEX_NAME), 'r') as fp:
+                    self._index = json.load(fp)
+            except (OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        f = os.path.join(self.cache_dir, _INDEX_NAME)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(f + '.tmp', 'w') as fp:
+                json.dump(self._index, fp)
+            os.replace(f + '.tmp', f)
+            self._dirty = False
+        except OSError:
+            pass
@@ -0,0 +1,560 @@
+#! encoding = utf-8
+
+""" Headless concatenation engine.
+
+All spectral arithmetic used by the GUI lives here so that it can be run
+without a display, e.g. from the batch command line tool.
+"""
+
+from collections import namedtuple
+import numpy as np
+from PyConcat.libs.trace import traced
+
+# grid of the overlap region when averaging
+GRID_EXACT = 'exact'    # both spectra must share the same points
+GRID_FILE1 = 'file1'    # resample file 2 on the points of file 1
+GRID_FILE2 = 'file2'    # resample file 1 on the points of file 2
+GRID_STEP = 'step'      # resample both on a uniform grid of a given step
+GRID_TYPES = (GRID_EXACT, GRID_FILE1, GRID_FILE2, GRID_STEP)
+# points of an overlap used to fit scales and shifts, evenly strided above
+MATCH_POINTS = 1 << 16
+# number of blocks of the sampled median of memory mapped data
+_MEDIAN_BLOCKS = 256
+
+
+@traced
+def transform_y(y, scale=1., yshift=0., ym=None):
+    """ Scale y around its median and shift it
+
+    Arguments:
+        y: np.array             y data
+        scale: float            scaling factor around the median
+        yshift: float           constant shift added after scaling
+        ym: float               median of y. Computed if not given
+    Returns:
+        y_tr: np.array          transformed y data
+    """
+
+    if not len(y):
+        return np.zeros(0)
+    if ym is None:
+        ym = np.median(y)
+    return (y - ym) * scale + ym + yshift
+
+
+@traced
+def y_stats(y, max_exact=None, limits=None):
+    """ Statistics of y needed for display and transforms
+
+    Arguments:
+        y: np.array             y data
+        max_exact: int          above this size, the median is taken from a
+                                sample of about max_exact points, see y_median.
+                                This avoids a full size copy, e.g. of memory
+                                mapped data
+        limits: tuple           (min, max) of y if already known, e.g. from
+                                MinMaxPyramid.limits, to avoid scanning y
+    Returns:
+        stats: tuple            (min, max, median) of y, None if y is empty
+    """
+
+    if not len(y):
+        return None
+    ymin, ymax = limits if limits is not None else (y.min(), y.max())
+    return ymin, ymax, y_median(y, max_exact)
+
+
+def y_median(y, max_exact=None):
+    """ Median of y, approximate above max_exact points, see y_stats.
+    The sample is evenly strided, or made of contiguous blocks spread over
+    memory mapped data, so that only the pages of the sample are read """
+    if not max_exact or len(y) <= max_exact:
+        return np.median(y)
+    if isinstance(y, np.memmap):
+        nblocks = min(_MEDIAN_BLOCKS, max_exact)
+        size = max_exact // nblocks
+        starts = np.linspace(0, len(y) - size, nblocks).astype(np.intp)
+        return np.median(np.concatenate([y[i:i + size] for i in starts]))
+    return np.median(y[::-(-len(y) // max_exact)])
+
+
+def affine_coef(scale, yshift, ym):
+    """ Coefficients (a, b) such that transform_y(y) = a * y + b """
+    return scale, (1 - scale) * ym + yshift
+
+
+def affine_stats(stats, a, b):
+    """ Statistics of a * y + b derived from the statistics of y,
+    without scanning the data again """
+    ymin, ymax, ymedian = stats
+    lo = a * ymin + b
+    hi = a * ymax + b
+    return min(lo, hi), max(lo, hi), a * ymedian + b
+
+
+def find_overlap_range(x1min, x1max, x2min, x2max):
+    """ Find the overlap range of two x ranges """
+    _l = [x1min, x1max, x2min, x2max]
+    _l.sort()
+    return _l[1], _l[2]
+
+
+@traced
+def resample(x_new, x, y):
+    """ Linear interpolation of sorted (x, y) on the points x_new.
+    The neighbours of every point are found by a vectorized searchsorted,
+    points outside of x are extrapolated from the end segments.
+
+    Arguments:
+        x_new: np.array         points to interpolate on, in any order
+        x: np.array             x data, in ascending or descending order
+        y: np.array             y data
+    Returns:
+        y_new: np.array         interpolated y on x_new
+    """
+
+    if not len(x):
+        raise ValueError('No data to interpolate')
+    elif len(x) == 1:
+        return np.full(len(x_new), y[0], dtype=np.result_type(y, float))
+    if x[-1] < x[0]:
+        # a descending sweep, reversed as views
+        x = x[::-1]
+        y = y[::-1]
+    i = np.searchsorted(x, x_new, side='right')
+    np.clip(i, 1, len(x) - 1, out=i)
+    x_lo = x[i - 1]
+    y_lo = y[i - 1]
+    dx = x[i] - x_lo
+    # duplicated x points take the left value
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(dx != 0, (x_new - x_lo) / dx, 0.)
+    return y_lo + w * (y[i] - y_lo)
+
+
+def uniform_grid(xmin, xmax, step):
+    """ Uniform grid of step strictly inside (xmin, xmax) """
+    if not step > 0:
+        raise ValueError('The grid step must be positive')
+    x = xmin + step * np.arange(1, int(np.ceil((xmax - xmin) / step)) + 1)
+    return x[x < xmax]
+
+
+def apply_affine(y, a, b):
+    """ a * y + b, or y itself if the transform is the identity """
+    if a == 1 and b == 0:
+        return y
+    return y * a + b
+
+
+# what a two-spectra concatenation keeps to be redone with new parameters:
+# left and right parts as (x, y, 1 or 2 for the source spectrum), the overlap
+# grid and the untransformed y of both spectra on it, and the medians
+_ConcatRecipe = namedtuple('_ConcatRecipe',
+                           'left right x_cat y1_cat y2_cat ym1 ym2 replace')
+
+
+class ConcatPlan:
+    """ Virtual result of a concatenation or a stitch.
+
+    The result is a list of sorted, non overlapping segments (x, y, a, b),
+    each standing for a * y + b over x. The parts covered by a single
+    spectrum are views of the input data, so that only the averaged
+    overlaps take new memory until a contiguous array is actually needed.
+
+    Arguments:
+        segments: list          (x, y, a, b) of each segment, in x order
+        x_cat, y_cat: np.array  overlap region, shown on its own
+        recipe: _ConcatRecipe   inputs of a two-spectra concatenation,
+                                to redo it with new parameters
+    """
+
+    def __init__(self, segments=(), x_cat=None, y_cat=None, recipe=None):
+        self.segments = [seg for seg in segments if len(seg[0])]
+        self.x_cat = np.zeros(0) if x_cat is None else x_cat
+        self.y_cat = np.zeros(0) if y_cat is None else y_cat
+        self.recipe = recipe
+
+    def __len__(self):
+        return sum(len(seg[0]) for seg in self.segments)
+
+    def xrange(self):
+        """ First and last x of the result """
+        return self.segments[0][0][0], self.segments[-1][0][-1]
+
+    @traced('ConcatPlan.materialize')
+    def materialize(self):
+        """ Contiguous copy of the result
+
+        Returns:
+            xt: np.array        concatenated x
+            yt: np.array        concatenated y
+        """
+        n = len(self)
+        xt = np.empty(n, dtype=np.result_type(*(seg[0] for seg in self.segments), float))
+        yt = np.empty(n)
+        i = 0
+        for x, y, a, b in self.segments:
+            m = len(x)
+            xt[i:i + m] = x
+            np.multiply(y, a, out=yt[i:i + m])
+            yt[i:i + m] += b
+            i += m
+        return xt, yt
+
+    @traced('ConcatPlan.with_params')
+    def with_params(self, avg1=1, avg2=1, scale1=1., scale2=1., yshift1=0., yshift2=0.):
+        """ The same concatenation with new weights, scales and shifts.
+        Only the overlap is computed again: the other segments share
+        their data with this plan, and only their affine changes.
+
+        Returns:
+            plan: ConcatPlan    the updated plan
+        Raises:
+            ValueError          if this is not a two-spectra concatenation
+        """
+        if self.recipe is None:
+            raise ValueError('Only the concatenation of two spectra can be updated')
+        return _assemble(self.recipe, avg1, avg2, scale1, scale2, yshift1, yshift2)
+
+    def iter_blocks(self, rows=1 << 16):
+        """ Yield (x, y) blocks of at most rows points, without
+        materializing the whole result """
+        for x, y, a, b in self.segments:
+            for i in range(0, len(x), rows):
+                yield x[i:i + rows], apply_affine(y[i:i + rows], a, b)
+
+    @traced('ConcatPlan.stats')
+    def stats(self, max_exact=None, limits=None):
+        """ (min, max, median) of the result, see y_stats.
+
+        Arguments:
+            max_exact: int      see y_stats
+            limits: list        (min, max) of the raw y of each segment,
+                                if already known
+        """
+        if not self.segments:
+            return None
+        if limits is None:
+            limits = [(y.min(), y.max()) for _, y, _, _ in self.segments]
+        lims = [affine_stats((lo, hi, 0.), a, b)
+                for (lo, hi), (_, _, a, b) in zip(limits, self.segments)]
+        n = len(self)
+        step = -(-n // max_exact) if max_exact and n > max_exact else 1
+        ym = np.median(np.concatenate([apply_affine(y[::step], a, b)
+                                       for _, y, a, b in self.segments]))
+        return min(lim[0] for lim in lims), max(lim[1] for lim in lims), ym
+
+
+@traced
+def plan_concat(x1, y1, x2, y2, avg1=1, avg2=1, scale1=1., scale2=1.,
+                yshift1=0., yshift2=0., replace=False, grid=GRID_EXACT, step=0.,
+                ym1=None, ym2=None):
+    """ Plan the concatenation (or replacement) of two sorted spectra.
+    Arguments and errors are the same as concat.
+
+    The left, overlap and right regions are contiguous in sorted data, so
+    their bounds are found by binary search, and they are kept as views.
+    Only the overlap is computed.
+
+    Returns:
+        plan: ConcatPlan        virtual concatenated spectrum
+    """
+
+    if not (len(x1) and len(x2)):
+        raise ValueError('Both data need to be loaded')
+    ym1 = np.median(y1) if ym1 is None else ym1
+    ym2 = np.median(y2) if ym2 is None else ym2
+    # get overlap xrange
+    xo_min, xo_max = find_overlap_range(x1[0], x1[-1], x2[0], x2[-1])
+    # the overlap is strictly inside (xo_min, xo_max)
+    o1 = slice(np.searchsorted(x1, xo_min, side='right'),
+               np.searchsorted(x1, xo_max, side='left'))
+    o2 = slice(np.searchsorted(x2, xo_min, side='right'),
+               np.searchsorted(x2, xo_max, side='left'))
+    # 1. find left part, x <= xo_min
+    if x1[0] < xo_min:
+        i = np.searchsorted(x1, xo_min, side='right')
+        left = (x1[:i], y1[:i], 1)
+    else:
+        i = np.searchsorted(x2, xo_min, side='right')
+        left = (x2[:i], y2[:i], 2)
+    # 2. find right part, x >= xo_max
+    if x1[-1] > xo_max:
+        i = np.searchsorted(x1, xo_max, side='left')
+        right = (x1[i:], y1[i:], 1)
+    else:
+        i = np.searchsorted(x2, xo_max, side='left')
+        right = (x2[i:], y2[i:], 2)
+    # 3. the middle part, on its grid but not yet transformed
+    # if replace=True, replace the middle part
+    x1_to_cat = x1[o1]
+    x2_to_cat = x2[o2]
+    if replace:
+        x_cat = x2_to_cat
+        y1_to_cat = None
+        y2_to_cat = y2[o2]
+    elif grid == GRID_EXACT:
+        if x1_to_cat.shape != x2_to_cat.shape:
+            raise ValueError('The two data have different dimensions')
+        x_cat = x1_to_cat
+        y1_to_cat = y1[o1]
+        y2_to_cat = y2[o2]
+    elif grid == GRID_FILE1:
+        x_cat = x1_to_cat
+        y1_to_cat = y1[o1]
+        y2_to_cat = resample(x_cat, x2, y2)
+    elif grid == GRID_FILE2:
+        x_cat = x2_to_cat
+        y1_to_cat = resample(x_cat, x1, y1)
+        y2_to_cat = y2[o2]
+    elif grid == GRID_STEP:
+        x_cat = uniform_grid(xo_min, xo_max, step)
+        y1_to_cat = resample(x_cat, x1, y1)
+        y2_to_cat = resample(x_cat, x2, y2)
+    else:
+        raise ValueError('Unknown grid type: {:s}'.format(str(grid)))
+    recipe = _ConcatRecipe(left, right, x_cat, y1_to_cat, y2_to_cat, ym1, ym2, replace)
+    return _assemble(recipe, avg1, avg2, scale1, scale2, yshift1, yshift2)
+
+
+def _assemble(recipe, avg1, avg2, scale1, scale2, yshift1, yshift2):
+    """ Build the plan of a recipe. Only the overlap is computed """
+    coef = {1: affine_coef(scale1, yshift1, recipe.ym1),
+            2: affine_coef(scale2, yshift2, recipe.ym2)}
+    left = recipe.left[:2] + coef[recipe.left[2]]
+    right = recipe.right[:2] + coef[recipe.right[2]]
+    a1, b1 = coef[1]
+    a2, b2 = coef[2]
+    x_cat = recipe.x_cat
+    if recipe.replace:
+        y_cat = apply_affine(recipe.y2_cat, a2, b2)
+        middle = (x_cat, recipe.y2_cat, a2, b2)
+    else:
+        # resampling is linear, so it commutes with the affine transforms,
+        # and the weighted average is a single affine combination
+        w1 = avg1 / (avg1 + avg2)
+        w2 = avg2 / (avg1 + avg2)
+        y_cat = np.multiply(recipe.y1_cat, a1 * w1, dtype=float)
+        y_cat += recipe.y2_cat * (a2 * w2)
+        y_cat += b1 * w1 + b2 * w2
+        middle = (x_cat, y_cat, 1., 0.)
+    return ConcatPlan([left, middle, right], x_cat, y_cat, recipe)
+
+
+@traced
+def concat(x1, y1, x2, y2, avg1=1, avg2=1, scale1=1., scale2=1.,
+           yshift1=0., yshift2=0., replace=False, grid=GRID_EXACT, step=0.,
+           ym1=None, ym2=None):
+    """ Concatenate (or replace) two sorted spectra
+
+    Arguments:
+        x1, y1: np.array        spectrum 1
+        x2, y2: np.array        spectrum 2
+        avg1, avg2: int         number of averages, used as weights in the overlap
+        scale1, scale2: float   scaling factor of each spectrum
+        yshift1, yshift2: float y shift of each spectrum
+        replace: bool           replace the overlap of 1 by 2 instead of averaging
+        grid: str               grid of the averaged overlap, one of GRID_TYPES
+        step: float             grid step, for GRID_STEP
+        ym1, ym2: float         medians of y1 and y2, computed if not given
+    Returns:
+        xt: np.array            concatenated x
+        yt: np.array            concatenated y
+        x_cat: np.array         x of the overlap region
+        y_cat: np.array         y of the overlap region
+    Raises:
+        ValueError              if either spectrum is empty, or the overlap
+                                regions have different dimensions on
+                                GRID_EXACT
+    """
+
+    plan = plan_concat(x1, y1, x2, y2, avg1, avg2, scale1, scale2, yshift1, yshift2,
+                       replace, grid, step, ym1, ym2)
+    xt, yt = plan.materialize()
+    return xt, yt, plan.x_cat, plan.y_cat
+
+
+@traced
+def plan_stitch(segments):
+    """ Plan the stitch of any number of sorted spectra in one pass.
+
+    The x axis is cut at every segment start and end, so that each region
+    is covered by a fixed set of segments. A region takes the points of
+    the covering segment that starts first. The other covering segments
+    are resampled on these points and averaged with their average counts
+    as weights. Points on a region boundary belong to the region on their
+    right, unless that region is a gap. Regions covered by a single
+    segment are kept as views, so only the averaged regions take new memory.
+
+    Arguments:
+        segments: iterable      (x, y) or (x, y, avg, scale, yshift) of
+                                each spectrum, in any order
+    Returns:
+        plan: ConcatPlan        virtual stitched spectrum
+    """
+
+    segs = []
+    for seg in segments:
+        x, y, avg, scale, yshift = tuple(seg) + (1, 1., 0.)[len(seg) - 2:]
+        if len(x):
+            segs.append((x, y, avg) + affine_coef(scale, yshift, np.median(y)))
+    if not segs:
+        raise ValueError('No data to stitch')
+    segs.sort(key=lambda seg: (seg[0][0], seg[0][-1]))
+    bounds = np.unique([seg[0][i] for seg in segs for i in (0, -1)])
+    if len(bounds) == 1:
+        regions = [(bounds[0], bounds[0])]
+    else:
+        regions = list(zip(bounds[:-1], bounds[1:]))
+
+    covers = [[j for j, seg in enumerate(segs) if seg[0][0] <= lo and seg[0][-1] >= hi]
+              for lo, hi in regions]
+    # nothing follows the last region
+    covers.append([])
+    plan = []
+    for k, (lo, hi) in enumerate(regions):
+        cover = covers[k]
+        if not cover:   # a gap between segments
+            continue
+        x, y, avg, a, b = segs[cover[0]]
+        i0 = np.searchsorted(x, lo, side='left')
+        # the point on hi belongs to this region if nothing follows
+        i1 = np.searchsorted(x, hi, side='left' if covers[k + 1] else 'right')
+        if i1 <= i0:
+            continue
+        xr = x[i0:i1]
+        if len(cover) == 1:
+            plan.append((xr, y[i0:i1], a, b))
+        else:
+            acc = (y[i0:i1] * a + b) * avg
+            weight = avg
+            for j in cover[1:]:
+                xj, yj, avgj, aj, bj = segs[j]
+                acc += (resample(xr, xj, yj) * aj + bj) * avgj
+                weight += avgj
+            acc /= weight
+            plan.append((xr, acc, 1., 0.))
+    return ConcatPlan(plan)
+
+
+@traced
+def stitch(segments):
+    """ Stitch any number of sorted spectra in one pass, see plan_stitch
+
+    Arguments:
+        segments: iterable      (x, y) or (x, y, avg, scale, yshift) of
+                                each spectrum, in any order
+    Returns:
+        xt: np.array            stitched x
+        yt: np.array            stitched y
+    """
+    return plan_stitch(segments).materialize()
+
+
+@traced
+def match_scale(x1, y1, x2, y2, scale1=1., yshift1=0., ym1=None, ym2=None,
+                max_points=MATCH_POINTS):
+    """ Scale and shift of spectrum 2 that best match spectrum 1 on their
+    overlap, in the least squares sense. See match_segments
+
+    Arguments:
+        x1, y1, x2, y2: np.array    sorted spectra
+        scale1, yshift1: float      transform of spectrum 1, kept fixed
+        ym1, ym2: float             medians of y1 and y2. Computed if not given
+        max_points: int             see match_segments
+    Returns:
+        scale2, yshift2: float      transform of spectrum 2
+    Raises:
+        ValueError                  if the spectra do not overlap, or
+                                    spectrum 2 is flat on the overlap
+    """
+    return match_segments([(x1, y1, 1, scale1, yshift1), (x2, y2)], ref=0,
+                          ym=[ym1, ym2], max_points=max_points)[1]
+
+
+@traced
+def match_segments(segments, ref=0, ym=None, max_points=MATCH_POINTS):
+    """ Scales and shifts of any number of spectra that best match each
+    other on all their overlaps, relative to a reference spectrum.
+
+    Every spectrum j is transformed as a_j * (y_j - ym_j) + c_j. On each
+    overlapping pair, the spectrum that comes second is resampled on the
+    points of the first one, and the squared differences of the transformed
+    spectra are summed over all pairs. Each pair only adds a 4 x 4 block,
+    built from 6 sums, to the normal equations of the (a_j, c_j), so the
+    whole fit is one linear solve of size 2 N, whatever the overlap sizes.
+
+    Arguments:
+        segments: list          (x, y) or (x, y, avg, scale, yshift) of
+                                each spectrum, as in plan_stitch. Only the
+                                scale and shift of the reference are used
+        ref: int                index of the reference spectrum, kept fixed
+        ym: list                median of each y, or None to compute it
+        max_points: int         above this number of points, an overlap is
+                                sampled with an even stride
+    Returns:
+        params: list            (scale, yshift) of each spectrum
+    Raises:
+        ValueError              if a spectrum is not connected to the
+                                reference by overlaps, or is flat on them
+    """
+
+    segs = [tuple(seg) + (1, 1., 0.)[len(seg) - 2:] for seg in segments]
+    n = len(segs)
+    if not 0 <= ref < n:
+        raise ValueError('No reference spectrum to match')
+    ym = [None] * n if ym is None else list(ym)
+    for j, (_, y, _, _, _) in enumerate(segs):
+        if ym[j] is None:
+            ym[j] = np.median(y) if len(y) else 0.
+    normal = np.zeros((2 * n, 2 * n))
+    for i in range(n):
+        for j in range(i + 1, n):
+            first, second = (i, j) if segs[i][0][0] <= segs[j][0][0] else (j, i)
+            block = _overlap_normal(segs[first][:2], segs[second][:2],
+                                    ym[first], ym[second], max_points)
+            if block is not None:
+                idx = [2 * first, 2 * first + 1, 2 * second, 2 * second + 1]
+                normal[np.ix_(idx, idx)] += block
+    # solve for the free (a_j, c_j), the reference is moved to the right side
+    fixed = [2 * ref, 2 * ref + 1]
+    free = [k for k in range(2 * n) if k // 2 != ref]
+    theta = np.empty(2 * n)
+    theta[fixed] = segs[ref][3], ym[ref] + segs[ref][4]
+    try:
+        theta[free] = np.linalg.solve(normal[np.ix_(free, free)],
+                                      -normal[np.ix_(free, fixed)] @ theta[fixed])
+    except np.linalg.LinAlgError:
+        raise ValueError('Cannot match the spectra: each of them must overlap '
+                         'the others and vary on the overlap') from None
+    return [(theta[2 * j], theta[2 * j + 1] - ym[j]) for j in range(n)]
+
+
+def _overlap_normal(seg1, seg2, ym1, ym2, max_points):
+    """ Normal equations block of the residuals a1 * y1' + c1 - a2 * y2' - c2
+    on the overlap of two spectra, y' being y minus its median.
+    None if they do not overlap """
+
+    x1, y1 = seg1
+    x2, y2 = seg2
+    if not (len(x1) and len(x2)):
+        return None
+    lo = max(x1[0], x2[0])
+    hi = min(x1[-1], x2[-1])
+    i0 = np.searchsorted(x1, lo, side='left')
+    i1 = np.searchsorted(x1, hi, side='right')
+    if hi <= lo or i1 - i0 < 2:
+        return None
+    stride = -(-(i1 - i0) // max_points) if max_points else 1
+    xs = x1[i0:i1:stride]
+    u = y1[i0:i1:stride] - ym1
+    v = resample(xs, x2, y2) - ym2
+    m = len(xs)
+    su, sv = u.sum(), v.sum()
+    suu, svv, suv = np.dot(u, u), np.dot(v, v), np.dot(u, v)
+    # Gram matrix of the columns (u, 1, -v, -1)
+    return np.array([[suu, su, -suv, -su],
+                     [su, m, -sv, -m],
+                     [-suv, -sv, svv, sv],
+                     [-su, -m, sv, m]])
@@ -0,0 +1,178 @@
+#! encoding = utf-8
+
+""" Undo/redo history of workspace states, bounded by memory
+
+A state is any structure of tuples, lists, dicts and objects holding numpy
+arrays, e.g. the loaded spectra and the concatenated result. The arrays of
+the workspace are never modified in place, so consecutive states simply
+share the arrays that did not change, and a new state only costs the
+memory of what changed. The memory of the history is the size of the
+array buffers it keeps alive beyond the current state; memory mapped
+buffers live on disk and are free. Oldest states are evicted first when
+the history goes over its budget, and a budget of 0 keeps no state but
+the current one, mapped or not.
+"""
+
+import mmap
+import numpy as np
+
+
+class History:
+    """ Linear undo/redo stack of workspace states
+
+    Arguments:
+        max_bytes: int          memory budget of the states other than the
+                                current one. 0 keeps no history
+    """
+
+    def __init__(self, max_bytes=1024 ** 3):
+        self.max_bytes = max_bytes
+        # list of (label, state, buffers), buffers as found by _buffers
+        self._states = []
+        self._index = -1        # position of the current state
+        # number of states holding each buffer, and the size of all of them,
+        # updated as states come and go
+        self._holders = {}
+        self._total = 0
+
+    def __len__(self):
+        return len(self._states)
+
+    def push(self, state, label='', merge=False):
+        """ Make state the current state, dropping the redo states
+
+        Arguments:
+            state: object           workspace state
+            label: str              name of the operation that led to state
+            merge: bool             replace the current state instead, if it
+                                    has the same label. Used to keep only the
+                                    last of a burst of updates
+        """
+        self._drop_redo()
+        if merge and self._states and self._states[-1][0] == label:
+            self._release(self._states.pop()[2])
+        self._states.append((label, state, self._hold(state)))
+        self._index = len(self._states) - 1
+        self._evict()
+
+    def amend(self, state):
+        """ Replace the current state, keeping its label, and drop the redo
+        states. Used for the automatic follow-ups of an operation, so that
+        they are undone with it """
+        self._drop_redo()
+        label, _, buffers = self._states[self._index]
+        self._release(buffers)
+        self._states[self._index] = (label, state, self._hold(state))
+        self._evict()
+
+    def can_undo(self):
+        return self._index > 0
+
+    def can_redo(self):
+        return self._index < len(self._states) - 1
+
+    def undo_label(self):
+        """ Label of the operation undone by undo() """
+        return self._states[self._index][0] if self.can_undo() else ''
+
+    def redo_label(self):
+        """ Label of the operation redone by redo() """
+        return self._states[self._index + 1][0] if self.can_redo() else ''
+
+    def undo(self):
+        """ Step back. Returns the previous state, None if there is none """
+        if not self.can_undo():
+            return None
+        self._index -= 1
+        return self._states[self._index][1]
+
+    def redo(self):
+        """ Step forward. Returns the next state, None if there is none """
+        if not self.can_redo():
+            return None
+        self._index += 1
+        return self._states[self._index][1]
+
+    def clear(self):
+        """ Forget every state but the current one """
+        if self._states:
+            current = self._states[self._index]
+            for i, (_, _, buffers) in enumerate(self._states):
+                if i != self._index:
+                    self._release(buffers)
+            self._states = [current]
+            self._index = 0
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def nbytes(self):
+        """ Memory kept alive by the history beyond the current state """
+        if not self._states:
+            return 0
+        return self._total - sum(self._states[self._index][2].values())
+
+    def _hold(self, state):
+        """ Count the buffers of a new state. Returns them """
+        buffers = _buffers(state)
+        for key, size in buffers.items():
+            n = self._holders.get(key, 0)
+            if not n:
+                self._total += size
+            self._holders[key] = n + 1
+        return buffers
+
+    def _release(self, buffers):
+        """ Uncount the buffers of a dropped state """
+        for key, size in buffers.items():
+            n = self._holders.pop(key) - 1
+            if n:
+                self._holders[key] = n
+            else:
+                self._total -= size
+
+    def _drop_redo(self):
+        while len(self._states) > self._index + 1:
+            self._release(self._states.pop()[2])
+
+    def _evict(self):
+        """ Drop the oldest states, then the farthest redo states, until
+        the others fit in the budget """
+        if self.max_bytes <= 0:
+            self.clear()
+            return None
+        while len(self._states) > 1 and self.nbytes() > self.max_bytes:
+            if self._index > 0:
+                self._release(self._states.pop(0)[2])
+                self._index -= 1
+            else:
+                self._release(self._states.pop()[2])
+
+
+def _buffers(state):
+    """ {id: size in bytes} of the array buffers held by a state """
+    found = {}
+    stack = [state]
+    seen = set()
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or obj is None or isinstance(obj, (str, bytes, int, float)):
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, np.ndarray):
+            owner = obj
+            while isinstance(owner.base, np.ndarray):
+                owner = owner.base
+            found[id(owner)] = 0 if _is_mapped(owner) else owner.nbytes
+        elif isinstance(obj, (tuple, list)):
+            stack.extend(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif hasattr(obj, '__dict__'):
+            stack.extend(vars(obj).values())
+    return found
+
+
+def _is_mapped(a):
+    return isinstance(a, np.memmap) or isinstance(a.base, mmap.mmap)
@@ -0,0 +1,211 @@
+#! encoding = utf-8
+
+""" Level-of-detail pyramid of a spectrum for fast rendering
+
+Each level keeps, per bin of 64, 256, 1024, ... points, the bin starting x
+and the y minimum and maximum. Drawing the min/max envelope of a level keeps
+every peak visible, and the number of drawn points is set by the screen
+width instead of the data size. Views finer than the first level are
+reduced on the fly from the raw data in view, so the pyramid costs only
+a few percent of the data size. Memory mapped data is read once, block by
+block, to build the pyramid; after that, only the pages of the fine views
+are read again. The coarsest level also gives the y limits for free.
+"""
+
+import numpy as np
+from PyConcat.libs.trace import traced
+
+# number of points merged into a bin of the first level
+_BASE = 64
+# number of bins merged into a bin of the next level
+_FACTOR = 4
+# do not build levels below this number of bins
+_MIN_BINS = 256
+# number of bins of the first level reduced at once, so that each block
+# of data is read once for both its minima and maxima
+_BLOCK_BINS = 1 << 14
+
+
+class MinMaxPyramid:
+    """ Multi-resolution min/max envelope of sorted (x, y) data
+
+    Arguments:
+        x: np.array             sorted x data
+        y: np.array             y data
+    """
+
+    @traced('MinMaxPyramid')
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+        self._limits = None
+        # list of (x_start, y_min, y_max) per level, coarser and coarser
+        self.levels = []
+        if len(x) > _MIN_BINS * _BASE:
+            xs, mn, mx = _reduce_blocks(x, y, _BASE)
+            self.levels.append((xs, mn, mx))
+            while len(xs) > _MIN_BINS * _FACTOR:
+                xs, mn, mx = _reduce(xs, mn, mx, _FACTOR)
+                self.levels.append((xs, mn, mx))
+
+    @classmethod
+    def from_levels(cls, x, y, levels):
+        """ Pyramid of x and y from its saved levels, without reading the data """
+        lod = cls.__new__(cls)
+        lod.x = x
+        lod.y = y
+        lod._limits = None
+        lod.levels = list(levels)
+        return lod
+
+    def __len__(self):
+        return len(self.x)
+
+    def xrange(self):
+        """ (min, max) of x, None if there is no data """
+        return (self.x[0], self.x[-1]) if len(self.x) else None
+
+    def limits(self):
+        """ (min, max) of y, from the coarsest level """
+        if self._limits is None:
+            if self.levels:
+                _, mn, mx = self.levels[-1]
+            else:
+                mn = mx = self.y
+            self._limits = (mn.min(), mx.max()) if len(mn) else None
+        return self._limits
+
+    def get(self, xmin, xmax, nbins):
+        """ Get the points to draw in a x range
+
+        Arguments:
+            xmin, xmax: float       x range in view
+            nbins: int              number of bins wanted, e.g. the pixel width
+        Returns:
+            x: np.array             x to draw
+            y: np.array             y to draw
+        """
+
+        # one extra point on each side to draw the lines to the view edges
+        i0, i1 = _find_slice(self.x, xmin, xmax)
+        npts = i1 - i0
+        if npts <= 2 * nbins:
+            return self.x[i0:i1], self.y[i0:i1]
+        elif npts <= 2 * nbins * _BASE or not self.levels:
+            # reduce the points in view on the fly. The points beyond the
+            # view edges are kept as they are, not drawn at a bin start
+            y = self.y[i0 + 1:i1 - 1]
+            xs, mn, mx = _reduce(self.x[i0 + 1:i1 - 1], y, y, -(-npts // nbins))
+            xs = np.concatenate((self.x[i0:i0 + 1], xs, self.x[i1 - 1:i1]))
+            mn = np.concatenate((self.y[i0:i0 + 1], mn, self.y[i1 - 1:i1]))
+            mx = np.concatenate((self.y[i0:i0 + 1], mx, self.y[i1 - 1:i1]))
+            i0, i1 = 0, len(xs)
+        else:
+            # pick the finest level that has at most 2 bins per pixel
+            for xs, mn, mx in self.levels:
+                i0, i1 = _find_slice(xs, xmin, xmax)
+                if i1 - i0 <= 2 * nbins:
+                    break
+        # draw each bin as a vertical segment from its min to its max
+        x_out = np.repeat(xs[i0:i1], 2)
+        y_out = np.empty(2 * (i1 - i0))
+        y_out[0::2] = mn[i0:i1]
+        y_out[1::2] = mx[i0:i1]
+        return x_out, y_out
+
+
+class SegmentedPyramid:
+    """ Level-of-detail pyramids of the segments of a ConcatPlan, so that
+    a virtual result is drawn without being made contiguous
+
+    Arguments:
+        segments: list          (x, y, a, b) of each segment, drawn as a * y + b
+        reuse: SegmentedPyramid the pyramids of the segments that have the
+                                same x and y arrays are shared, not rebuilt
+    """
+
+    @traced('SegmentedPyramid')
+    def __init__(self, segments, reuse=None):
+        built = {}
+        if reuse:
+            built = {(id(lod.x), id(lod.y)): lod for lod, _, _ in reuse.parts}
+        self.parts = []
+        for x, y, a, b in segments:
+            lod = built.get((id(x), id(y)))
+            if lod is None or lod.x is not x or lod.y is not y:
+                lod = MinMaxPyramid(x, y)
+            self.parts.append((lod, a, b))
+
+    @classmethod
+    def from_parts(cls, parts):
+        """ Pyramid of segments whose pyramids are already built
+
+        Arguments:
+            parts: list         (MinMaxPyramid, a, b) of each segment
+        """
+        lod = cls.__new__(cls)
+        lod.parts = list(parts)
+        return lod
+
+    def xrange(self):
+        """ (min, max) of x over all the segments, None if there is no data """
+        ranges = [r for r in (lod.xrange() for lod, _, _ in self.parts) if r]
+        if not ranges:
+            return None
+        return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+    def limits(self):
+        """ (min, max) of the raw y of each segment """
+        return [lod.limits() for lod, _, _ in self.parts]
+
+    def __len__(self):
+        return sum(len(lod) for lod, _, _ in self.parts)
+
+    def get(self, xmin, xmax, nbins):
+        """ Get the points to draw in a x range, see MinMaxPyramid.get """
+        xs = []
+        ys = []
+        width = max(xmax - xmin, 0.)
+        for lod, a, b in self.parts:
+            if not len(lod) or lod.x[-1] < xmin or lod.x[0] > xmax:
+                continue
+            # share the bins by the x extent of each segment in view
+            if width > 0:
+                frac = (min(lod.x[-1], xmax) - max(lod.x[0], xmin)) / width
+                nb = int(nbins * frac) + 1
+            else:
+                nb = nbins
+            x, y = lod.get(xmin, xmax, nb)
+            xs.append(x)
+            ys.append(y * a + b if a != 1 or b != 0 else y)
+        if not xs:
+            return np.zeros(0), np.zeros(0)
+        return np.concatenate(xs), np.concatenate(ys)
+
+
+def _find_slice(x, xmin, xmax):
+    i0 = max(np.searchsorted(x, xmin, side='left') - 1, 0)
+    i1 = min(np.searchsorted(x, xmax, side='right') + 1, len(x))
+    return i0, i1
+
+
+def _reduce_blocks(x, y, factor):
+    """ Reduce raw data to bins of factor points, block by block """
+    step = factor * _BLOCK_BINS
+    parts = [_reduce(x[i:i + step], y[i:i + step], y[i:i + step], factor)
+             for i in range(0, len(x), step)]
+    return tuple(np.concatenate(p) for p in zip(*parts))
+
+
+def _reduce(xs, mn, mx, factor):
+    """ Merge every factor bins into one """
+    n = len(xs) // factor * factor
+    xs_new = xs[:n:factor]
+    mn_new = mn[:n].reshape(-1, factor).min(axis=1)
+    mx_new = mx[:n].reshape(-1, factor).max(axis=1)
+    if n < len(xs):
+        # the incomplete bin at the end
+        xs_new = np.append(xs_new, xs[n])
+        mn_new = np.append(mn_new, mn[n:].min())
+        mx_new = np.append(mx_new, mx[n:].max())
+    return xs_new, mn_new, mx_new
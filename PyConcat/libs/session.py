@@ -0,0 +1,293 @@
+#! encoding = utf-8
+
+""" Binary session files, to save and reopen a whole workspace
+
+A session holds named curves, e.g. both inputs and the concatenated
+result, each with its y statistics and level-of-detail pyramid, and a
+json dictionary of parameters. The file is laid out as:
+
+    preamble    magic, format version, offset and size of the header
+    arrays      raw little-endian arrays, each aligned to 64 bytes,
+                or zlib compressed chunks
+    header      json: parameters, curves and the location of each array
+
+Raw arrays are written and read through memory maps, so reopening a
+session only reads the header and the small pyramids, whatever its size,
+and the data is paged in where it is shown. Compressed sessions are
+smaller but are decompressed into memory when opened.
+
+    from PyConcat.libs.session import load_session
+    session = load_session('work.pycs')
+    x, y, stats, lod = session.curves['result']
+"""
+
+import json
+import os
+import struct
+import zlib
+from collections import namedtuple
+import numpy as np
+from PyConcat.libs import engine
+from PyConcat.libs.lod import MinMaxPyramid
+from PyConcat.libs.trace import traced
+
+SESSION_EXT = '.pycs'
+SESSION_VERSION = 1
+
+_MAGIC = b'PYCCSESS'
+# magic, version, header offset, header size
+_PREAMBLE = struct.Struct('<8sIxxxxQQ')
+_ALIGN = 64
+# rows copied or compressed at once
+_BLOCK_ROWS = 1 << 20
+# size above which a missing median is estimated, see engine.y_stats
+_MAX_EXACT_MEDIAN = 1 << 22
+
+Session = namedtuple('Session', 'params curves')
+Session.__doc__ = """ Content of a session file
+
+    params: dict            parameters saved with the session
+    curves: dict            {name: (x, y, stats, lod)}, stats is
+                            (min, max, median) or None, lod is a
+                            MinMaxPyramid
+"""
+
+
+@traced
+def save_session(file_name, curves, params=None, compress=False):
+    """ Save curves and parameters as a session
+
+    Arguments:
+        file_name: str          output file name
+        curves: dict            {name: (x, y, stats, lod)}. lod is a
+                                MinMaxPyramid of x and y, or None to build it.
+                                x can also be a ConcatPlan, with y and lod
+                                None: it is written block by block, without
+                                being made contiguous in memory
+        params: dict            json-serializable parameters
+        compress: bool          zlib compress the arrays
+    Raises:
+        ValueError              if the parameters cannot be serialized
+    """
+
+    header = {'version': SESSION_VERSION, 'params': params or {},
+              'curves': {}, 'arrays': {}}
+    # the session replaces the file only once it is complete
+    tmp_name = file_name + '.tmp'
+    try:
+        with open(tmp_name, 'w+b') as fp:
+            fp.write(_PREAMBLE.pack(_MAGIC, SESSION_VERSION, 0, 0))
+            if compress:
+                _write_zlib(fp, curves, header)
+            else:
+                _write_raw(fp, curves, header)
+            header_bytes = json.dumps(header, default=_json_default).encode('utf-8')
+            offset = fp.seek(0, os.SEEK_END)
+            fp.write(header_bytes)
+            fp.seek(0)
+            fp.write(_PREAMBLE.pack(_MAGIC, SESSION_VERSION, offset, len(header_bytes)))
+        os.replace(tmp_name, file_name)
+    except BaseException:
+        if os.path.isfile(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+@traced
+def load_session(file_name, mmap=True):
+    """ Load a session
+
+    Arguments:
+        file_name: str          session file name
+        mmap: bool              memory map the raw arrays instead of reading
+                                them. Compressed arrays are always read
+    Returns:
+        session: Session        parameters and curves
+    Raises:
+        ValueError              if the file is not a session file
+    """
+
+    header = read_session_header(file_name)
+    arrays = {}
+    with open(file_name, 'rb') as fp:
+        for key, info in header['arrays'].items():
+            arrays[key] = _read_array(fp, file_name, info, mmap)
+    curves = {}
+    for name, info in header['curves'].items():
+        x = arrays[name + '/x']
+        y = arrays[name + '/y']
+        if info['levels'] is None:
+            lod = MinMaxPyramid(x, y)
+        else:
+            lod = MinMaxPyramid.from_levels(x, y, [
+                tuple(arrays[_level_key(name, i, k)] for k in _LEVEL_KEYS)
+                for i in range(info['levels'])])
+        stats = tuple(info['stats']) if info['stats'] is not None else None
+        curves[name] = (x, y, stats, lod)
+    return Session(header['params'], curves)
+
+
+def read_session_header(file_name):
+    """ Read the json header of a session, without its arrays
+
+    Returns:
+        header: dict            'version', 'params', 'curves' and 'arrays'
+    Raises:
+        ValueError              if the file is not a session file
+    """
+
+    with open(file_name, 'rb') as fp:
+        preamble = fp.read(_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size:
+            raise ValueError('{:s} is not a session file'.format(file_name))
+        magic, version, offset, size = _PREAMBLE.unpack(preamble)
+        if magic != _MAGIC or not offset:
+            raise ValueError('{:s} is not a session file'.format(file_name))
+        if version > SESSION_VERSION:
+            raise ValueError('{:s} needs a newer version of PyConcat'.format(file_name))
+        fp.seek(offset)
+        return json.loads(fp.read(size).decode('utf-8'))
+
+
+_LEVEL_KEYS = ('x', 'min', 'max')
+
+
+def _level_key(name, i, k):
+    return '{:s}/lod{:d}/{:s}'.format(name, i, k)
+
+
+def _write_raw(fp, curves, header):
+    """ Write the curves uncompressed. x and y of all curves are filled
+    through a single memory map, then their pyramids are appended """
+
+    arrays = header['arrays']
+    end = _PREAMBLE.size
+    for name, (x, y, _, _) in curves.items():
+        for key, a in ((name + '/x', x), (name + '/y', y)):
+            dtype = _file_dtype(a)
+            offset = _aligned(end)
+            arrays[key] = {'dtype': dtype.str, 'n': len(x), 'offset': offset}
+            end = offset + len(x) * dtype.itemsize
+    fp.truncate(end)
+    if end > _PREAMBLE.size:
+        mm = np.memmap(fp, dtype=np.uint8, mode='r+', shape=(end, ))
+        for name, (x, y, _, _) in curves.items():
+            out_x = _view(mm, arrays[name + '/x'])
+            out_y = _view(mm, arrays[name + '/y'])
+            i = 0
+            for xb, yb in _iter_blocks(x, y):
+                out_x[i:i + len(xb)] = xb
+                out_y[i:i + len(xb)] = yb
+                i += len(xb)
+        mm.flush()
+        del mm, out_x, out_y
+    fp.seek(end)
+    for name, (x, y, stats, lod) in curves.items():
+        if _is_plan(x) or lod is None or lod.x is not x or lod.y is not y:
+            # the pyramid of the written data, paged in once
+            x = _read_array(fp, None, arrays[name + '/x'], True)
+            y = _read_array(fp, None, arrays[name + '/y'], True)
+            lod = MinMaxPyramid(x, y)
+        if stats is None:
+            stats = engine.y_stats(y, _MAX_EXACT_MEDIAN)
+        header['curves'][name] = {'n': len(x), 'stats': stats, 'levels': len(lod.levels)}
+        for i, level in enumerate(lod.levels):
+            for k, a in zip(_LEVEL_KEYS, level):
+                fp.write(b'\0' * (_aligned(fp.tell()) - fp.tell()))
+                arrays[_level_key(name, i, k)] = {'dtype': _file_dtype(a).str,
+                                                  'n': len(a), 'offset': fp.tell()}
+                fp.write(np.ascontiguousarray(a, _file_dtype(a)).data)
+
+
+def _write_zlib(fp, curves, header):
+    """ Write the curves as zlib compressed chunks. Pyramids that are not
+    given are built when the session is opened """
+
+    arrays = header['arrays']
+    for name, (x, y, stats, lod) in curves.items():
+        chunks_x = []
+        chunks_y = []
+        arrays[name + '/x'] = {'dtype': _file_dtype(x).str, 'n': len(x), 'zlib': chunks_x}
+        arrays[name + '/y'] = {'dtype': _file_dtype(y).str, 'n': len(x), 'zlib': chunks_y}
+        for xb, yb in _iter_blocks(x, y):
+            chunks_x.append(_write_chunk(fp, xb))
+            chunks_y.append(_write_chunk(fp, yb))
+        if stats is None:
+            stats = x.stats(_MAX_EXACT_MEDIAN) if _is_plan(x) else \
+                engine.y_stats(y, _MAX_EXACT_MEDIAN)
+        if _is_plan(x) or lod is None or lod.x is not x or lod.y is not y:
+            levels = None
+        else:
+            levels = len(lod.levels)
+            for i, level in enumerate(lod.levels):
+                for k, a in zip(_LEVEL_KEYS, level):
+                    arrays[_level_key(name, i, k)] = {
+                        'dtype': _file_dtype(a).str, 'n': len(a),
+                        'zlib': [_write_chunk(fp, a[j:j + _BLOCK_ROWS])
+                                 for j in range(0, len(a), _BLOCK_ROWS)]}
+        header['curves'][name] = {'n': len(x), 'stats': stats, 'levels': levels}
+
+
+def _write_chunk(fp, a):
+    """ Compress and write an array. Returns [offset, size] """
+    data = zlib.compress(np.ascontiguousarray(a, _file_dtype(a)).data, 1)
+    offset = fp.tell()
+    fp.write(data)
+    return [offset, len(data)]
+
+
+def _read_array(fp, file_name, info, mmap):
+    """ Read an array of the header. The file object is memory mapped
+    if file_name is None """
+    dtype = np.dtype(info['dtype'])
+    n = info['n']
+    if 'zlib' in info:
+        a = np.empty(n, dtype)
+        i = 0
+        for offset, size in info['zlib']:
+            fp.seek(offset)
+            block = np.frombuffer(zlib.decompress(fp.read(size)), dtype)
+            a[i:i + len(block)] = block
+            i += len(block)
+        return a
+    if not n:
+        return np.zeros(0, dtype)
+    if mmap:
+        return np.memmap(file_name or fp, dtype=dtype, mode='r',
+                         offset=info['offset'], shape=(n, ))
+    fp.seek(info['offset'])
+    return np.fromfile(fp, dtype=dtype, count=n)
+
+
+def _iter_blocks(x, y):
+    if _is_plan(x):
+        yield from x.iter_blocks(_BLOCK_ROWS)
+    else:
+        for i in range(0, len(x), _BLOCK_ROWS):
+            yield x[i:i + _BLOCK_ROWS], y[i:i + _BLOCK_ROWS]
+
+
+def _is_plan(x):
+    return isinstance(x, engine.ConcatPlan)
+
+
+def _file_dtype(a):
+    """ Little-endian dtype of an array in the file """
+    if a is None or _is_plan(a):
+        return np.dtype('<f8')
+    return a.dtype.newbyteorder('<')
+
+
+def _view(mm, info):
+    dtype = np.dtype(info['dtype'])
+    return mm[info['offset']:info['offset'] + info['n'] * dtype.itemsize].view(dtype)
+
+
+def _aligned(offset):
+    return -(-offset // _ALIGN) * _ALIGN
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise ValueError('{:s} cannot be saved in a session'.format(repr(obj)))
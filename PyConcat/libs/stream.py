@@ -0,0 +1,313 @@
+#! encoding = utf-8
+
+""" Out-of-core concatenation of two sorted spectra
+
+The inputs are read block by block and merged like a sorted-merge join:
+only the current block of each input and a few points of look-ahead are
+kept in memory, and the result is written as it is produced. The memory
+use does not depend on the file sizes, and the inputs and the output can
+be pipes. The result is the same as engine.plan_concat on the exact, file1
+and file2 grids, spectra of a single point aside.
+"""
+
+import os
+import numpy as np
+from PyConcat.libs import engine
+from PyConcat.libs.lib import iter_xy_blocks, save_xy_blocks
+from PyConcat.libs.trace import traced
+
+# sample size of the estimated median of a stream
+MEDIAN_POINTS = 1 << 20
+
+
+class _Stream:
+    """ Sorted (x, y) blocks of an input, with a buffer of the points
+    read but not consumed yet """
+
+    def __init__(self, blocks, name):
+        self.name = name
+        self._blocks = iter(blocks)
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self.exhausted = False
+        self.end = None         # last x read
+        self.prev = None        # last consumed point (x, y)
+
+    def read(self):
+        """ Append the next block to the buffer. Returns False at the end """
+        for x, y in self._blocks:
+            if not len(x):
+                continue
+            if (self.end is not None and x[0] < self.end) or np.any(x[1:] < x[:-1]):
+                raise ValueError('{:s} must be sorted by ascending x to be streamed'.format(
+                    self.name))
+            self.end = x[-1]
+            if len(self.x):
+                self.x = np.concatenate((self.x, x))
+                self.y = np.concatenate((self.y, y))
+            else:
+                self.x = x
+                self.y = y
+            return True
+        self.exhausted = True
+        return False
+
+    def fill(self, bound):
+        """ Read until a buffered x is above bound, or the input ends """
+        while (not len(self.x) or self.x[-1] <= bound) and self.read():
+            pass
+
+    def take(self, n):
+        """ Consume the first n buffered points """
+        x, y = self.x[:n], self.y[:n]
+        if n:
+            self.prev = (x[-1], y[-1])
+        self.x = self.x[n:]
+        self.y = self.y[n:]
+        return x, y
+
+    def take_until(self, bound, side='right'):
+        """ Yield the points up to bound (included if side is 'right'),
+        block by block """
+        while True:
+            n = np.searchsorted(self.x, bound, side=side)
+            if n:
+                yield self.take(n)
+            if len(self.x) or not self.read():
+                return None
+
+    def drain(self):
+        """ Yield all the remaining points """
+        while len(self.x) or self.read():
+            yield self.take(len(self.x))
+
+
+@traced
+def merge_streams(blocks1, blocks2, avg1=1, avg2=1, scale1=1., scale2=1.,
+                  yshift1=0., yshift2=0., replace=False, grid=engine.GRID_EXACT,
+                  ym1=None, ym2=None, names=('data 1', 'data 2')):
+    """ Concatenate (or replace) two sorted spectra given block by block.
+    Arguments are the same as engine.concat.
+
+    Arguments:
+        blocks1, blocks2: iterable  (x, y) blocks of each spectrum, in
+                                    ascending x, e.g. from iter_xy_blocks
+        ym1, ym2: float             medians of y1 and y2. Only needed if
+                                    the spectrum is scaled, see estimate_median
+        names: tuple of str         names of the spectra in error messages
+    Yields:
+        x, y: np.array              blocks of the result, in ascending x
+    Raises:
+        ValueError                  if either spectrum is empty or unsorted,
+                                    a median is missing, the overlaps have
+                                    different dimensions on GRID_EXACT or
+                                    the grid is GRID_STEP
+    """
+
+    coef = []
+    for scale, yshift, ym, name in ((scale1, yshift1, ym1, names[0]),
+                                    (scale2, yshift2, ym2, names[1])):
+        if ym is None and scale != 1:
+            raise ValueError('The median of {:s} is needed to scale it'.format(name))
+        coef.append(engine.affine_coef(scale, yshift, 0. if ym is None else ym))
+    if grid not in (engine.GRID_EXACT, engine.GRID_FILE1, engine.GRID_FILE2):
+        raise ValueError('Only the exact, file1 and file2 grids can be streamed')
+    streams = (_Stream(blocks1, names[0]), _Stream(blocks2, names[1]))
+    for st in streams:
+        st.fill(-np.inf)
+        if not len(st.x):
+            raise ValueError('Both data need to be loaded')
+
+    def _out(pieces, j):
+        a, b = coef[j]
+        for x, y in pieces:
+            yield x, engine.apply_affine(y, a, b)
+
+    # 1. left part, up to the start of the other spectrum
+    xo_min = max(streams[0].x[0], streams[1].x[0])
+    j_left = 0 if streams[0].x[0] < xo_min else 1
+    yield from _out(streams[j_left].take_until(xo_min), j_left)
+    if streams[j_left].exhausted and not len(streams[j_left].x):
+        # the spectra do not overlap, or only touch
+        xo_max = xo_min
+    else:
+        # 2. overlap, strictly inside (xo_min, xo_max), xo_max being the
+        # first end. The grid spectrum is consumed, the other one keeps
+        # the points around the grid points to resample on them
+        xo_max = yield from _merge_overlap(streams, coef, avg1, avg2, replace, grid, xo_min)
+    # 3. right part, from the spectrum that ends last
+    for st in streams:
+        st.fill(xo_max)
+    j_right = 0 if not streams[0].exhausted or streams[0].end > xo_max else 1
+    right = streams[j_right]
+    if len(right.x):
+        right.take(np.searchsorted(right.x, xo_max, side='left'))
+    yield from _out(right.drain(), j_right)
+
+
+def _merge_overlap(streams, coef, avg1, avg2, replace, grid, xo_min):
+    """ Yield the overlap blocks of merge_streams. Returns its upper bound """
+
+    j_grid = 1 if replace or grid == engine.GRID_FILE2 else 0
+    g = streams[j_grid]
+    o = streams[1 - j_grid]
+    exact = grid == engine.GRID_EXACT and not replace
+    (a1, b1), (a2, b2) = coef
+    w1 = avg1 / (avg1 + avg2)
+    w2 = avg2 / (avg1 + avg2)
+    # the overlap starts strictly after xo_min
+    for _ in g.take_until(xo_min):
+        pass
+    if exact:
+        for _ in o.take_until(xo_min):
+            pass
+        return (yield from _merge_exact(g, o, coef, w1, w2))
+    if o.prev is not None:
+        # the left part was taken from the other spectrum, its last point
+        # is needed to resample on the first grid points
+        o.x = np.concatenate(([o.prev[0]], o.x))
+        o.y = np.concatenate(([o.prev[1]], o.y))
+    while True:
+        g.fill(-np.inf)
+        o.fill(-np.inf)
+        ends = [st.end for st in streams if st.exhausted]
+        bound = min(ends) if ends else np.inf
+        if not len(g.x) or g.x[0] >= bound:
+            return bound
+        # grid points before the bound and before the last points read,
+        # which may be the ends of the spectra
+        hi = min(o.x[-1], g.x[-1], bound) if len(o.x) else bound
+        n = np.searchsorted(g.x, hi, side='left')
+        if not n:
+            # read ahead on the spectrum that lags
+            if len(o.x) and o.x[-1] < g.x[-1]:
+                o.read()
+            else:
+                g.read()
+            continue
+        x, yg = g.take(n)
+        if replace:
+            y_cat = yg * a2 + b2
+        else:
+            yo = engine.resample(x, o.x, o.y)
+            # keep the last point before the next grid point
+            o.take(max(np.searchsorted(o.x, x[-1], side='right') - 1, 0))
+            y1, y2 = (yg, yo) if j_grid == 0 else (yo, yg)
+            y_cat = np.multiply(y1, a1 * w1, dtype=float)
+            y_cat += y2 * (a2 * w2)
+            y_cat += b1 * w1 + b2 * w2
+        yield x, y_cat
+
+
+def _merge_exact(g, o, coef, w1, w2):
+    """ Yield the overlap blocks of the exact grid, see _merge_overlap.
+    As in engine.plan_concat, the overlaps only need the same number of
+    points: they are averaged point by point, on the x of file 1 """
+
+    (a1, b1), (a2, b2) = coef
+    while True:
+        g.fill(-np.inf)
+        o.fill(-np.inf)
+        ends = [st.end for st in (g, o) if st.exhausted]
+        if ends:
+            # the end of the overlap is known, average the rest of it
+            bound = min(ends)
+            g.fill(bound)
+            o.fill(bound)
+            n = np.searchsorted(g.x, bound, side='left')
+            if n != np.searchsorted(o.x, bound, side='left'):
+                raise ValueError('The two data have different dimensions')
+        else:
+            # points before the last x read of both spectra are inside
+            # the overlap
+            hi = min(g.end, o.end)
+            n = min(np.searchsorted(g.x, hi, side='left'),
+                    np.searchsorted(o.x, hi, side='left'))
+            if not n:
+                # read ahead on the spectrum that lags
+                for st in (g, o):
+                    if st.end == hi:
+                        st.read()
+                continue
+        if n:
+            x, yg = g.take(n)
+            _, yo = o.take(n)
+            y_cat = np.multiply(yg, a1 * w1, dtype=float)
+            y_cat += yo * (a2 * w2)
+            y_cat += b1 * w1 + b2 * w2
+            yield x, y_cat
+        if ends:
+            return bound
+
+
+@traced
+def estimate_median(blocks, max_points=MEDIAN_POINTS):
+    """ Median of y given block by block, in bounded memory. Above
+    max_points, it is the median of an evenly strided sample, as in
+    engine.y_stats
+
+    Arguments:
+        blocks: iterable        (x, y) blocks
+        max_points: int         maximum sample size
+    Returns:
+        ym: float               median of y, None if there is no data
+    """
+
+    sample = []
+    size = 0
+    step = 1
+    count = 0
+    for _, y in blocks:
+        part = y[(-count) % step::step].copy()
+        count += len(y)
+        sample.append(part)
+        size += len(part)
+        if size > 2 * max_points:
+            kept = np.concatenate(sample)[::2]
+            sample = [kept]
+            size = len(kept)
+            step *= 2
+    if not size:
+        return None
+    return float(np.median(np.concatenate(sample)))
+
+
+@traced
+def stream_concat(source1, source2, output, fmtX='%.3f', fmtY='%.3f',
+                  chunk_size=1 << 22, **kwargs):
+    """ Concatenate two sorted data files into a text file, in bounded
+    memory. The medians of scaled files that are not given are estimated
+    by a first pass, which pipes cannot have. An output file is only
+    replaced once the result is complete, an error leaves it untouched.
+
+    Arguments:
+        source1, source2: str or file   file names, or binary file objects
+                                        of text files, e.g. sys.stdin.buffer
+        output: str or file             output file name, or binary file
+                                        object, e.g. sys.stdout.buffer
+        fmtX, fmtY: str                 %-style formats of the columns
+        chunk_size: int                 read block size in bytes
+        kwargs:                         see merge_streams
+    """
+
+    names = tuple(src if isinstance(src, str) else getattr(src, 'name', '<stream>')
+                  for src in (source1, source2))
+    for i, src in enumerate((source1, source2)):
+        key = 'ym{:d}'.format(i + 1)
+        if kwargs.get('scale{:d}'.format(i + 1), 1.) != 1 and kwargs.get(key) is None:
+            if not isinstance(src, str):
+                raise ValueError('The median of {:s} is needed to scale it'.format(names[i]))
+            kwargs[key] = estimate_median(iter_xy_blocks(src, chunk_size))
+    blocks = merge_streams(iter_xy_blocks(source1, chunk_size),
+                           iter_xy_blocks(source2, chunk_size), names=names, **kwargs)
+    if not isinstance(output, str):
+        save_xy_blocks(output, blocks, fmtX, fmtY)
+        return None
+    tmp_name = output + '.tmp'
+    try:
+        save_xy_blocks(tmp_name, blocks, fmtX, fmtY)
+        os.replace(tmp_name, output)
+    except BaseException:
+        if os.path.isfile(tmp_name):
+            os.remove(tmp_name)
+        raise
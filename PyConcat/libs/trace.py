@@ -0,0 +1,257 @@
+#! encoding = utf-8
+
+""" Opt-in timing of the hot paths
+
+Functions decorated with `traced`, and blocks wrapped in `span`, record
+their wall time, CPU time and data size once tracing is enabled. When it
+is disabled, a traced call only costs one flag check, and `span` returns
+a shared no-op context.
+
+Spans nest per thread. Whenever an outermost span finishes, the listeners
+are called with it, e.g. to show its breakdown in the status bar. The
+recorded spans can be dumped in the Chrome trace format, to be opened in
+chrome://tracing or https://ui.perfetto.dev
+
+Tracing can also be turned on without the GUI, by setting the environment
+variable PYCC_TRACE to the file name of the trace written at exit.
+"""
+
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+import numpy as np
+
+# maximum number of spans kept in memory, older ones are dropped
+MAX_SPANS = 100000
+
+
+class Span:
+    """ A timed operation
+
+    Attributes:
+        name: str               operation name
+        args: dict              extra information, e.g. the data size 'n'
+        tid: int                thread id
+        start: int              wall start time in ns
+        wall: int               wall time in ns
+        cpu: int                CPU time of the thread in ns
+        children: list of Span  nested operations
+    """
+
+    __slots__ = ('name', 'args', 'tid', 'start', 'wall', 'cpu', 'children',
+                 '_cpu0')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.tid = threading.get_ident()
+        self.children = []
+        self.wall = 0
+        self.cpu = 0
+        self.start = time.perf_counter_ns()
+        self._cpu0 = time.thread_time_ns()
+
+    def stop(self):
+        self.wall = time.perf_counter_ns() - self.start
+        self.cpu = time.thread_time_ns() - self._cpu0
+
+    def breakdown(self):
+        """ Summary of the span and its direct children, children of the
+        same name are added up
+
+        Returns:
+            text: str           e.g. 'concat_task 12.3 ms: concat 10.1 ms, ...'
+        """
+        total = {}
+        for child in self.children:
+            total[child.name] = total.get(child.name, 0) + child.wall
+        text = '{:s}{:s} {:.1f} ms'.format(self.name, _size_str(self.args),
+                                          self.wall / 1e6)
+        if total:
+            text += ': ' + ', '.join('{:s} {:.1f} ms'.format(name, wall / 1e6)
+                                     for name, wall in total.items())
+        return text
+
+
+class _NullSpan:
+    """ Shared no-op context returned by span() when tracing is disabled """
+
+    __slots__ = ()
+    args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """ Collect the spans of all threads """
+
+    def __init__(self):
+        self.enabled = False
+        self._spans = deque(maxlen=MAX_SPANS)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.last = None        # latest outermost span
+
+    def enable(self, is_enabled=True):
+        self.enabled = bool(is_enabled)
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+            self.last = None
+
+    def add_listener(self, fn):
+        """ Call fn(span) when an outermost span finishes. fn is called
+        in the thread of the span """
+        self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        if fn in self._listeners:
+            self._listeners.remove(fn)
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def push(self, name, args):
+        sp = Span(name, args)
+        stack = self._stack()
+        if stack:
+            stack[-1].children.append(sp)
+        stack.append(sp)
+        return sp
+
+    def pop(self, sp):
+        sp.stop()
+        stack = self._stack()
+        stack.pop()
+        with self._lock:
+            self._spans.append(sp)
+        if not stack:
+            self.last = sp
+            for fn in self._listeners:
+                fn(sp)
+
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def to_chrome(self):
+        """ Recorded spans as a Chrome trace dictionary """
+        pid = os.getpid()
+        events = []
+        for sp in self.spans():
+            args = dict(sp.args)
+            args['cpu_ms'] = round(sp.cpu / 1e6, 3)
+            events.append({'name': sp.name, 'ph': 'X', 'pid': pid, 'tid': sp.tid,
+                           'ts': sp.start / 1e3, 'dur': sp.wall / 1e3,
+                           'args': args})
+        events.sort(key=lambda ev: ev['ts'])
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, file_name):
+        """ Write the recorded spans to a Chrome trace json file """
+        with open(file_name, 'w') as fp:
+            json.dump(self.to_chrome(), fp, default=_json_default)
+
+
+class _ActiveSpan:
+
+    __slots__ = ('_name', '_args', '_span')
+
+    def __init__(self, name, args):
+        self._name = name
+        self._args = args
+        self._span = None
+
+    def __enter__(self):
+        self._span = TRACER.push(self._name, self._args)
+        return self._span
+
+    def __exit__(self, *exc):
+        TRACER.pop(self._span)
+        return False
+
+
+TRACER = Tracer()
+
+
+def span(name, **args):
+    """ Time a block:
+
+        with span('parse', n=len(data)) as sp:
+            ...
+            sp.args['rows'] = nrows
+
+    Returns a shared no-op context if tracing is disabled
+    """
+    if not TRACER.enabled:
+        return _NULL_SPAN
+    return _ActiveSpan(name, args)
+
+
+def traced(name=None):
+    """ Decorator timing every call of a function, as @traced or
+    @traced('label'). The data size 'n' is taken from the first array
+    in the result, or else in the arguments """
+
+    if callable(name):
+        return traced()(name)
+
+    def deco(fn):
+        label = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return fn(*args, **kwargs)
+            sp = TRACER.push(label, {})
+            result = None
+            try:
+                result = fn(*args, **kwargs)
+                return result
+            finally:
+                n = _size_of(result, args)
+                if n is not None:
+                    sp.args['n'] = n
+                TRACER.pop(sp)
+        return wrapper
+    return deco
+
+
+def _size_of(result, args):
+    items = result if isinstance(result, tuple) else (result, )
+    for item in items + args:
+        if isinstance(item, np.ndarray):
+            return item.shape[0] if item.ndim else 1
+    return None
+
+
+def _size_str(args):
+    return ' [{:d}]'.format(args['n']) if 'n' in args else ''
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+
+if os.environ.get('PYCC_TRACE'):
+    TRACER.enable()
+    atexit.register(TRACER.dump, os.environ['PYCC_TRACE'])
@@ -0,0 +1,73 @@
+#! encoding = utf-8
+
+""" Out-of-core concatenation of two spectra from the command line
+
+The files are read and written block by block, so they can be larger than
+the memory, and either input and the output can be a pipe:
+
+    pycc-merge a.txt b.txt -o ab.txt --avg2 2
+    gunzip -c b.txt.gz | pycc-merge a.txt - --scale2 1.2 --median2 0.35 > ab.txt
+
+Both inputs must be sorted by ascending x.
+"""
+
+import argparse
+import os
+import sys
+from PyConcat.libs import engine
+from PyConcat.libs.stream import stream_concat
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pycc-merge',
+        description='Concatenate two sorted spectra in constant memory. '
+                    'Use - to read one of them from stdin')
+    parser.add_argument('file1', help='spectrum 1, or - for stdin')
+    parser.add_argument('file2', help='spectrum 2, or - for stdin')
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file (default: stdout)')
+    for i in ('1', '2'):
+        parser.add_argument('--avg' + i, type=int, default=1,
+                            help='number of averages of spectrum ' + i)
+        parser.add_argument('--scale' + i, type=float, default=1.,
+                            help='scaling factor of spectrum ' + i)
+        parser.add_argument('--yshift' + i, type=float, default=0.,
+                            help='y shift of spectrum ' + i)
+        parser.add_argument('--median' + i, type=float, default=None,
+                            help='median of spectrum {:s}, around which it is scaled. '
+                                 'Estimated by a first pass if not given, which '
+                                 'stdin cannot have'.format(i))
+    parser.add_argument('--replace', action='store_true',
+                        help='replace the overlap of 1 by 2 instead of averaging')
+    parser.add_argument('--grid', default=engine.GRID_EXACT,
+                        choices=(engine.GRID_EXACT, engine.GRID_FILE1, engine.GRID_FILE2),
+                        help='grid of the averaged overlap (default: exact)')
+    parser.add_argument('--fmtX', default='%.3f', help='format of the x column')
+    parser.add_argument('--fmtY', default='%.3f', help='format of the y column')
+    args = parser.parse_args(argv)
+
+    if args.file1 == '-' and args.file2 == '-':
+        parser.error('only one input can be read from stdin')
+    sources = [sys.stdin.buffer if f == '-' else f for f in (args.file1, args.file2)]
+    output = sys.stdout.buffer if args.output == '-' else args.output
+    try:
+        stream_concat(sources[0], sources[1], output, args.fmtX, args.fmtY,
+                      avg1=args.avg1, avg2=args.avg2,
+                      scale1=args.scale1, scale2=args.scale2,
+                      yshift1=args.yshift1, yshift2=args.yshift2,
+                      ym1=args.median1, ym2=args.median2,
+                      replace=args.replace, grid=args.grid)
+    except BrokenPipeError:
+        # the reader of the output has exited, e.g. head
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    except (OSError, ValueError, TypeError) as e:
+        print('Error: {:s}'.format(str(e)), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+
+    sys.exit(main())
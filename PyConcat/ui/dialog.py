@@ -38,14 +38,25 @@ class DialogPref(QtWidgets.QDialog):
         self._pt_pen_list = []
 
         # other value input widgets
+        inpLoadWorkers = create_int_spin_box(0, minimum=0, maximum=64)
+        inpLoadWorkers.setSpecialValueText('All cores')     # 0 is every core
         self._inp_list = [
             ('click_radius', QtWidgets.QLabel('Click radius'),
              create_int_spin_box(3, minimum=1, maximum=10, suffix=' px')),
+            ('cache_size', QtWidgets.QLabel('Spectrum cache'),
+             create_int_spin_box(512, minimum=0, maximum=1048576, suffix=' MB')),
+            ('history_size', QtWidgets.QLabel('Undo history'),
+             create_int_spin_box(1024, minimum=0, maximum=1048576, suffix=' MB')),
+            ('export_workers', QtWidgets.QLabel('Export processes'),
+             create_int_spin_box(1, minimum=1, maximum=64)),
+            ('load_workers', QtWidgets.QLabel('Loading processes'), inpLoadWorkers),
         ]
 
         # other check widgets
         self._ck_list = [
             ('is_antialias', QtWidgets.QCheckBox('Anti-alias')),
+            ('is_approx_median', QtWidgets.QCheckBox('Approximate medians')),
+            ('is_session_compress', QtWidgets.QCheckBox('Compress sessions')),
         ]
 
         penBoxLayout = QtWidgets.QGridLayout()
@@ -0,0 +1,113 @@
+#! encoding = utf-8
+
+""" Spectra shown by the canvases
+
+The store holds each curve once, as a CurveData: its level-of-detail
+pyramid, cached statistics and draw transform. Canvases bound to a store
+share these objects instead of receiving their own copies, and redraw a
+curve only when its data version or transform changes. The memory of the
+displayed data therefore does not grow with the number of canvases: each
+canvas only keeps the few screen-wide points it draws.
+"""
+
+from PyQt5 import QtCore
+from numpy import zeros
+from PyConcat.libs import engine
+from PyConcat.libs.lod import MinMaxPyramid
+
+
+# sample size of the approximate median of a curve, see engine.y_stats
+_MEDIAN_POINTS = 1 << 22
+
+
+class CurveData:
+    """ Data of a curve of a canvas: its level-of-detail pyramid, the cached
+    statistics of y and the transform applied to y when drawing.
+    Statistics are computed at most once per data, and only if they were
+    not given with it. Min and max then come from the pyramid, without
+    scanning the data.
+    """
+
+    def __init__(self):
+        self.lod = MinMaxPyramid(zeros(0), zeros(0))
+        self.affine = (1., 0.)
+        self.version = 0        # incremented whenever the data changes
+        self._stats = None
+        self._stale = False     # stats need to be computed
+
+    def set_data(self, x, y, stats=None, lod=None):
+        """ Set the data, see Canvas.plot1. Returns True if it changed """
+        if lod is None:
+            is_new = not (x is getattr(self.lod, 'x', None) and
+                          y is getattr(self.lod, 'y', None))
+            lod = MinMaxPyramid(x, y) if is_new else self.lod
+        if lod is not self.lod:
+            self.lod = lod
+            self._stats = stats
+            self._stale = not stats
+            self.version += 1
+            return True
+        if stats:
+            self._stats = stats
+            self._stale = False
+        return False
+
+    def stats(self, approx_median=False):
+        """ (min, max, median) of y, None if there is no data
+
+        Arguments:
+            approx_median: bool     take the median of a sample of large data
+        """
+        if self._stale:
+            self._stale = False
+            self._stats = _lod_stats(self.lod, _MEDIAN_POINTS if approx_median else None)
+        return self._stats
+
+
+def _lod_stats(lod, max_exact=None):
+    """ Statistics of the y of a MinMaxPyramid, see engine.y_stats """
+    if not isinstance(lod, MinMaxPyramid) or not len(lod):
+        # the statistics of a virtual result come with it
+        return None
+    ymin, ymax = lod.limits()
+    return ymin, ymax, engine.y_median(lod.y, max_exact)
+
+
+class SpectrumStore(QtCore.QObject):
+    """ Observable set of named curves, e.g. 'file1' and 'result'. The
+    changed signal carries the name of the curve that changed """
+
+    changed = QtCore.pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._curves = {}
+
+    def get(self, name):
+        """ CurveData of name, created empty if missing """
+        if name not in self._curves:
+            self._curves[name] = CurveData()
+        return self._curves[name]
+
+    def set_data(self, name, x, y, stats=None, affine=(1., 0.), lod=None):
+        """ Set the data of a curve, drawn as a * y + b
+
+        Arguments:
+            name: str               curve name
+            x, y: np.array          data. The pyramid is only rebuilt if
+                                    they are new arrays. Not used if both
+                                    stats and lod are given
+            stats: tuple            (min, max, median) of y, computed once
+                                    when needed if not given
+            affine: (a, b)          transform applied to y when drawing
+            lod: MinMaxPyramid      prebuilt pyramid of (x, y), or
+                                    SegmentedPyramid of a virtual result
+        """
+        data = self.get(name)
+        data.set_data(x, y, stats, lod)
+        data.affine = affine
+        self.changed.emit(name)
+
+    def clear(self, name):
+        """ Empty a curve """
+        self.set_data(name, zeros(0), zeros(0))
@@ -5,8 +5,10 @@
 
 from PyQt5 import QtWidgets, QtCore
 import pyqtgraph as pg
-from numpy import median, any
 from PyConcat.ui.common import create_int_spin_box, create_double_spin_box
+from PyConcat.libs import engine
+from PyConcat.ui.store import CurveData, SpectrumStore
+from PyConcat.libs.trace import traced, span
 
 
 class MainUI(QtWidgets.QWidget):
@@ -17,10 +19,15 @@ class MainUI(QtWidgets.QWidget):
         self.penMgr = PenManager(prefs)
         pg.setConfigOption('leftButtonPan', False)
 
+        # the spectra, shared by all canvases
+        self.store = SpectrumStore(self)
         self.canvasFull = Canvas(self.penMgr, parent=self)
+        self.canvasFull.bind(self.store, 'file1', 'file2')
         self.canvasDetail = Canvas(self.penMgr, parent=self)
+        self.canvasDetail.bind(self.store, 'file1', 'file2')
         self.canvasDetail.setYLink(self.canvasFull)
         self.canvasCC = Canvas(self.penMgr, parent=self)
+        self.canvasCC.bind(self.store, 'result', 'overlap')
         self.canvasCC.setXLink(self.canvasFull)
         self.canvasCC.setYLink(self.canvasFull)
         canvasLayout = QtWidgets.QVBoxLayout()  # _layout for canvas
@@ -58,6 +65,8 @@ class MainUI(QtWidgets.QWidget):
         self.box2.inpYShift.setValue(prefs.yshift2)
         self.box3.inpFmtX.setText(prefs.fmtX)
         self.box3.inpFmtY.setText(prefs.fmtY)
+        self.box3.set_grid(prefs.concat_grid)
+        self.box3.inpStep.setValue(prefs.concat_step)
         self.penMgr.load_prefs(prefs)
         self.canvasFull.refreshPen()
         self.canvasDetail.refreshPen()
@@ -70,6 +79,8 @@ class MainUI(QtWidgets.QWidget):
         prefs.scale2 = self.box2.inpScale.value()
         prefs.fmtX = self.box3.inpFmtX.text()
         prefs.fmtY = self.box3.inpFmtY.text()
+        prefs.concat_grid = self.box3.get_grid()
+        prefs.concat_step = self.box3.inpStep.value()
         prefs.yshift1 = self.box1.inpYShift.value()
         prefs.yshift2 = self.box2.inpYShift.value()
 
@@ -87,6 +98,14 @@ class Canvas(pg.PlotWidget):
         self.addItem(self.curve2)
         self.setLabel('bottom', 'Frequency')
         self.refreshPen()
+        # full data of the two curves, with their cached statistics
+        self.data1 = CurveData()
+        self.data2 = CurveData()
+        # store names of the two curves, and (version, affine) last drawn
+        self._names = (None, None)
+        self._drawn = [None, None]
+        self.getViewBox().sigXRangeChanged.connect(self._refresh_curves)
+        self.getViewBox().sigResized.connect(self._refresh_curves)
 
         # keep track of the xrange of the spectrum
         self._xrange_record = []
@@ -96,33 +115,91 @@ class Canvas(pg.PlotWidget):
         self._ymax = 100.    # hold the current y range
         self._ymedian = 0.     # hold the current y center
 
-    def plot1(self, x, y):
-        self.curve1.setData(x, y)
-        if any(y) and any(self.curve2.yData):
-            self._ymin = min(y.min(), self.curve2.yData.min())
-            self._ymax = max(y.max(), self.curve2.yData.max())
-            self._ymedian = (median(y) + median(self.curve2.yData)) / 2
-        elif any(y):
-            self._ymin = y.min()
-            self._ymax = y.max()
-            self._ymedian = median(y)
-        else:
-            pass
+    def bind(self, store, name1=None, name2=None):
+        """ Show curves of a SpectrumStore, following their changes. The
+        curve data is shared with the store, so plot1 and plot2 must not be
+        used on a bound curve
+
+        Arguments:
+            store: SpectrumStore    store of the curves
+            name1, name2: str       names of curve 1 and curve 2, None to
+                                    keep plotting that curve directly
+        """
+        self._names = (name1, name2)
+        if name1:
+            self.data1 = store.get(name1)
+        if name2:
+            self.data2 = store.get(name2)
+        store.changed.connect(self._store_changed)
+
+    def _store_changed(self, name):
+        redrawn = False
+        for i, (curve, data) in enumerate(((self.curve1, self.data1),
+                                           (self.curve2, self.data2))):
+            drawn = (data.version, data.affine)
+            if self._names[i] == name and self._drawn[i] != drawn:
+                self._drawn[i] = drawn
+                self._draw(curve, data.lod, data.affine)
+                redrawn = True
+        if redrawn:
+            self._update_yrange()
+
+    @traced
+    def plot1(self, x, y, stats=None, affine=(1., 0.), lod=None):
+        """ Plot curve 1 as a * y + b
+
+        Arguments:
+            x, y: np.array          data. The level-of-detail pyramid is only
+                                    rebuilt if they are new arrays. Not
+                                    used if both stats and lod are given
+            stats: tuple            (min, max, median) of y, computed once
+                                    when needed if not given
+            affine: (a, b)          transform applied to y when drawing
+            lod: MinMaxPyramid      prebuilt pyramid of (x, y), shared between canvases
+        """
+        self._plot(self.curve1, self.data1, x, y, stats, affine, lod)
+
+    @traced
+    def plot2(self, x, y, stats=None, affine=(1., 0.), lod=None):
+        """ Plot curve 2 as a * y + b, see plot1 """
+        self._plot(self.curve2, self.data2, x, y, stats, affine, lod)
+
+    def _plot(self, curve, data, x, y, stats, affine, lod):
+        data.set_data(x, y, stats, lod)
+        data.affine = affine
+        self._draw(curve, data.lod, affine)
+        self._update_yrange()
+
+    def _update_yrange(self):
+        """ Reset the y range from the transformed statistics of both
+        curves, without scanning their data """
+        stats = []
+        for data in (self.data1, self.data2):
+            st = data.stats(self._penMgr.is_approx_median)
+            if st:
+                stats.append(engine.affine_stats(st, *data.affine))
+        if stats:
+            self._ymin = min(st[0] for st in stats)
+            self._ymax = max(st[1] for st in stats)
+            self._ymedian = sum(st[2] for st in stats) / len(stats)
         self._zoom_y(1)
 
-    def plot2(self, x, y):
-        self.curve2.setData(x, y)
-        if any(y) and any(self.curve1.yData):
-            self._ymin = min(y.min(), self.curve1.yData.min())
-            self._ymax = max(y.max(), self.curve1.yData.max())
-            self._ymedian = (median(y) + median(self.curve1.yData)) / 2
-        elif any(y):
-            self._ymin = y.min()
-            self._ymax = y.max()
-            self._ymedian = median(y)
-        else:
-            pass
-        self._zoom_y(1)
+    def _draw(self, curve, lod, affine=(1., 0.)):
+        """ Draw the level of detail matching the view range and width """
+        if not len(lod):
+            curve.clear()
+            return None
+        (xmin, xmax), _ = self.getViewBox().viewRange()
+        x, y = lod.get(xmin, xmax, max(int(self.getViewBox().width()), 1))
+        a, b = affine
+        if a != 1 or b != 0:
+            y = y * a + b
+        with span('render', n=len(x)):
+            curve.setData(x, y)
+
+    def _refresh_curves(self):
+        self._draw(self.curve1, self.data1.lod, self.data1.affine)
+        self._draw(self.curve2, self.data2.lod, self.data2.affine)
 
     def refreshPen(self):
 
@@ -136,7 +213,7 @@ class Canvas(pg.PlotWidget):
         if self._xrange_record:
             return self._xrange_record[-1]
         else:
-            return self.curve1.xData.min(), self.curve1.xData.max()
+            return self.data1.lod.xrange()
 
     def get_current_yrange(self):
         view_range = self.curve1.getViewBox().viewRange()
@@ -212,10 +289,21 @@ class BoxFile(QtWidgets.QGroupBox):
 
         self.btnOpen = QtWidgets.QPushButton('Open File')
         self.inpAvg = create_int_spin_box(1, minimum=1)
-        self.inpScale = create_double_spin_box(1, minimum=0, dec=3)
+        # enough decimals to hold a fitted scale and shift, see match_scale
+        self.inpScale = create_double_spin_box(1, minimum=0, dec=6)
         self.inpScale.setStepType(QtWidgets.QAbstractSpinBox.AdaptiveDecimalStepType)
-        self.inpYShift = create_double_spin_box(0, dec=3)
+        self.inpYShift = create_double_spin_box(0, dec=6)
         self.btnClear = QtWidgets.QPushButton('Clear')
+        # loading progress, only visible while a file is being loaded
+        self.progressBar = QtWidgets.QProgressBar()
+        self.progressBar.setRange(0, 1000)
+        self.progressBar.setTextVisible(False)
+        self.btnCancel = QtWidgets.QPushButton('Cancel')
+        self.lblLoading = QtWidgets.QLabel()
+
+        loadLayout = QtWidgets.QHBoxLayout()
+        loadLayout.addWidget(self.progressBar)
+        loadLayout.addWidget(self.btnCancel)
 
         avgLayout = QtWidgets.QHBoxLayout()
         avgLayout.addWidget(QtWidgets.QLabel('Average: '))
@@ -232,30 +320,79 @@ class BoxFile(QtWidgets.QGroupBox):
         thisLayout = QtWidgets.QVBoxLayout()
         thisLayout.setAlignment(QtCore.Qt.AlignTop | QtCore.Qt.AlignLeft)
         thisLayout.addWidget(self.btnOpen)
+        thisLayout.addWidget(self.lblLoading)
+        thisLayout.addLayout(loadLayout)
         thisLayout.addLayout(avgLayout)
         thisLayout.addLayout(scaleLayout)
         thisLayout.addLayout(shiftLayout)
         thisLayout.addWidget(self.btnClear)
         self.setLayout(thisLayout)
         self.setSizePolicy(QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Fixed)
+        self.set_loading('')
+
+    def set_loading(self, filename):
+        """ Show the loading progress of filename, or hide it if empty """
+        is_loading = bool(filename)
+        self.lblLoading.setText(filename)
+        self.lblLoading.setToolTip(filename)
+        self.lblLoading.setVisible(is_loading)
+        self.progressBar.setValue(0)
+        self.progressBar.setVisible(is_loading)
+        self.btnCancel.setVisible(is_loading)
+
+    def set_progress(self, done, total):
+        if total > 0:
+            self.progressBar.setValue(int(1000 * done / total))
+            self.progressBar.setToolTip('{:.1f} / {:.1f} MB'.format(
+                done / 1024 ** 2, total / 1024 ** 2))
 
 
 class BoxConcat(QtWidgets.QGroupBox):
 
+    # (grid type, combo box label)
+    grid_items = ((engine.GRID_EXACT, 'Same points'),
+                  (engine.GRID_FILE1, 'File 1 grid'),
+                  (engine.GRID_FILE2, 'File 2 grid'),
+                  (engine.GRID_STEP, 'Custom step'))
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setTitle('Concatenated')
 
         self.btnConcat = QtWidgets.QPushButton('Concatenate')
         self.btnReplace = QtWidgets.QPushButton('Replace 2 on 1')
+        self.btnMatch = QtWidgets.QPushButton('Auto Match 2 to 1')
+        self.btnMatch.setToolTip('Fit the scale and shift of file 2 to file 1 on their overlap')
+        self.btnStitch = QtWidgets.QPushButton('Stitch Many Files')
+        self.btnStitch.setToolTip('Stitch any number of overlapping files in one pass')
         self.btnOverride = QtWidgets.QPushButton('Result → File 1')
         self.btnSave = QtWidgets.QPushButton('Save (Ctrl+S)')
         self.btnSave.setShortcut('Ctrl+S')
         self.btnClear = QtWidgets.QPushButton('Clear')
+        self.ckPreview = QtWidgets.QCheckBox('Live preview')
+        self.ckPreview.setToolTip('Update the concatenation as the averages, '
+                                  'scales and shifts change')
         self.inpFmtX = QtWidgets.QLineEdit('%.2f')
         self.inpFmtX.setPlaceholderText('e.g. %.2f')
         self.inpFmtY = QtWidgets.QLineEdit('%.3f')
         self.inpFmtY.setPlaceholderText('e.g. %.2f')
+        self.comboGrid = QtWidgets.QComboBox()
+        for _, label in self.grid_items:
+            self.comboGrid.addItem(label)
+        self.comboGrid.setToolTip('Grid of the averaged overlap region')
+        self.inpStep = create_double_spin_box(0.01, minimum=0, dec=6)
+        self.inpStep.setStepType(QtWidgets.QAbstractSpinBox.AdaptiveDecimalStepType)
+        self.inpStep.setEnabled(False)
+        self.comboGrid.currentIndexChanged.connect(
+            lambda: self.inpStep.setEnabled(self.get_grid() == engine.GRID_STEP))
+
+        gridLayout = QtWidgets.QHBoxLayout()
+        gridLayout.addWidget(QtWidgets.QLabel('Overlap: '))
+        gridLayout.addWidget(self.comboGrid)
+
+        stepLayout = QtWidgets.QHBoxLayout()
+        stepLayout.addWidget(QtWidgets.QLabel('Step: '))
+        stepLayout.addWidget(self.inpStep)
 
         fmtXLayout = QtWidgets.QHBoxLayout()
         fmtXLayout.addWidget(QtWidgets.QLabel('X Format: '))
@@ -269,8 +406,13 @@ class BoxConcat(QtWidgets.QGroupBox):
 
         thisLayout = QtWidgets.QVBoxLayout()
         thisLayout.setAlignment(QtCore.Qt.AlignTop | QtCore.Qt.AlignLeft)
+        thisLayout.addLayout(gridLayout)
+        thisLayout.addLayout(stepLayout)
+        thisLayout.addWidget(self.btnMatch)
+        thisLayout.addWidget(self.ckPreview)
         thisLayout.addWidget(self.btnConcat)
         thisLayout.addWidget(self.btnReplace)
+        thisLayout.addWidget(self.btnStitch)
         thisLayout.addWidget(self.btnOverride)
         thisLayout.addWidget(self.btnSave)
         thisLayout.addWidget(self.btnClear)
@@ -279,6 +421,14 @@ class BoxConcat(QtWidgets.QGroupBox):
         self.setLayout(thisLayout)
         self.setSizePolicy(QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Fixed)
 
+    def get_grid(self):
+        return self.grid_items[self.comboGrid.currentIndex()][0]
+
+    def set_grid(self, grid):
+        for i, (name, _) in enumerate(self.grid_items):
+            if name == grid:
+                self.comboGrid.setCurrentIndex(i)
+
 
 class PenManager:
     """ A global pen manager for all canvas. This makes sure the same pen
@@ -295,12 +445,14 @@ class PenManager:
         self._dict_size = {}
         self._dict_brush = {}
         self.is_antialias = True
+        self.is_approx_median = False
         self.click_radius = 3
         self.load_prefs(prefs)
 
     def load_prefs(self, prefs):
         self.click_radius = prefs.click_radius
         self.is_antialias = prefs.is_antialias
+        self.is_approx_median = prefs.is_approx_median
         for name in self.color_names:
             self._dict_color[name] = pg.mkColor(
                     getattr(prefs, '_'.join([name, 'color']))
@@ -341,11 +493,34 @@ class MenuBar(QtWidgets.QMenuBar):
     def __init__(self, prefs, parent=None):
         super().__init__(parent)
 
+        self.actionOpenSession = QtWidgets.QAction('Open Session...')
+        self.actionOpenSession.setShortcut('Ctrl+Shift+L')
+        self.actionSaveSession = QtWidgets.QAction('Save Session...')
+        self.actionSaveSession.setShortcut('Ctrl+Shift+S')
         self.actionPref = QtWidgets.QAction('Preference')
         self.actionPref.setShortcut('Ctrl+P')
         self.actionAbout = QtWidgets.QAction('About')
         self.actionExit = QtWidgets.QAction('Exit')
+        self.actionTrace = QtWidgets.QAction('Record Timing')
+        self.actionTrace.setCheckable(True)
+        self.actionTrace.setChecked(prefs.is_trace)
+        self.actionTrace.setToolTip('Time the load, transform, concat, plot and save steps')
+        self.actionSaveTrace = QtWidgets.QAction('Save Timing Trace...')
+        self.actionUndo = QtWidgets.QAction('Undo')
+        self.actionUndo.setShortcut('Ctrl+Z')
+        self.actionUndo.setEnabled(False)
+        self.actionRedo = QtWidgets.QAction('Redo')
+        self.actionRedo.setShortcuts(['Ctrl+Shift+Z', 'Ctrl+Y'])
+        self.actionRedo.setEnabled(False)
         menuFile = self.addMenu('&Program')
+        menuFile.addAction(self.actionOpenSession)
+        menuFile.addAction(self.actionSaveSession)
         menuFile.addAction(self.actionPref)
         menuFile.addAction(self.actionAbout)
         menuFile.addAction(self.actionExit)
+        menuEdit = self.addMenu('&Edit')
+        menuEdit.addAction(self.actionUndo)
+        menuEdit.addAction(self.actionRedo)
+        menuTools = self.addMenu('&Tools')
+        menuTools.addAction(self.actionTrace)
+        menuTools.addAction(self.actionSaveTrace)
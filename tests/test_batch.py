@@ -0,0 +1,64 @@
+#! encoding = utf-8
+
+""" Tests of the batch command line tool """
+
+import json
+import os
+import pytest
+from PyConcat import batch
+from PyConcat.libs import engine
+
+
+def _manifest(tmp_path, content):
+    f = tmp_path / 'manifest.json'
+    f.write_text(json.dumps(content))
+    return str(f)
+
+
+def test_load_manifest(tmp_path):
+    f = _manifest(tmp_path, {
+        'defaults': {'avg2': 2, 'fmtY': '%.6e'},
+        'jobs': [
+            {'file1': 'a.txt', 'file2': 'b.txt', 'output': 'ab.txt', 'scale2': 1.2},
+            {'files': ['c.txt', {'file': 'd.txt', 'avg': 2}], 'output': 'cd.txt',
+             'match': True},
+        ]})
+    jobs = batch.load_manifest(f)
+    assert len(jobs) == 2
+    root = str(tmp_path)
+    assert jobs[0]['file1'] == os.path.join(root, 'a.txt')
+    assert jobs[0]['output'] == os.path.join(root, 'ab.txt')
+    assert jobs[0]['avg2'] == 2
+    assert jobs[0]['scale2'] == 1.2
+    assert jobs[0]['fmtY'] == '%.6e'
+    assert jobs[0]['grid'] == engine.GRID_EXACT
+    assert jobs[1]['files'] == [
+        {'file': os.path.join(root, 'c.txt'), 'avg': 1, 'scale': 1., 'yshift': 0.},
+        {'file': os.path.join(root, 'd.txt'), 'avg': 2, 'scale': 1., 'yshift': 0.}]
+    assert jobs[1]['match']
+
+
+def test_manifest_as_a_list(tmp_path):
+    f = _manifest(tmp_path, [{'file1': 'a.txt', 'file2': 'b.txt', 'output': 'ab.txt'}])
+    job, = batch.load_manifest(f)
+    assert job['avg1'] == 1
+
+
+def test_missing_manifest(tmp_path):
+    with pytest.raises(OSError):
+        batch.load_manifest(str(tmp_path / 'missing.json'))
+
+
+def test_missing_file(tmp_path):
+    f = _manifest(tmp_path, [{'file1': 'a.txt', 'output': 'ab.txt'}])
+    with pytest.raises(ValueError, match='file2'):
+        batch.load_manifest(f)
+
+
+@pytest.mark.parametrize('job', [
+    {'file1': 'a.txt', 'file2': 'b.txt', 'output': 'ab.txt', 'scale': 2},
+    {'files': [{'file': 'a.txt', 'scale2': 2}], 'output': 'a2.txt'},
+])
+def test_bad_key(tmp_path, job):
+    with pytest.raises(ValueError):
+        batch.load_manifest(_manifest(tmp_path, [job]))
@@ -0,0 +1,149 @@
+#! encoding = utf-8
+
+""" Tests of the spectrum cache of libs.cache """
+
+import os
+import numpy as np
+import pytest
+from PyConcat.libs import lib
+from PyConcat.libs.cache import SpectrumCache
+
+
+def _write(tmp_path, name, n, seed=0):
+    x = np.arange(n, dtype=float)
+    y = np.random.default_rng(seed).standard_normal(n)
+    f = str(tmp_path / name)
+    np.savetxt(f, np.column_stack((x, y)))
+    return f
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SpectrumCache(str(tmp_path / 'cache'))
+
+
+def _entries(cache):
+    # a fresh instance reads the index saved on disk
+    return SpectrumCache(cache.cache_dir)._load_index()
+
+
+def test_hit_is_a_memory_map(tmp_path, cache):
+    f = _write(tmp_path, 'a.txt', 100)
+    data = cache.load(f)
+    assert not isinstance(data, np.memmap)
+    again = SpectrumCache(cache.cache_dir).load(f)
+    assert isinstance(again, np.memmap)
+    np.testing.assert_array_equal(again, data)
+    np.testing.assert_array_equal(again, lib.load_xy_file(f))
+
+
+def test_changed_source_is_parsed_again(tmp_path, cache):
+    f = _write(tmp_path, 'a.txt', 100)
+    cache.load(f)
+    f = _write(tmp_path, 'a.txt', 120, seed=1)
+    data = cache.load(f)
+    np.testing.assert_array_equal(data, lib.load_xy_file(f))
+    # the outdated entry is dropped
+    assert len(_entries(cache)) == 1
+    assert len([n for n in os.listdir(cache.cache_dir) if n.endswith('.npy')]) == 1
+
+
+def test_same_size_new_mtime(tmp_path, cache):
+    f = _write(tmp_path, 'a.txt', 100)
+    cache.load(f)
+    f = _write(tmp_path, 'a.txt', 100, seed=1)
+    st = os.stat(f)
+    os.utime(f, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    np.testing.assert_array_equal(cache.load(f), lib.load_xy_file(f))
+
+
+def test_lru_eviction(tmp_path, cache):
+    files = [_write(tmp_path, '{:d}.txt'.format(i), 100, seed=i) for i in range(3)]
+    cache.set_max_bytes(2 * 100 * 2 * 8)
+    for f in files[:2]:
+        cache.load(f)
+    # a hit makes the first file the most recently used
+    cache.load(files[0])
+    cache.load(files[2])
+    keys = {k.rsplit('|', 2)[0] for k in _entries(cache)}
+    assert keys == {os.path.abspath(files[0]), os.path.abspath(files[2])}
+
+
+def test_too_large_is_not_cached(tmp_path, cache):
+    f = _write(tmp_path, 'a.txt', 100)
+    cache.set_max_bytes(1000)
+    np.testing.assert_array_equal(cache.load(f), lib.load_xy_file(f))
+    assert not _entries(cache)
+
+
+def test_shrink_and_clear(tmp_path, cache):
+    files = [_write(tmp_path, '{:d}.txt'.format(i), 100, seed=i) for i in range(3)]
+    for f in files:
+        cache.load(f)
+    assert len(_entries(cache)) == 3
+    cache.set_max_bytes(100 * 2 * 8)
+    assert len(_entries(cache)) == 1
+    cache.clear()
+    assert not _entries(cache)
+    assert os.listdir(cache.cache_dir) == ['index.json']
+
+
+def test_disabled(tmp_path):
+    cache = SpectrumCache(str(tmp_path / 'cache'), max_bytes=0)
+    f = _write(tmp_path, 'a.txt', 100)
+    np.testing.assert_array_equal(cache.load(f), lib.load_xy_file(f))
+    assert not os.path.exists(cache.cache_dir)
+
+
+def test_corrupted_entry(tmp_path, cache):
+    f = _write(tmp_path, 'a.txt', 100)
+    cache.load(f)
+    for name in os.listdir(cache.cache_dir):
+        if name.endswith('.npy'):
+            with open(os.path.join(cache.cache_dir, name), 'wb') as fp:
+                fp.write(b'broken')
+    data = SpectrumCache(cache.cache_dir).load(f)
+    np.testing.assert_array_equal(data, lib.load_xy_file(f))
+    # the broken entry is replaced, not looked up again by every process
+    assert len(_entries(cache)) == 1
+    assert isinstance(SpectrumCache(cache.cache_dir).load(f), np.memmap)
+
+
+def test_corrupted_entry_is_deleted(tmp_path, cache):
+    f = _write(tmp_path, 'a.txt', 100)
+    cache.load(f)
+    key, = _entries(cache)
+    os.truncate(os.path.join(cache.cache_dir, SpectrumCache._file_name(key)), 10)
+    assert SpectrumCache(cache.cache_dir)._lookup(key) is None
+    assert not _entries(cache)
+    assert os.listdir(cache.cache_dir) == ['index.json']
+
+
+def test_hits_do_not_write_the_index(tmp_path, cache):
+    f = _write(tmp_path, 'a.txt', 100)
+    cache.load(f)
+    index = os.path.join(cache.cache_dir, 'index.json')
+    atime = _entries(cache)
+    os.remove(index)
+    cache.load(f)
+    assert not os.path.exists(index)
+    cache.close()
+    assert _entries(cache).keys() == atime.keys()
+    key, = atime
+    assert _entries(cache)[key]['atime'] > atime[key]['atime']
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_load_many(tmp_path, cache, workers):
+    files = [_write(tmp_path, '{:d}.txt'.format(i), 100, seed=i) for i in range(3)]
+    bad = str(tmp_path / 'missing.txt')
+    cache.load(files[0])
+    datas, errors = cache.load_many(files + [bad], workers=workers)
+    for f, data in zip(files, datas):
+        np.testing.assert_array_equal(data, lib.load_xy_file(f))
+    assert datas[-1] is None
+    assert [e[0] for e in errors] == [bad]
+    assert len(_entries(cache)) == 3
+    datas, errors = SpectrumCache(cache.cache_dir).load_many(files, workers=workers)
+    assert all(isinstance(data, np.memmap) for data in datas)
+    assert not errors
@@ -0,0 +1,256 @@
+#! encoding = utf-8
+
+""" Tests of the concatenation engine of libs.engine """
+
+import numpy as np
+import pytest
+from PyConcat.libs import engine
+
+
+def _flat(x0, x1, y):
+    x = np.arange(x0, x1 + 1, dtype=float)
+    return x, np.full(len(x), float(y))
+
+
+@pytest.mark.parametrize('spec1, spec2, x, y', [
+    # 1 then 2
+    ((0, 5, 1), (3, 8, 3), np.arange(9.), [1, 1, 1, 1, 2, 3, 3, 3, 3]),
+    # 2 then 1
+    ((3, 8, 1), (0, 5, 3), np.arange(9.), [3, 3, 3, 3, 2, 1, 1, 1, 1]),
+    # 2 inside 1
+    ((0, 8, 1), (3, 6, 3), np.arange(9.), [1, 1, 1, 1, 2, 2, 1, 1, 1]),
+    # 1 inside 2
+    ((3, 6, 1), (0, 8, 3), np.arange(9.), [3, 3, 3, 3, 2, 2, 3, 3, 3]),
+    # same range, the bounds are taken from 2
+    ((0, 4, 1), (0, 4, 3), np.arange(5.), [3, 2, 2, 2, 3]),
+    # no overlap
+    ((0, 2, 1), (5, 7, 3), np.array([0., 1, 2, 5, 6, 7]), [1, 1, 1, 3, 3, 3]),
+])
+def test_overlap_orderings(spec1, spec2, x, y):
+    x1, y1 = _flat(*spec1)
+    x2, y2 = _flat(*spec2)
+    xt, yt, _, _ = engine.concat(x1, y1, x2, y2)
+    np.testing.assert_array_equal(xt, x)
+    np.testing.assert_array_equal(yt, y)
+
+
+def test_weights_and_shifts():
+    x1, y1 = _flat(0, 5, 1)
+    x2, y2 = _flat(3, 8, 3)
+    xt, yt, x_cat, y_cat = engine.concat(x1, y1, x2, y2, avg1=1, avg2=3, yshift2=1.)
+    np.testing.assert_array_equal(xt, np.arange(9.))
+    np.testing.assert_array_equal(yt, [1, 1, 1, 1, 3.25, 4, 4, 4, 4])
+    np.testing.assert_array_equal(x_cat, [4.])
+    np.testing.assert_array_equal(y_cat, [3.25])
+
+
+def test_scale_around_the_median():
+    x1 = np.arange(6.)
+    y1 = np.array([1., 2, 3, 3, 4, 5])
+    x2, y2 = _flat(3, 7, 0)
+    xt, yt, _, _ = engine.concat(x1, y1, x2, y2, scale1=2.)
+    # 2 * (y1 - 3) + 3, averaged with 0 at x = 4
+    np.testing.assert_array_equal(xt, np.arange(8.))
+    np.testing.assert_array_equal(yt, [-1, 1, 3, 3, 2.5, 0, 0, 0])
+
+
+def test_replace():
+    x1, y1 = _flat(0, 8, 1)
+    x2, y2 = _flat(3, 6, 3)
+    xt, yt, _, _ = engine.concat(x1, y1, x2, y2, replace=True)
+    np.testing.assert_array_equal(xt, np.arange(9.))
+    np.testing.assert_array_equal(yt, [1, 1, 1, 1, 3, 3, 1, 1, 1])
+
+
+def test_exact_grid_different_dimensions():
+    x1, y1 = _flat(0, 5, 1)
+    x2 = np.array([3., 3.5, 4, 4.5, 6])
+    with pytest.raises(ValueError, match='dimensions'):
+        engine.concat(x1, y1, x2, x2)
+
+
+def test_empty_spectrum():
+    x1, y1 = _flat(0, 5, 1)
+    with pytest.raises(ValueError, match='loaded'):
+        engine.concat(x1, y1, np.zeros(0), np.zeros(0))
+
+
+def _old_concat(x1, y1, x2, y2, avg1, avg2, scale1, scale2, yshift1, yshift2, replace):
+    """ Concatenation of ctrl_main before the engine was split out """
+    y1 = (y1 - np.median(y1)) * scale1 + np.median(y1) + yshift1
+    y2 = (y2 - np.median(y2)) * scale2 + np.median(y2) + yshift2
+    xo_min, xo_max = engine.find_overlap_range(x1.min(), x1.max(), x2.min(), x2.max())
+    in1 = (x1 > xo_min) & (x1 < xo_max)
+    in2 = (x2 > xo_min) & (x2 < xo_max)
+    if x1.min() < xo_min:
+        x_left, y_left = x1[x1 <= xo_min], y1[x1 <= xo_min]
+    else:
+        x_left, y_left = x2[x2 <= xo_min], y2[x2 <= xo_min]
+    if x1.max() > xo_max:
+        x_right, y_right = x1[x1 >= xo_max], y1[x1 >= xo_max]
+    else:
+        x_right, y_right = x2[x2 >= xo_max], y2[x2 >= xo_max]
+    if replace:
+        x_cat, y_cat = x2[in2], y2[in2]
+    else:
+        x_cat = x1[in1]
+        y_cat = (y1[in1] * avg1 + y2[in2] * avg2) / (avg1 + avg2)
+    return np.concatenate((x_left, x_cat, x_right)), np.concatenate((y_left, y_cat, y_right))
+
+
+def test_same_as_before_the_engine():
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        n1, n2 = rng.integers(1, 30, 2)
+        o1, o2 = rng.integers(-20, 20, 2)
+        x1 = o1 + np.arange(n1, dtype=float)
+        x2 = o2 + np.arange(n2, dtype=float)
+        y1 = rng.standard_normal(n1)
+        y2 = rng.standard_normal(n2)
+        kwargs = dict(avg1=int(rng.integers(1, 4)), avg2=int(rng.integers(1, 4)),
+                      scale1=rng.choice([1, 1.5]), scale2=rng.choice([1, 0.5]),
+                      yshift1=rng.choice([0, 0.3]), yshift2=rng.choice([0, -2.]),
+                      replace=bool(rng.random() < 0.3))
+        xt, yt, _, _ = engine.concat(x1, y1, x2, y2, **kwargs)
+        x_old, y_old = _old_concat(x1, y1, x2, y2, **kwargs)
+        np.testing.assert_array_equal(xt, x_old)
+        np.testing.assert_allclose(yt, y_old, rtol=1e-12, atol=1e-12)
+
+
+def _line(x):
+    return 2 * x - 1
+
+
+@pytest.mark.parametrize('x_new', [
+    np.array([0., 0.25, 1.5, 2.75, 9.]),
+    # outside of the data, extrapolated from the end segments
+    np.array([-3., -0.5, 9.5, 12.]),
+    np.array([9., 4.2, 0.1]),
+])
+def test_resample_linear(x_new):
+    x = np.array([0., 1., 2., 4., 7., 9.])
+    np.testing.assert_allclose(engine.resample(x_new, x, _line(x)), _line(x_new))
+    # a descending input
+    np.testing.assert_allclose(engine.resample(x_new, x[::-1], _line(x[::-1])), _line(x_new))
+
+
+def test_resample_duplicates_and_single_point():
+    x = np.array([0., 1., 1., 2.])
+    y = np.array([0., 1., 3., 3.])
+    np.testing.assert_allclose(engine.resample(np.array([0.5, 1., 1.5]), x, y), [0.5, 3., 3.])
+    np.testing.assert_array_equal(engine.resample(np.arange(3.), x[:1], y[:1] + 5), [5, 5, 5])
+    with pytest.raises(ValueError):
+        engine.resample(np.arange(3.), x[:0], y[:0])
+
+
+@pytest.mark.parametrize('xmin, xmax, step, expected', [
+    (0., 1., 0.25, [0.25, 0.5, 0.75]),
+    # a step that does not divide the range
+    (0., 1., 0.3, [0.3, 0.6, 0.9]),
+    (2., 3., 0.4, [2.4, 2.8]),
+    (0., 1., 2., []),
+])
+def test_uniform_grid(xmin, xmax, step, expected):
+    np.testing.assert_allclose(engine.uniform_grid(xmin, xmax, step), expected)
+
+
+@pytest.mark.parametrize('step', [0., -1.])
+def test_uniform_grid_bad_step(step):
+    with pytest.raises(ValueError):
+        engine.uniform_grid(0., 1., step)
+
+
+def _grid_case():
+    x1 = np.arange(0., 10.)
+    x2 = np.arange(5.5, 15., 0.5)
+    return x1, _line(x1), x2, _line(x2) + 4
+
+
+@pytest.mark.parametrize('grid, step, x_cat', [
+    (engine.GRID_FILE1, 0., np.arange(6., 9.)),
+    (engine.GRID_FILE2, 0., np.arange(6., 9., 0.5)),
+    (engine.GRID_STEP, 0.7, 5.5 + 0.7 * np.arange(1, 5)),
+])
+def test_grids_on_linear_data(grid, step, x_cat):
+    x1, y1, x2, y2 = _grid_case()
+    xt, yt, xc, yc = engine.concat(x1, y1, x2, y2, avg1=3, avg2=1, grid=grid, step=step)
+    np.testing.assert_allclose(xc, x_cat)
+    # 3 parts of y1 for 1 part of y2, on any grid
+    np.testing.assert_allclose(yc, _line(x_cat) + 1)
+    assert np.all(np.diff(xt) > 0)
+    left = xt <= 5.5
+    right = xt >= 9
+    np.testing.assert_array_equal(xt[left], x1[x1 <= 5.5])
+    np.testing.assert_array_equal(yt[left], y1[x1 <= 5.5])
+    np.testing.assert_array_equal(xt[right], x2[x2 >= 9])
+    np.testing.assert_array_equal(yt[right], y2[x2 >= 9])
+    np.testing.assert_allclose(yt[~left & ~right], yc)
+
+
+def test_unknown_grid():
+    x1, y1, x2, y2 = _grid_case()
+    with pytest.raises(ValueError, match='grid'):
+        engine.concat(x1, y1, x2, y2, grid='spline')
+
+
+def _match_case(params, ym, noise=0., seed=0):
+    """ Segments on a common integer grid, which give the same curve once
+    transformed by params, as a * (y - ym) + ym + b """
+    rng = np.random.default_rng(seed)
+    segments = []
+    for j, ((a, b), m) in enumerate(zip(params, ym)):
+        x = np.arange(60. * j, 60. * j + 100.)
+        f = np.sin(x / 7) + 0.01 * x
+        y = (f - m - b) / a + m + noise * rng.standard_normal(len(x))
+        segments.append((x, y))
+    return segments
+
+
+@pytest.mark.parametrize('ref', [0, 2])
+def test_match_segments_recovers_the_transforms(ref):
+    params = [(1., 0.), (2., 0.5), (0.5, -1.), (1.3, 3.)]
+    ym = [0.1, -0.2, 0.3, 0.]
+    segments = _match_case(params, ym)
+    segments[ref] = segments[ref] + (1,) + params[ref]
+    found = engine.match_segments(segments, ref=ref, ym=ym)
+    np.testing.assert_allclose(found, params, rtol=1e-9, atol=1e-9)
+
+
+def test_match_segments_with_noise():
+    params = [(1., 0.), (2., 0.5), (0.5, -1.)]
+    segments = _match_case(params, [0.] * 3, noise=1e-3)
+    found = engine.match_segments(segments)
+    # the medians are computed, so compare the transformed spectra
+    for (x, y), (a, b) in zip(segments, found):
+        m = np.median(y)
+        np.testing.assert_allclose(a * (y - m) + m + b, np.sin(x / 7) + 0.01 * x, atol=0.02)
+
+
+def test_match_scale():
+    x1 = np.arange(100.)
+    y1 = np.sin(x1 / 5)
+    x2 = np.arange(50., 150.)
+    y2 = (np.sin(x2 / 5) - 0.25) / 2
+    scale2, yshift2 = engine.match_scale(x1, y1, x2, y2, ym1=0., ym2=0.)
+    assert scale2 == pytest.approx(2.)
+    assert yshift2 == pytest.approx(0.25)
+
+
+@pytest.mark.parametrize('starts', [
+    (0, 200),           # no overlap
+    (0, 60, 300),       # the third spectrum is not connected
+])
+def test_match_segments_without_overlap(starts):
+    segments = []
+    for x0 in starts:
+        x = np.arange(x0, x0 + 100.)
+        segments.append((x, np.sin(x / 7)))
+    with pytest.raises(ValueError, match='overlap'):
+        engine.match_segments(segments)
+
+
+def test_match_flat_spectrum():
+    x1 = np.arange(100.)
+    x2 = np.arange(50., 150.)
+    with pytest.raises(ValueError):
+        engine.match_scale(x1, np.sin(x1), x2, np.ones(100))
@@ -0,0 +1,105 @@
+#! encoding = utf-8
+
+""" Tests of the undo/redo history of libs.history """
+
+import time
+import numpy as np
+import pytest
+from PyConcat.libs.history import History
+
+MB = 1024 ** 2
+
+
+def _state(*arrays):
+    return {'arrays': list(arrays), 'scale': 1.}
+
+
+def test_undo_redo():
+    h = History()
+    assert h.undo() is None and h.redo() is None
+    states = [_state(), _state(), _state()]
+    h.push(states[0])
+    h.push(states[1], 'Load')
+    h.push(states[2], 'Concatenate')
+    assert h.undo_label() == 'Concatenate' and h.redo_label() == ''
+    assert h.undo() is states[1]
+    assert h.undo_label() == 'Load' and h.redo_label() == 'Concatenate'
+    assert h.undo() is states[0]
+    assert not h.can_undo() and h.undo() is None
+    assert h.redo() is states[1]
+    # a new operation drops the redo states
+    new = _state()
+    h.push(new, 'Scale')
+    assert not h.can_redo() and len(h) == 3
+    assert h.undo() is states[1]
+
+
+def test_merge_and_amend():
+    h = History()
+    h.push(_state())
+    for _ in range(3):
+        h.push(_state(), 'Preview', merge=True)
+    assert len(h) == 2
+    h.push(_state(), 'Load')
+    last = _state()
+    h.amend(last)
+    assert len(h) == 3 and h.undo_label() == 'Load'
+    h.undo()
+    assert h.redo() is last
+
+
+def test_shared_buffers_are_counted_once():
+    h = History()
+    a = np.zeros(MB // 8)
+    b = np.zeros(MB // 8)
+    h.push(_state(a, b))
+    # a view and the array itself share a buffer with the current state
+    h.push(_state(a[::2], b))
+    assert h.nbytes() == 0
+    h.push(_state(np.zeros(10)))
+    assert h.nbytes() == 2 * MB
+    h.undo()
+    assert h.nbytes() == 80
+
+
+def test_budget_evicts_the_oldest_states():
+    h = History(max_bytes=3 * MB)
+    arrays = [np.full(MB // 8, float(i)) for i in range(6)]
+    for i, a in enumerate(arrays):
+        h.push(_state(a), str(i))
+    # the current state and 3 others fit
+    assert len(h) == 4 and h.nbytes() == 3 * MB
+    assert [h.undo()['arrays'][0][0] for _ in range(3)] == [4., 3., 2.]
+    assert not h.can_undo()
+    # the farthest redo states go when nothing older is left
+    h.set_max_bytes(MB)
+    assert len(h) == 2 and h.redo()['arrays'][0][0] == 3.
+
+
+def test_mapped_buffers_are_free(tmp_path):
+    f = str(tmp_path / 'a.npy')
+    np.save(f, np.zeros(MB // 8))
+    h = History(max_bytes=1)
+    for _ in range(4):
+        h.push(_state(np.load(f, mmap_mode='r')))
+    assert len(h) == 4 and h.nbytes() == 0
+    # no budget, no history, even of mapped states
+    h.set_max_bytes(0)
+    assert len(h) == 1 and not h.can_undo()
+    h.push(_state(np.load(f, mmap_mode='r')))
+    assert len(h) == 1
+
+
+def test_eviction_is_linear():
+    h = History(max_bytes=1)
+    arrays = [np.zeros(1) for _ in range(2000)]
+    t0 = time.perf_counter()
+    for a in arrays[:1000]:
+        h.push(_state(a, *arrays[:50]))
+    assert len(h) == 1
+    h = History(max_bytes=1024 ** 3)
+    for a in arrays:
+        h.push(_state(a, *arrays[:50]))
+    h.set_max_bytes(1)
+    assert len(h) == 1
+    assert time.perf_counter() - t0 < 5
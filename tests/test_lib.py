@@ -0,0 +1,264 @@
+#! encoding = utf-8
+
+""" Tests of the format sniffing, text parser, parallel loading and
+exporter of libs.lib """
+
+import os
+import numpy as np
+import pytest
+from PyConcat.libs import lib
+
+
+@pytest.fixture(params=[True, False], ids=['loadtxt', 'fromstring'])
+def parser(request, monkeypatch):
+    """ Run a test with both block parsers """
+    monkeypatch.setattr(lib, '_LOADTXT_C', request.param)
+    return request.param
+
+
+def _write(tmp_path, content, name='data.txt'):
+    f = tmp_path / name
+    f.write_bytes(content)
+    return str(f)
+
+
+@pytest.mark.parametrize('content', [
+    b'1,2\n3\n4,5,6\n',
+    b'1 2\n3 4 5\n',
+    b'1;2\n3;4;5\n6\n',
+])
+def test_ragged_rows_are_rejected(tmp_path, parser, content):
+    f = _write(tmp_path, content)
+    with pytest.raises(ValueError):
+        lib.load_xy_file(f)
+    with pytest.raises(ValueError):
+        list(lib.iter_xy_blocks(f))
+    with pytest.raises(ValueError):
+        lib.load_xy_file(f, progress=lambda done, total: True)
+
+
+@pytest.mark.parametrize('content, expected', [
+    (b'1,2\n3,4\n', [[1, 2], [3, 4]]),
+    (b'1,2,\n3,4,\n', [[1, 2], [3, 4]]),
+    (b'# comment\n1,2 # end\n\n3,4\n', [[1, 2], [3, 4]]),
+    (b'x,y\n1;2,5\n3;4\n', [[1, 2.5], [3, 4]]),
+    (b'freq\tint\n3\t4\n1\t2\n', [[1, 2], [3, 4]]),
+])
+def test_formats(tmp_path, parser, content, expected):
+    f = _write(tmp_path, content)
+    np.testing.assert_array_equal(lib.load_xy_file(f), expected)
+    np.testing.assert_array_equal(
+        lib.load_xy_file(f, progress=lambda done, total: True), expected)
+
+
+def test_blocks_match_loadtxt(tmp_path, parser):
+    rng = np.random.default_rng(0)
+    data = np.column_stack((np.arange(20000) * 0.5, rng.normal(size=20000)))
+    f = str(tmp_path / 'data.csv')
+    np.savetxt(f, data, fmt='%.6f', delimiter=',', header='x,y', comments='')
+    expected = np.loadtxt(f, delimiter=',', skiprows=1)
+    spec = lib.sniff_format(f)
+    assert spec.n_header == 1
+    np.testing.assert_array_equal(lib._load_txt(f, spec, chunk_size=4096), expected)
+    np.testing.assert_array_equal(
+        lib._load_txt(f, spec, chunk_size=4096, progress=lambda done, total: True), expected)
+    blocks = list(lib.iter_xy_blocks(f, chunk_size=4096))
+    assert len(blocks) > 1
+    np.testing.assert_array_equal(np.concatenate([x for x, _ in blocks]), expected[:, 0])
+    np.testing.assert_array_equal(np.concatenate([y for _, y in blocks]), expected[:, 1])
+
+
+@pytest.mark.parametrize('fmt, delimiter, newline, header', [
+    ('%.6f', ',', '\n', 'x,y'),
+    ('%.17g', '\t', '\n', ''),
+    ('%.8e', ' ', '\r\n', 'freq int'),
+    ('%.3f', ';', '\n', '# a comment'),
+    ('%d', ' ', '\n', ''),
+])
+def test_whole_file_and_blocks_are_identical(tmp_path, fmt, delimiter, newline, header):
+    """ load_xy_file parses the whole file with np.loadtxt, and by blocks
+    when progress is asked for. Both give the same array """
+    rng = np.random.default_rng(1)
+    data = np.column_stack((np.arange(20000) * 0.37, rng.standard_normal(20000) * 1e3))
+    f = str(tmp_path / 'data.txt')
+    np.savetxt(f, data, fmt=fmt, delimiter=delimiter, newline=newline, header=header,
+               comments='')
+    spec = lib.sniff_format(f)
+    whole = lib._load_txt(f, spec)
+    blocks = lib._load_txt(f, spec, chunk_size=4096, progress=lambda done, total: True)
+    assert whole.shape == (20000, 2)
+    np.testing.assert_array_equal(blocks, whole)
+
+
+def test_cancel(tmp_path):
+    f = _write(tmp_path, b'1 2\n' * 10000)
+    spec = lib.sniff_format(f)
+    with pytest.raises(lib.LoadCancelled):
+        lib._load_txt(f, spec, chunk_size=1024, progress=lambda done, total: False)
+
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_load_xy_files(tmp_path, workers):
+    rng = np.random.default_rng(0)
+    files = []
+    for i in range(4):
+        data = np.column_stack((np.sort(rng.random(500)), rng.random(500)))
+        files.append(str(tmp_path / '{:d}.txt'.format(i)))
+        np.savetxt(files[-1], data)
+    np.save(str(tmp_path / 'b.npy'), data)
+    files.append(str(tmp_path / 'b.npy'))
+    bad = _write(tmp_path, b'1 2\n3\n', name='bad.txt')
+    tmp_dir = tmp_path / 'tmp'
+    tmp_dir.mkdir()
+    reported = []
+    datas, errors = lib.load_xy_files(files + [bad], workers=workers, tmp_dir=str(tmp_dir),
+                                      progress=lambda done, total: reported.append((done, total)))
+    for f, data in zip(files, datas):
+        np.testing.assert_array_equal(data, lib.load_xy_file(f))
+    assert datas[-1] is None
+    assert [e[0] for e in errors] == [bad]
+    assert reported[-1] == (6, 6)
+    # the parsed files are mapped and deleted
+    del datas
+    assert not os.listdir(str(tmp_dir))
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_load_xy_files_cancel(tmp_path, workers):
+    files = [_write(tmp_path, b'1 2\n3 4\n', name='{:d}.txt'.format(i)) for i in range(6)]
+    tmp_dir = tmp_path / 'tmp'
+    tmp_dir.mkdir()
+    with pytest.raises(lib.LoadCancelled):
+        lib.load_xy_files(files, workers=workers, tmp_dir=str(tmp_dir),
+                          progress=lambda done, total: done < 2)
+    assert not os.listdir(str(tmp_dir))
+
+def test_no_data(tmp_path, parser):
+    with pytest.raises(ValueError):
+        lib.load_xy_file(_write(tmp_path, b'# nothing\n'))
+
+
+def test_descending_data_is_reversed(tmp_path):
+    f = _write(tmp_path, b'3 30\n2 20\n1 10\n')
+    data, order = lib.load_xy_file(f, return_order=True)
+    assert order == lib.ORDER_DESCENDING
+    np.testing.assert_array_equal(data, [[1, 10], [2, 20], [3, 30]])
+
+
+@pytest.mark.parametrize('content, spec', [
+    (b'1,5;2,5\n3,5;4,5\n', (';', 0, 2, ',')),
+    (b'1,5\t2,5\t7\n', ('\t', 0, 3, ',')),
+    (b'Frequency Intensity\n-1,5e3 2,5\n', (' ', 1, 2, ',')),
+    (b'1,5 2,5\n', (' ', 0, 2, ',')),
+    # a comma between dots is a delimiter
+    (b'1.5,2.5\n', (',', 0, 2, '.')),
+    (b'1,2\n', (',', 0, 2, '.')),
+])
+def test_sniff_format(tmp_path, content, spec):
+    assert lib.sniff_format(_write(tmp_path, content)) == spec
+
+
+def test_decimal_comma(tmp_path, parser):
+    f = _write(tmp_path, b'x;y\n1,5;-2,25\n3,5;4e-1\n')
+    np.testing.assert_array_equal(lib.load_xy_file(f), [[1.5, -2.25], [3.5, 0.4]])
+
+
+@pytest.fixture
+def sniffs(monkeypatch):
+    """ Count the files sniffed from scratch """
+    calls = []
+    sniff = lib._sniff_lines
+
+    def counted(lines, maxrow, file_name=''):
+        calls.append(file_name)
+        return sniff(lines, maxrow, file_name)
+
+    monkeypatch.setattr(lib, '_sniff_lines', counted)
+    return calls
+
+
+def test_format_cache_reuses_the_directory_format(tmp_path, sniffs):
+    cache = lib.FormatCache()
+    header = b'freq,int\n'
+    f1 = _write(tmp_path, header + b'1.0,2.0\n3.0,4.0\n', 'a.csv')
+    f2 = _write(tmp_path, header + b'5.5,6.5\n', 'b.csv')
+    spec = cache.get(f1)
+    assert spec == (',', 1, 2, '.')
+    assert cache.get(f2) == spec
+    assert cache.get(f1) == spec
+    assert sniffs == [f1]
+
+
+@pytest.mark.parametrize('content', [
+    b'5.5\t6.5\n',                          # another delimiter
+    b'freq\tint\n5.5\t6.5\n',              # another delimiter
+    b'5.5,6.5\n',                            # no header
+    b'title\nfreq,int\n5.5,6.5\n',          # two header rows
+    b'freq,int\n5.5,6.5,7.5\n',             # three columns
+    b'freq;int\n5,5;6,5\n',                 # decimal comma
+])
+def test_format_cache_rejects_another_format(tmp_path, sniffs, content):
+    cache = lib.FormatCache()
+    f1 = _write(tmp_path, b'freq,int\n1.0,2.0\n', 'a.csv')
+    f2 = _write(tmp_path, content, 'b.csv')
+    cache.get(f1)
+    spec = cache.get(f2)
+    assert sniffs == [f1, f2]
+    assert spec == lib.sniff_format(f2)
+    assert spec != lib.sniff_format(f1)
+
+
+def test_format_cache_sees_a_changed_file(tmp_path):
+    cache = lib.FormatCache()
+    f = _write(tmp_path, b'1.0,2.0\n')
+    assert cache.get(f).delimiter == ','
+    f = _write(tmp_path, b'1.0\t2.0\t3.0\n')
+    assert cache.get(f) == ('\t', 0, 3, '.')
+
+
+@pytest.mark.parametrize('fmtX, fmtY', [('%.3f', '%.3f'), ('%.6e', '%g'), ('%d', '%r')])
+@pytest.mark.parametrize('workers', [1, 2])
+def test_export_matches_savetxt(tmp_path, fmtX, fmtY, workers):
+    rng = np.random.default_rng(0)
+    x = np.sort(rng.uniform(-1e3, 1e3, 1000))
+    y = rng.standard_normal(1000)
+    f = str(tmp_path / 'out.txt')
+    ref = str(tmp_path / 'ref.txt')
+    lib.save_xy_file(f, x, y, fmtX, fmtY, workers=workers, chunk_rows=64)
+    np.savetxt(ref, np.column_stack((x, y)), fmt=[fmtX, fmtY])
+    with open(f, 'rb') as a, open(ref, 'rb') as b:
+        assert a.read() == b.read()
+
+
+@pytest.mark.parametrize('dtype1, dtype2', [
+    (np.int64, np.int64),
+    (np.float32, np.float32),
+    (np.int32, np.float64),
+    (np.float32, np.float64),
+])
+@pytest.mark.parametrize('fmt', ['%s', '%r', '%.3f', '%d', '%10.4g'])
+def test_export_keeps_the_dtype(tmp_path, dtype1, dtype2, fmt):
+    x = np.arange(50).astype(dtype1)
+    y = (np.arange(50) / 3).astype(dtype2)
+    f = str(tmp_path / 'out.txt')
+    ref = str(tmp_path / 'ref.txt')
+    lib.save_xy_file(f, x, y, fmt, fmt, chunk_rows=16)
+    np.savetxt(ref, np.column_stack((x, y)), fmt=[fmt, fmt])
+    with open(f, 'rb') as a, open(ref, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_export_blocks(tmp_path):
+    x = np.arange(10.)
+    f = str(tmp_path / 'out.txt')
+    lib.save_xy_blocks(f, [(x[:0], x[:0]), (x[:4], x[:4]), (x[4:], -x[4:])])
+    np.testing.assert_array_equal(np.loadtxt(f), np.column_stack((x, np.where(x < 4, x, -x))))
+    lib.save_xy_blocks(f, [])
+    assert (tmp_path / 'out.txt').read_bytes() == b''
+
+
+def test_export_bad_format(tmp_path):
+    f = str(tmp_path / 'out.txt')
+    with pytest.raises(TypeError):
+        lib.save_xy_file(f, np.arange(3.), np.arange(3.), '%s %d', '%d')
@@ -0,0 +1,97 @@
+#! encoding = utf-8
+
+""" Tests of the level-of-detail pyramids of libs.lod """
+
+import numpy as np
+import pytest
+from PyConcat.libs import lod
+
+
+def _data(n, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.cumsum(rng.uniform(0.5, 1.5, n))
+    return x, rng.standard_normal(n)
+
+
+@pytest.mark.parametrize('block_bins', [lod._BLOCK_BINS, 7])
+def test_levels_keep_the_bin_extremes(monkeypatch, block_bins):
+    monkeypatch.setattr(lod, '_BLOCK_BINS', block_bins)
+    x, y = _data(300001)
+    pyramid = lod.MinMaxPyramid(x, y)
+    assert len(pyramid.levels) >= 3
+    size = lod._BASE
+    for xs, mn, mx in pyramid.levels:
+        n_bins = -(-len(x) // size)
+        assert len(xs) == len(mn) == len(mx) == n_bins
+        np.testing.assert_array_equal(xs, x[::size])
+        full = len(x) // size * size
+        np.testing.assert_array_equal(mn[:full // size], y[:full].reshape(-1, size).min(axis=1))
+        np.testing.assert_array_equal(mx[:full // size], y[:full].reshape(-1, size).max(axis=1))
+        # the incomplete bin at the end
+        assert mn[-1] == y[full:].min() and mx[-1] == y[full:].max()
+        size *= lod._FACTOR
+    assert pyramid.limits() == (y.min(), y.max())
+
+
+def test_small_data_has_no_level():
+    x, y = _data(1000)
+    pyramid = lod.MinMaxPyramid(x, y)
+    assert not pyramid.levels
+    assert pyramid.limits() == (y.min(), y.max())
+    assert pyramid.xrange() == (x[0], x[-1])
+    empty = lod.MinMaxPyramid(np.zeros(0), np.zeros(0))
+    assert empty.limits() is None and empty.xrange() is None
+
+
+@pytest.mark.parametrize('span', [
+    300,        # raw points
+    20000,      # reduced on the fly
+    250000,     # from a level
+])
+def test_view_includes_its_edges(span):
+    x, y = _data(300001, seed=1)
+    pyramid = lod.MinMaxPyramid(x, y)
+    xmin = x[1234] + 0.1
+    xmax = xmin + span
+    x_out, y_out = pyramid.get(xmin, xmax, 100)
+    assert np.all(np.diff(x_out) >= 0)
+    # one point or bin on each side, to draw the lines to the view edges
+    assert x_out[0] <= xmin and x_out[-1] >= xmax
+    # every peak in view is drawn
+    view = (x >= xmin) & (x <= xmax)
+    assert y_out.max() >= y[view].max()
+    assert y_out.min() <= y[view].min()
+    assert y_out.max() <= y.max() and y_out.min() >= y.min()
+
+
+def test_view_of_raw_points():
+    x, y = _data(1000)
+    pyramid = lod.MinMaxPyramid(x, y)
+    x_out, y_out = pyramid.get(x[10] + 0.01, x[20] - 0.01, 100)
+    np.testing.assert_array_equal(x_out, x[10:21])
+    np.testing.assert_array_equal(y_out, y[10:21])
+    # outside of the data
+    x_out, _ = pyramid.get(x[-1] + 10, x[-1] + 20, 100)
+    np.testing.assert_array_equal(x_out, x[-1:])
+
+
+def test_segmented_pyramid():
+    x1, y1 = _data(50000, seed=2)
+    x2 = x1[-1] + 1 + np.arange(20000.)
+    y2 = np.random.default_rng(3).standard_normal(20000)
+    pyramid = lod.SegmentedPyramid([(x1, y1, 1., 0.), (x2, y2, 2., 1.)])
+    assert len(pyramid) == 70000
+    assert pyramid.xrange() == (x1[0], x2[-1])
+    assert pyramid.limits() == [(y1.min(), y1.max()), (y2.min(), y2.max())]
+    x_out, y_out = pyramid.get(x1[0], x2[-1], 200)
+    assert x_out[0] == x1[0] and np.all(np.diff(x_out) >= 0)
+    assert y_out.max() == max(y1.max(), 2 * y2.max() + 1)
+    assert y_out.min() == min(y1.min(), 2 * y2.min() + 1)
+    # a view of the second segment only, transformed
+    x_out, y_out = pyramid.get(x2[10], x2[50], 200)
+    np.testing.assert_array_equal(x_out, x2[9:52])
+    np.testing.assert_array_equal(y_out, 2 * y2[9:52] + 1)
+    # the pyramids of unchanged segments are shared
+    again = lod.SegmentedPyramid([(x1, y1, 3., 0.), (x2, y2 + 1, 1., 0.)], reuse=pyramid)
+    assert again.parts[0][0] is pyramid.parts[0][0]
+    assert again.parts[1][0] is not pyramid.parts[1][0]
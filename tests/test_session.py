@@ -0,0 +1,77 @@
+#! encoding = utf-8
+
+""" Tests of the session files of libs.session """
+
+import numpy as np
+import pytest
+from PyConcat.libs import engine, session
+from PyConcat.libs.lod import MinMaxPyramid
+
+
+def _curves():
+    x1 = np.linspace(0, 10, 5000)
+    y1 = np.sin(x1)
+    x2 = np.linspace(8, 20, 3000, dtype=np.float32)
+    y2 = np.cos(x2)
+    plan = engine.plan_concat(x1, y1, x2.astype(float), y2.astype(float),
+                              grid=engine.GRID_FILE1)
+    return {'file1': (x1, y1, None, MinMaxPyramid(x1, y1)),
+            'file2': (x2, y2, (-1., 1., 0.), None),
+            'result': (plan, None, None, None)}
+
+
+@pytest.mark.parametrize('compress', [False, True], ids=['raw', 'zlib'])
+@pytest.mark.parametrize('mmap', [True, False])
+def test_round_trip(tmp_path, compress, mmap):
+    f = str(tmp_path / ('work' + session.SESSION_EXT))
+    curves = _curves()
+    params = {'grid': 'exact', 'scale': [1.5, 1.], 'file': 'a.txt'}
+    session.save_session(f, curves, params, compress=compress)
+    loaded = session.load_session(f, mmap=mmap)
+    assert loaded.params == params
+    assert set(loaded.curves) == set(curves)
+    for name, (x, y, stats, lod) in curves.items():
+        if name == 'result':
+            x, y = x.materialize()
+        x_, y_, stats_, lod_ = loaded.curves[name]
+        np.testing.assert_array_equal(x_, x)
+        np.testing.assert_array_equal(y_, y)
+        assert x_.dtype == x.dtype
+        assert stats_ == pytest.approx(stats or engine.y_stats(y))
+        expected = MinMaxPyramid(x, y)
+        assert len(lod_.levels) == len(expected.levels)
+        for level_, level in zip(lod_.levels, expected.levels):
+            for a_, a in zip(level_, level):
+                np.testing.assert_array_equal(a_, a)
+
+
+def test_empty_curve(tmp_path):
+    f = str(tmp_path / 'empty.pycs')
+    session.save_session(f, {'file1': (np.zeros(0), np.zeros(0), None, None)})
+    x, y, _, _ = session.load_session(f).curves['file1']
+    assert len(x) == len(y) == 0
+
+
+def test_header(tmp_path):
+    f = str(tmp_path / 'work.pycs')
+    session.save_session(f, _curves(), {'a': 1})
+    header = session.read_session_header(f)
+    assert header['version'] == session.SESSION_VERSION
+    assert header['params'] == {'a': 1}
+    assert header['curves']['file2']['n'] == 3000
+
+
+def test_not_a_session(tmp_path):
+    f = tmp_path / 'data.pycs'
+    f.write_bytes(b'1 2\n3 4\n')
+    with pytest.raises(ValueError, match='not a session'):
+        session.load_session(str(f))
+
+
+def test_failed_save_keeps_the_old_file(tmp_path):
+    f = str(tmp_path / 'work.pycs')
+    session.save_session(f, _curves(), {'a': 1})
+    with pytest.raises(ValueError):
+        session.save_session(f, _curves(), {'a': object()})
+    assert session.load_session(f).params == {'a': 1}
+    assert [p.name for p in tmp_path.iterdir()] == ['work.pycs']
@@ -0,0 +1,57 @@
+#! encoding = utf-8
+
+""" Tests of engine.plan_stitch """
+
+import numpy as np
+import pytest
+from PyConcat.libs import engine
+
+
+def _line(x0, x1):
+    x = np.arange(x0, x1 + 1, dtype=float)
+    return x, 2 * x + 1
+
+
+def test_gap_keeps_the_last_point():
+    x1, y1 = _line(0, 10)
+    x2, y2 = _line(20, 30)
+    x, y = engine.stitch([(x1, y1), (x2, y2)])
+    assert len(x) == 22
+    np.testing.assert_array_equal(x, np.concatenate((x1, x2)))
+    np.testing.assert_array_equal(y, np.concatenate((y1, y2)))
+    xc, _, _, _ = engine.concat(x1, y1, x2, y2)
+    np.testing.assert_array_equal(x, xc)
+
+
+def test_gap_after_an_overlap():
+    x, y = engine.stitch([_line(0, 10), _line(5, 20), _line(30, 40)])
+    np.testing.assert_array_equal(x, np.concatenate((np.arange(21.), np.arange(30., 41.))))
+    np.testing.assert_allclose(y, 2 * x + 1)
+
+
+def test_touching_segments_keep_the_boundary_once():
+    x, _ = engine.stitch([_line(0, 10), _line(10, 20)])
+    np.testing.assert_array_equal(x, np.arange(21.))
+
+
+def test_overlap_is_the_weighted_average():
+    x1 = np.arange(0., 11.)
+    x2 = np.arange(5., 16.)
+    x, y = engine.stitch([(x1, np.zeros(11), 1, 1., 0.), (x2, np.ones(11), 3, 1., 0.)])
+    np.testing.assert_array_equal(x, np.arange(16.))
+    np.testing.assert_allclose(y[(x > 5) & (x < 10)], 0.75)
+    np.testing.assert_allclose(y[x > 10], 1.)
+    np.testing.assert_allclose(y[x < 5], 0.)
+
+
+def test_order_of_the_segments_does_not_matter():
+    segs = [_line(0, 10), _line(5, 20), _line(30, 40)]
+    x, y = engine.stitch(segs)
+    xr, yr = engine.stitch(segs[::-1])
+    np.testing.assert_array_equal(x, xr)
+    np.testing.assert_array_equal(y, yr)
+
+
+def test_no_data():
+    with pytest.raises(ValueError):
+        engine.stitch([(np.zeros(0), np.zeros(0))])
@@ -0,0 +1,143 @@
+#! encoding = utf-8
+
+""" Tests of the out-of-core concatenation of libs.stream """
+
+import os
+import numpy as np
+import pytest
+from PyConcat.libs import engine, lib, stream
+
+
+def _blocks(x, y, rng, sizes=(1, 2, 3, 7)):
+    i = 0
+    while i < len(x):
+        k = int(rng.choice(sizes))
+        yield x[i:i + k], y[i:i + k]
+        i += k
+
+
+def _random_case(rng):
+    n1, n2 = rng.integers(2, 40, 2)
+    if rng.random() < 0.5:
+        # shifted grids, which often share their overlap
+        o1, o2 = rng.integers(-20, 40, 2)
+        x1 = o1 + np.arange(n1, dtype=float)
+        x2 = o2 + np.arange(n2) * rng.choice([1., 0.5])
+    else:
+        x1 = np.sort(rng.uniform(-10, 30, n1))
+        x2 = np.sort(rng.uniform(-10, 30, n2))
+    y1 = rng.standard_normal(n1)
+    y2 = rng.standard_normal(n2)
+    kwargs = dict(avg1=int(rng.integers(1, 4)), avg2=int(rng.integers(1, 4)),
+                  scale1=rng.choice([1, 1.3]), scale2=rng.choice([1, 0.7]),
+                  yshift1=0.2, yshift2=-0.1, replace=bool(rng.random() < 0.3),
+                  grid=rng.choice([engine.GRID_EXACT, engine.GRID_FILE1, engine.GRID_FILE2]),
+                  ym1=np.median(y1), ym2=np.median(y2))
+    return x1, y1, x2, y2, kwargs
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_same_as_plan_concat(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(50):
+        x1, y1, x2, y2, kwargs = _random_case(rng)
+        try:
+            expected = engine.plan_concat(x1, y1, x2, y2, **kwargs).materialize()
+        except ValueError:
+            with pytest.raises(ValueError):
+                list(stream.merge_streams(_blocks(x1, y1, rng), _blocks(x2, y2, rng), **kwargs))
+            continue
+        out = list(stream.merge_streams(_blocks(x1, y1, rng), _blocks(x2, y2, rng), **kwargs))
+        x = np.concatenate([b[0] for b in out])
+        y = np.concatenate([b[1] for b in out])
+        np.testing.assert_allclose(x, expected[0])
+        np.testing.assert_allclose(y, expected[1])
+
+
+def test_exact_grid_only_compares_the_counts():
+    x1 = np.arange(10.)
+    x2 = np.array([5., 6.5, 7., 8.2, 9., 10., 11.])
+    y1 = np.ones(10)
+    y2 = 3 * np.ones(7)
+    out = list(stream.merge_streams([(x1, y1)], [(x2[:3], y2[:3]), (x2[3:], y2[3:])]))
+    x, y, _, _ = engine.concat(x1, y1, x2, y2)
+    np.testing.assert_array_equal(np.concatenate([b[0] for b in out]), x)
+    np.testing.assert_array_equal(np.concatenate([b[1] for b in out]), y)
+
+
+def test_exact_grid_different_counts():
+    x1 = np.arange(10.)
+    x2 = np.array([5., 6.5, 7., 7.5, 8.2, 9., 10.])
+    with pytest.raises(ValueError):
+        engine.concat(x1, x1, x2, x2)
+    with pytest.raises(ValueError):
+        list(stream.merge_streams([(x1, x1)], [(x2, x2)]))
+
+
+@pytest.mark.parametrize('blocks1, message', [
+    ([(np.array([0., 2., 1.]), np.zeros(3))], 'sorted'),
+    ([], 'loaded'),
+])
+def test_bad_inputs(blocks1, message):
+    x = np.arange(5.)
+    with pytest.raises(ValueError, match=message):
+        list(stream.merge_streams(blocks1, [(x, x)]))
+
+
+def test_step_grid_cannot_be_streamed():
+    x = np.arange(5.)
+    with pytest.raises(ValueError):
+        list(stream.merge_streams([(x, x)], [(x, x)], grid=engine.GRID_STEP))
+
+
+def test_scale_needs_the_median():
+    x = np.arange(5.)
+    with pytest.raises(ValueError, match='median'):
+        list(stream.merge_streams([(x, x)], [(x, x)], scale1=2.))
+
+
+def test_estimate_median():
+    y = np.random.default_rng(0).standard_normal(10001)
+    blocks = [(None, y[i:i + 1000]) for i in range(0, len(y), 1000)]
+    assert stream.estimate_median(blocks) == np.median(y)
+    assert abs(stream.estimate_median(blocks, max_points=500) - np.median(y)) < 0.1
+    assert stream.estimate_median([]) is None
+
+
+def test_stream_concat_file(tmp_path):
+    x1 = np.arange(0., 100.)
+    x2 = np.arange(50., 200., 0.5)
+    y1 = np.sin(x1)
+    y2 = np.cos(x2)
+    f1, f2, out, ref = (str(tmp_path / name) for name in ('1.txt', '2.txt', 'out.txt', 'ref.txt'))
+    np.savetxt(f1, np.column_stack((x1, y1)))
+    np.savetxt(f2, np.column_stack((x2, y2)))
+    kwargs = dict(grid=engine.GRID_FILE2, scale1=1.5, avg2=2)
+    stream.stream_concat(f1, f2, out, chunk_size=512, **kwargs)
+    d1 = lib.load_xy_file(f1)
+    d2 = lib.load_xy_file(f2)
+    x, y, _, _ = engine.concat(d1[:, 0], d1[:, 1], d2[:, 0], d2[:, 1],
+                               ym1=np.median(d1[:, 1]), **kwargs)
+    lib.save_xy_file(ref, x, y)
+    with open(out, 'rb') as a, open(ref, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_stream_concat_error_keeps_the_output(tmp_path):
+    x1 = np.arange(0., 10000.)
+    x2 = np.concatenate((np.arange(5000., 9000.), np.arange(9001., 12000.)))
+    f1, f2, out = (str(tmp_path / name) for name in ('1.txt', '2.txt', 'out.txt'))
+    np.savetxt(f1, np.column_stack((x1, x1)))
+    np.savetxt(f2, np.column_stack((x2, x2)))
+    with open(out, 'wb') as f:
+        f.write(b'old')
+    # the different dimensions are only found after blocks were written
+    with pytest.raises(ValueError, match='dimensions'):
+        stream.stream_concat(f1, f2, out, chunk_size=4096)
+    with open(out, 'rb') as f:
+        assert f.read() == b'old'
+    assert sorted(os.listdir(str(tmp_path))) == ['1.txt', '2.txt', 'out.txt']
+    os.remove(out)
+    with pytest.raises(ValueError, match='dimensions'):
+        stream.stream_concat(f1, f2, out, chunk_size=4096)
+    assert not os.path.exists(out)
@@ -0,0 +1,84 @@
+#! encoding = utf-8
+
+""" Tests of the timing instrumentation of libs.trace """
+
+import json
+import re
+import numpy as np
+import pytest
+from PyConcat.libs import trace
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    """ A fresh enabled tracer, disabled again after the test """
+    t = trace.Tracer()
+    monkeypatch.setattr(trace, 'TRACER', t)
+    t.enable()
+    yield t
+    t.enable(False)
+
+
+@trace.traced
+def _double(x):
+    return 2 * x
+
+
+@trace.traced('inner')
+def _inner(x):
+    return x + 1
+
+
+def test_nested_spans(tracer, tmp_path):
+    finished = []
+    tracer.add_listener(finished.append)
+    with trace.span('outer', n=3) as sp:
+        _double(np.zeros(5))
+        for _ in range(2):
+            _inner(np.zeros(7))
+        sp.args['rows'] = 9
+    assert finished == [tracer.last]
+    outer = tracer.last
+    assert outer.name == 'outer'
+    assert outer.args == {'n': 3, 'rows': 9}
+    assert [c.name for c in outer.children] == ['_double', 'inner', 'inner']
+    assert [c.args['n'] for c in outer.children] == [5, 7, 7]
+    assert outer.wall >= sum(c.wall for c in outer.children)
+    # children of the same name are added up
+    text = outer.breakdown()
+    assert re.fullmatch(r'outer \[3\] [\d.]+ ms: _double [\d.]+ ms, inner [\d.]+ ms', text)
+
+    chrome = tracer.to_chrome()
+    events = chrome['traceEvents']
+    assert [ev['name'] for ev in events] == ['outer', '_double', 'inner', 'inner']
+    assert all(ev['ph'] == 'X' and ev['dur'] >= 0 and 'cpu_ms' in ev['args'] for ev in events)
+    assert events[0]['ts'] <= events[1]['ts'] <= events[2]['ts']
+    assert events[0]['dur'] >= events[1]['dur']
+    f = str(tmp_path / 'trace.json')
+    tracer.dump(f)
+    with open(f) as fp:
+        assert json.load(fp)['traceEvents'][0]['args']['n'] == 3
+
+    tracer.clear()
+    assert tracer.spans() == [] and tracer.last is None
+
+
+def test_max_spans(monkeypatch):
+    monkeypatch.setattr(trace, 'MAX_SPANS', 5)
+    t = trace.Tracer()
+    monkeypatch.setattr(trace, 'TRACER', t)
+    t.enable()
+    try:
+        for i in range(8):
+            with trace.span('s{:d}'.format(i)):
+                pass
+    finally:
+        t.enable(False)
+    assert [sp.name for sp in t.spans()] == ['s3', 's4', 's5', 's6', 's7']
+
+
+def test_disabled(tracer):
+    tracer.enable(False)
+    assert trace.span('nothing') is trace._NULL_SPAN
+    assert _double(3) == 6
+    assert tracer.spans() == []